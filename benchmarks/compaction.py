@@ -0,0 +1,89 @@
+"""
+    Benchmark of compacting expired reminders, and of what it saves to the queries on pending ones.
+
+    Seeds a sqlite file db with `n` reminders due over the last two years, 90% of them
+    expired, and times the pending reminders queries before and after running compaction
+    until nothing is left to archive.
+    Run with `python -m benchmarks.compaction [n ...]`
+"""
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+SIZES = [100000, 1000000]
+SPREAD = timedelta(days=730)
+EXPIRED_RATIO = 0.9
+SEED_BATCH_SIZE = 10000
+
+
+def seed(n):
+    from bot.db import transaction
+    from bot.jobs.models import Reminder
+
+    now = datetime.now(timezone.utc)
+    for first in range(0, n, SEED_BATCH_SIZE):
+        rows = []
+        for i in range(first, min(first + SEED_BATCH_SIZE, n)):
+            expired = i % 10 < EXPIRED_RATIO * 10
+            remind_time = now - SPREAD * i / n if expired else now + timedelta(days=i % 30)
+            rows.append({
+                'key': f'{i % 1000}>reminder {i}>{remind_time.isoformat()}', 'text': f'reminder {i}',
+                'user_id': i % 1000, 'user_tag': f'@user{i % 1000}', 'remind_time': remind_time, 'chat_id': i % 1000,
+                'offset': 0, 'expired': expired, 'job_context': {'thing_to_remind': f'reminder {i}'},
+            })
+        with transaction() as conn:
+            conn.execute(Reminder.__table__.insert(), rows)
+
+
+def timed(func, runs=5):
+    start = time.perf_counter()
+    for _ in range(runs):
+        func()
+    return (time.perf_counter() - start) / runs * 1000
+
+
+def run(n):
+    from bot.db import get_engine
+    from bot.jobs.compaction import Compactor
+    from bot.jobs.db_ops import get_reminders, iter_pending_reminders
+    from bot.jobs.models import ArchivedReminder, Base, Reminder
+
+    tables = [Reminder.__table__, ArchivedReminder.__table__]
+    Base.metadata.drop_all(get_engine(), tables=tables)
+    Base.metadata.create_all(get_engine(), tables=tables)
+    seed(n)
+    horizon = datetime.now(timezone.utc) + timedelta(days=1)
+
+    def pending_queries():
+        return (timed(lambda: get_reminders(expired=False, user_id=1)),
+                timed(lambda: sum(len(batch) for batch in iter_pending_reminders(horizon))))
+
+    before = pending_queries()
+    compactor, runs, archived, purged, seconds = Compactor(), 0, 0, 0, 0.0
+    while True:
+        stats = compactor.run()
+        runs += 1
+        archived, purged, seconds = archived + stats['archived'], purged + stats['purged'], seconds + stats['seconds']
+        if not stats['archived'] and not stats['purged']:
+            break
+    after = pending_queries()
+
+    print(f"{n:>8} {runs:>5} {archived:>9} {purged:>8} {seconds:>8.2f}s {archived / seconds:>9.0f}/s"
+          f" {before[0]:>9.2f} {after[0]:>8.2f} {before[1]:>9.2f} {after[1]:>8.2f}")
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    os.environ['DATABASE_URL'] = f'sqlite:///{tempfile.mkdtemp()}/compaction.db'
+    sizes = [int(arg) for arg in sys.argv[1:]] or SIZES
+    print(f"{'rows':>8} {'runs':>5} {'archived':>9} {'purged':>8} {'time':>9} {'rows/s':>11}"
+          f" {'user ms':>9} {'after':>8} {'due ms':>9} {'after':>8}")
+    for n in sizes:
+        run(n)
+
+
+if __name__ == '__main__':
+    main()
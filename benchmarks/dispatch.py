@@ -0,0 +1,105 @@
+"""
+    Dispatch benchmark: many users query their reminders at once while the db is slow.
+
+    Runs once with handlers on the dispatcher thread and once with concurrent handlers, each
+    on a fresh interpreter, and reports throughput and reply latency percentiles.
+    Every db statement is delayed by a fixed round-trip, like on a remote postgres.
+    Run with `python -m benchmarks.dispatch [updates] [db_latency_ms]`
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+CHILD_FLAG = '--child'
+
+
+def command_update(update_id, user_id, command):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+            'text': command,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command.split()[0])}],
+        },
+    }
+
+
+def child(updates, db_latency):
+    import logging
+    logging.disable(logging.CRITICAL)
+    # A file db, as each thread gets its own in-memory sqlite db
+    os.environ['DATABASE_URL'] = f'sqlite:///{tempfile.mkdtemp()}/dispatch.db'
+    os.environ['STATE_JOURNAL_PATH'] = os.devnull
+
+    from sqlalchemy import event
+    from telegram import Update
+
+    import bot.__main__ as entrypoint
+    from benchmarks.fakes import FakeBot
+    from bot.db import get_engine
+    from bot.jobs.models import create_tables
+
+    create_tables()
+
+    @event.listens_for(get_engine(), 'before_cursor_execute')
+    def round_trip(*args):
+        time.sleep(db_latency)
+
+    fake_bot = FakeBot()
+    updater = entrypoint.create_updater(bot=fake_bot)
+    dispatcher = updater.dispatcher
+    dispatcher_thread = threading.Thread(target=dispatcher.start, daemon=True)
+    dispatcher_thread.start()
+
+    queued_at = {}
+    start = time.monotonic()
+    for user_id in range(1, updates + 1):
+        queued_at[user_id] = time.monotonic()
+        dispatcher.update_queue.put(Update.de_json(command_update(user_id, user_id, '/myreminders'), fake_bot))
+
+    while len(fake_bot.sent) < updates:
+        time.sleep(0.01)
+    elapsed = time.monotonic() - start
+    dispatcher.stop()
+
+    assert all(data['text'] == 'No reminders set yet' for _, _, data in fake_bot.sent), 'Handlers failed'
+    latencies = sorted(sent_at - queued_at[int(data['chat_id'])] for sent_at, _, data in fake_bot.sent)
+    print(json.dumps({
+        'updates_per_s': updates / elapsed,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000,
+    }))
+
+
+def run_child(concurrent, updates, db_latency_ms):
+    env = {**os.environ, 'CONCURRENT_HANDLERS': '1' if concurrent else '0'}
+    result = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.dispatch', CHILD_FLAG, str(updates), str(db_latency_ms)],
+        capture_output=True, text=True, check=True, env=env,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main(updates, db_latency_ms):
+    workers = os.environ.get('BOT_WORKERS', 16)
+    print(f'{updates} /myreminders updates with {db_latency_ms}ms db round-trips, {workers} workers')
+    for name, concurrent in (('dispatcher thread', False), ('concurrent', True)):
+        result = run_child(concurrent, updates, db_latency_ms)
+        print(f"{name:<18} {result['updates_per_s']:>8.1f} updates/s"
+              f"   p50 {result['p50_ms']:>8.1f}ms   p99 {result['p99_ms']:>8.1f}ms")
+
+
+if __name__ == '__main__':
+    if CHILD_FLAG in sys.argv:
+        child(int(sys.argv[2]), int(sys.argv[3]) / 1000)
+    else:
+        updates = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+        db_latency_ms = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+        main(updates, db_latency_ms)
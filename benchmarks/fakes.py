@@ -0,0 +1,82 @@
+"""
+    A telegram Bot that answers from memory instead of calling the Bot API.
+
+    It swaps the bot's http Request, so every Bot method still runs its own code.
+"""
+import threading
+import time
+
+from telegram import Bot
+from telegram.error import RetryAfter
+
+from bot.outbound import QueuedBot
+
+BOT_USER = {'id': 1000, 'is_bot': True, 'first_name': 'RemindersBot', 'username': 'RRemindersBot'}
+
+
+class FakeRequest(object):
+    """Answer Bot API calls and record the sent messages as (monotonic time, method, data)"""
+    con_pool_size = 100
+
+    def __init__(self, latency=0.0, flood_after=None):
+        self.latency = latency
+        # Answer the n-th sent message with a RetryAfter, like Telegram flood control does
+        self.flood_after = flood_after
+        self.sent = []
+        self.first_poll = threading.Event()
+        self._message_id = 0
+        self._lock = threading.Lock()
+
+    def get(self, url, timeout=None):
+        return self.post(url, {}, timeout=timeout)
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        if self.latency:
+            time.sleep(self.latency)
+
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getUpdates':
+            self.first_poll.set()
+            time.sleep(0.05)
+            return []
+        if method in ('deleteWebhook', 'setWebhook', 'answerCallbackQuery'):
+            return True
+
+        with self._lock:
+            if self.flood_after is not None and self._message_id == self.flood_after:
+                self.flood_after = None
+                raise RetryAfter(1)
+            self._message_id += 1
+            self.sent.append((time.monotonic(), method, data))
+            message_id = self._message_id
+        chat_id = data.get('chat_id', 1)
+        return {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if int(chat_id) > 0 else 'group'},
+            'from': BOT_USER,
+            'text': data.get('text', ''),
+        }
+
+    def stop(self):
+        pass
+
+
+class FakeBot(Bot):
+    def __init__(self, latency=0.0):
+        super().__init__('123456:fake-token', request=FakeRequest(latency))
+
+    @property
+    def sent(self):
+        return self._request.sent
+
+
+class FakeQueuedBot(QueuedBot):
+    def __init__(self, latency=0.0, flood_after=None, queue=None):
+        super().__init__('123456:fake-token', request=FakeRequest(latency, flood_after), queue=queue)
+
+    @property
+    def sent(self):
+        return self._request.sent
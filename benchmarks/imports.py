@@ -0,0 +1,80 @@
+"""
+    Benchmark of importing reminders from .csv and .ics files.
+
+    Generates files with `n` reminders spread over the next year, a few of them due within
+    the scheduling horizon, and imports each one into a fresh sqlite file db. Then imports
+    it again, which skips every row as already saved.
+    Run with `python -m benchmarks.imports [n ...]`
+"""
+import io
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from benchmarks.suite import SqlCounter
+
+SIZES = [10000, 50000]
+OFFSET = -10800
+SPREAD = timedelta(days=365)
+
+
+def csv_file(n, start):
+    lines = ['text,date\n']
+    for i in range(n):
+        when = start + SPREAD * (i + 1) / n
+        lines.append(f'reminder {i},{when:%Y-%m-%d %H:%M}\n')
+    return ''.join(lines)
+
+
+def ics_file(n, start):
+    lines = ['BEGIN:VCALENDAR\r\n', 'VERSION:2.0\r\n']
+    for i in range(n):
+        when = start + SPREAD * (i + 1) / n
+        lines += [
+            'BEGIN:VEVENT\r\n', f'UID:{i}@bench\r\n', f'SUMMARY:reminder {i}\\, from the calendar\r\n',
+            f'DTSTART;TZID=America/Argentina/Buenos_Aires:{when:%Y%m%dT%H%M%S}\r\n',
+            'BEGIN:VALARM\r\n', 'TRIGGER:-PT15M\r\n', 'END:VALARM\r\n', 'END:VEVENT\r\n',
+        ]
+    lines.append('END:VCALENDAR\r\n')
+    return ''.join(lines)
+
+
+def run(n):
+    from telegram.ext import JobQueue
+
+    from bot.db import get_engine
+    from bot.handlers.imports import import_reminders
+    from bot.jobs.models import Base, Reminder
+    from bot.reminder_files import CSV, ICS, read_entries
+
+    start = datetime.utcnow() + timedelta(seconds=OFFSET)
+    base_context = {'thing_to_remind': None, 'user_id': 1, 'user_tag': '@user1', 'chat_id': 1, 'offset': OFFSET}
+    sql = SqlCounter(get_engine())
+    for kind, content in ((CSV, csv_file(n, start)), (ICS, ics_file(n, start))):
+        Base.metadata.drop_all(get_engine(), tables=[Reminder.__table__])
+        Base.metadata.create_all(get_engine(), tables=[Reminder.__table__])
+        for attempt in ('first', 'again'):
+            job_queue, before = JobQueue(), sql.statements
+            began = time.perf_counter()
+            stats, errors = import_reminders(read_entries(kind, io.StringIO(content)), base_context, job_queue)
+            elapsed = time.perf_counter() - began
+            assert not errors, errors
+            print(f"{n:>7} {kind:<4} {attempt:<6} {elapsed:>8.2f}s {n / elapsed:>10.0f} rows/s"
+                  f" {sql.statements - before:>6} statements  imported {stats['imported']}"
+                  f" queued {stats['queued']} duplicated {stats['duplicated']}")
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    os.environ['DATABASE_URL'] = f'sqlite:///{tempfile.mkdtemp()}/imports.db'
+    sizes = [int(arg) for arg in sys.argv[1:]] or SIZES
+    print(f"{'rows':>7} {'kind':<4} {'import':<6} {'time':>9} {'throughput':>15} {'sql':>6}")
+    for n in sizes:
+        run(n)
+
+
+if __name__ == '__main__':
+    main()
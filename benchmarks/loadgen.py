@@ -0,0 +1,308 @@
+"""
+    Load generator: simulated users drive the real Dispatcher through a day of reminders.
+
+    Every user runs sessions at random times of the day: /q, /remind conversations with a
+    time button press, /myreminders and /delete. When one of their reminders fires they press
+    Done or Remind again. Users wait for the bot to answer before their next update.
+
+    The bot runs on a simulated clock, `speed` times faster than the real one, so a day of
+    reminders firing takes seconds. The job_queue and the bot's own datetimes read it, and
+    the job_queue is ticked by the generator instead of sleeping on its own thread.
+    Reports handler latency per kind of update and the lag between the time a reminder was
+    due and the time it was sent, in simulated seconds.
+    Run with `python -m benchmarks.loadgen [--users N] [--day-seconds S]`
+"""
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from benchmarks.dispatch import command_update
+from benchmarks.suite import callback_update
+
+DAY = 24 * 3600
+TIME_OPTIONS = [5 * 60, 10 * 60, 20 * 60, 30 * 60, 3600, 2 * 3600, 4 * 3600, 8 * 3600, 12 * 3600]
+# Relative weights of the sessions users start by themselves
+SESSIONS = {'/q': 4, '/remind': 3, '/myreminders': 2, '/delete': 1}
+DONE_RATIO = 0.7
+# Users don't answer a reminder or start a session right away. In simulated seconds
+THINK_TIME = (30, 1800)
+# Real seconds to wait for an answer before counting the update as unanswered
+ANSWER_TIMEOUT = 10
+OFFSET = -10800
+
+# Modules whose `datetime` is swapped for one reading the simulated clock
+CLOCK_AWARE_MODULES = ['bot.utils', 'bot.jobs.job_loader', 'bot.recurrence', 'bot.handlers.every']
+
+
+class SimulatedClock(object):
+    """Stands in for the time module. Starts at the real time and runs `speed` times faster"""
+    def __init__(self, speed):
+        self.speed = speed
+        self._start = time.time()
+        self._real_start = time.monotonic()
+
+    def at(self, monotonic):
+        """Simulated time at a real time.monotonic() reading"""
+        return self._start + (monotonic - self._real_start) * self.speed
+
+    def time(self):
+        return self.at(time.monotonic())
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def simulated_datetime(clock):
+    class SimulatedDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.fromtimestamp(clock.time(), tz)
+
+        @classmethod
+        def utcnow(cls):
+            return datetime.utcfromtimestamp(clock.time())
+
+    return SimulatedDatetime
+
+
+def install_clock(clock):
+    import importlib
+
+    import telegram.ext.jobqueue
+    import telegram.utils.helpers
+
+    telegram.ext.jobqueue.time = clock
+    # Converts relative job times, like the first run of repeating jobs
+    telegram.utils.helpers.time = clock
+    for name in CLOCK_AWARE_MODULES:
+        importlib.import_module(name).datetime = simulated_datetime(clock)
+
+
+class User(object):
+    """A simulated user. Runs one session at a time, one update at a time"""
+    def __init__(self, user_id, rng):
+        self.id = user_id
+        self.rng = rng
+        self.reminders = []
+        # (simulated time, tie breaker, session kind or id of the reminder to answer)
+        self.sessions = []
+        self._order = itertools.count()
+        self.session = None
+        self.waiting = None
+
+    def plan_day(self, start, sessions):
+        kinds = self.rng.choices(list(SESSIONS), weights=list(SESSIONS.values()), k=sessions)
+        for kind in kinds:
+            self.schedule(start + self.rng.uniform(0, DAY), kind)
+
+    def schedule(self, when, kind):
+        heapq.heappush(self.sessions, (when, next(self._order), kind))
+
+    def react_to(self, now, reminder_id):
+        """Answer a reminder after a while"""
+        self.schedule(now + self.rng.uniform(*THINK_TIME), reminder_id)
+
+    def next_session(self, now):
+        if self.session is not None or not self.sessions or self.sessions[0][0] > now:
+            return None
+        _, _, kind = heapq.heappop(self.sessions)
+        self.session = self.run_session(kind)
+        return next(self.session)
+
+    def answered(self, answer):
+        """Continue the session with the bot answer. Returns the next update, if any"""
+        try:
+            return self.session.send(answer)
+        except StopIteration:
+            self.session = None
+            return None
+
+    def run_session(self, kind):
+        """Generator of (kind, update) of a session. Gets sent the bot answer to each update"""
+        if isinstance(kind, int):
+            if self.rng.random() < DONE_RATIO:
+                yield 'Done', callback_update(0, self.id, f'done:{kind}')
+            else:
+                yield 'Remind again', callback_update(0, self.id, f'again:{kind}')
+                yield 'time button', callback_update(0, self.id, str(self.rng.choice(TIME_OPTIONS)))
+        elif kind == '/q':
+            text = f'task {self.rng.randrange(10 ** 6)}'
+            self.reminders.append(text)
+            yield kind, command_update(0, self.id, f'/q {text}, {self.rng.randint(1, 240)}')
+        elif kind == '/remind':
+            text = f'task {self.rng.randrange(10 ** 6)}'
+            self.reminders.append(text)
+            yield kind, command_update(0, self.id, f'/remind {text}')
+            yield 'time button', callback_update(0, self.id, str(self.rng.choice(TIME_OPTIONS)))
+        elif kind == '/delete' and self.reminders:
+            text = self.reminders.pop(self.rng.randrange(len(self.reminders)))
+            yield kind, command_update(0, self.id, f'/delete {text}')
+        else:
+            yield '/myreminders', command_update(0, self.id, '/myreminders')
+
+
+def reminder_id_of(data):
+    """Id of the reminder a sent message notifies of, or None if it is not a notification"""
+    markup = data.get('reply_markup')
+    if not markup:
+        return None
+    for row in json.loads(markup)['inline_keyboard']:
+        for button in row:
+            data = str(button.get('callback_data', ''))
+            if data.startswith('done:'):
+                return int(data.split(':')[1])
+    return None
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    pick = lambda p: values[min(len(values) - 1, int(len(values) * p))]
+    return {'count': len(values), 'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99), 'max': values[-1]}
+
+
+def seed_users(n_users):
+    from sqlalchemy import text
+
+    from bot.db import transaction
+
+    with transaction() as conn:
+        conn.execute(text('INSERT INTO user_state (user_id, data) VALUES (:id, :data)'), [
+            {'id': user_id, 'data': json.dumps({'offset': OFFSET})} for user_id in range(1, n_users + 1)
+        ])
+
+
+def run(n_users, day_seconds, sessions_per_day, seed):
+    logging.disable(logging.CRITICAL)
+    os.environ['DATABASE_URL'] = f'sqlite:///{tempfile.mkdtemp()}/loadgen.db'
+    os.environ['STATE_JOURNAL_PATH'] = os.devnull
+    clock = SimulatedClock(DAY / day_seconds)
+    install_clock(clock)
+
+    from telegram import Update
+
+    import bot.__main__ as entrypoint
+    from benchmarks.fakes import FakeBot
+    from bot.jobs.db_ops import get_reminders
+    from bot.jobs.models import create_tables
+
+    create_tables()
+    seed_users(n_users)
+    fake_bot = FakeBot()
+    updater = entrypoint.create_updater(bot=fake_bot)
+    dispatcher, job_queue = updater.dispatcher, updater.job_queue
+    threading.Thread(target=dispatcher.start, daemon=True).start()
+
+    rng = random.Random(seed)
+    start = clock.time()
+    users = {user_id: User(user_id, random.Random(rng.random())) for user_id in range(1, n_users + 1)}
+    for user in users.values():
+        user.plan_day(start, sessions_per_day)
+
+    update_id = 0
+    latencies, unanswered = defaultdict(list), defaultdict(int)
+    notified = {}
+
+    def put(user, kind_and_update):
+        nonlocal update_id
+        if kind_and_update is None:
+            user.waiting = None
+            return
+        kind, update = kind_and_update
+        update_id += 1
+        update['update_id'] = update_id
+        user.waiting = (kind, time.monotonic())
+        dispatcher.update_queue.put(Update.de_json(update, fake_bot))
+
+    seen = 0
+    real_start = time.monotonic()
+    while clock.time() < start + DAY or any(user.waiting for user in users.values()):
+        job_queue.tick()
+
+        sent = fake_bot.sent
+        for sent_at, method, data in sent[seen:len(sent)]:
+            user = users.get(int(data['chat_id']))
+            if user is None:
+                continue
+            reminder_id = reminder_id_of(data) if method == 'sendMessage' else None
+            if reminder_id is not None:
+                notified[reminder_id] = clock.at(sent_at)
+                if clock.time() < start + DAY:
+                    user.react_to(clock.time(), reminder_id)
+            elif user.waiting is not None:
+                kind, put_at = user.waiting
+                latencies[kind].append((sent_at - put_at) * 1000)
+                put(user, user.answered(data))
+        seen = len(sent)
+
+        now = clock.time()
+        for user in users.values():
+            if user.waiting is None:
+                if now < start + DAY:
+                    put(user, user.next_session(now))
+            elif time.monotonic() - user.waiting[1] > ANSWER_TIMEOUT:
+                unanswered[user.waiting[0]] += 1
+                user.session, user.waiting = None, None
+        time.sleep(0.001)
+
+    elapsed = time.monotonic() - real_start
+    dispatcher.stop()
+
+    # sqlite returns naive utc datetimes
+    due_times = {reminder.id: reminder.remind_time.replace(tzinfo=timezone.utc) for reminder in get_reminders()}
+    lags = [sent - due_times[reminder_id].timestamp() for reminder_id, sent in notified.items()
+            if reminder_id in due_times]
+    return {
+        'users': n_users,
+        'simulated_seconds': DAY,
+        'real_seconds': elapsed,
+        'updates': update_id,
+        'updates_per_real_s': update_id / elapsed,
+        'handler_latency_ms': {kind: percentiles(values) for kind, values in latencies.items()},
+        'unanswered': dict(unanswered),
+        'notifications': len(notified),
+        'notification_lag_s': percentiles(lags),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200, help='simulated users')
+    parser.add_argument('--day-seconds', type=float, default=60, help='real seconds a simulated day lasts')
+    parser.add_argument('--sessions', type=int, default=6, help='sessions a user starts per day')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='json file to write the results to')
+    args = parser.parse_args()
+
+    result = run(args.users, args.day_seconds, args.sessions, args.seed)
+    print(f"{result['users']} users, a simulated day in {result['real_seconds']:.1f}s."
+          f" {result['updates']} updates ({result['updates_per_real_s']:.1f}/s)")
+    print(f"{'update':<14} {'count':>6} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for kind, p in sorted(result['handler_latency_ms'].items()):
+        print(f"{kind:<14} {p['count']:>6} {p['p50']:>8.1f} {p['p90']:>8.1f} {p['p99']:>8.1f} {p['max']:>8.1f}")
+    if result['unanswered']:
+        print(f"Unanswered updates: {result['unanswered']}")
+
+    lag = result['notification_lag_s']
+    print(f"\n{result['notifications']} reminders sent")
+    if lag['count']:
+        print(f"lag behind due time  p50 {lag['p50']:.1f}s  p90 {lag['p90']:.1f}s"
+              f"  p99 {lag['p99']:.1f}s  max {lag['max']:.1f}s (simulated)")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""
+    Burst benchmark for the outbound queue: many reminders fire at once while users chat.
+
+    Reports how long the burst took to drain, how long interactive replies waited behind it
+    and the most messages a single chat got in any second.
+    Run with `python -m benchmarks.outbound [notifications] [chats]`
+"""
+import logging
+import sys
+import time
+from collections import Counter
+
+from benchmarks.fakes import FakeQueuedBot
+from bot.outbound import BULK
+
+
+def main(notifications, chats):
+    logging.disable(logging.CRITICAL)
+    # Telegram answers the 50th message with a RetryAfter
+    bot = FakeQueuedBot(latency=0.005, flood_after=50)
+    start = time.monotonic()
+    burst = [
+        bot.send_message(chat_id=i % chats + 1, text=f'reminder {i}', priority=BULK, block=False)
+        for i in range(notifications)
+    ]
+
+    replies = []
+    for i in range(5):
+        time.sleep(0.2)
+        sent_at = time.monotonic()
+        bot.send_message(chat_id=-(i + 1), text='reply')
+        replies.append(time.monotonic() - sent_at)
+
+    for sent in burst:
+        sent.result()
+    drained = time.monotonic() - start
+    bot.queue.stop()
+
+    per_chat_second = Counter((data['chat_id'], int(sent_at - start)) for sent_at, _, data in bot.sent)
+    print(f'{notifications} notifications to {chats} chats drained in {drained:.2f}s')
+    print(f'Interactive reply latency: max {max(replies) * 1000:.0f}ms')
+    print(f'Max messages to a chat in one second: {max(per_chat_second.values())}')
+    print(f'Stats: {bot.queue.stats}')
+
+
+if __name__ == '__main__':
+    notifications = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    chats = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    main(notifications, chats)
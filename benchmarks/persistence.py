@@ -0,0 +1,93 @@
+"""
+    Micro-benchmark of PSQLPersistence load and flush cost as the number of users grows.
+
+    Runs against DATABASE_URL, an in-memory sqlite db by default.
+    Run with `python -m benchmarks.persistence [n_users ...]`
+"""
+import json
+import logging
+import os
+import sys
+import time
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from sqlalchemy import text
+
+from bot.db import transaction, get_engine
+from bot.jobs.models import Base, State, UserState, ChatState, ConversationState
+from bot.persistence.psqlpersistence import PSQLPersistence
+
+CONVERSATIONS = ('Set Reminders', 'Repeat reminder', 'Delete reminders', 'Change timezone')
+STATE_TABLES = [model.__table__ for model in (State, UserState, ChatState, ConversationState)]
+
+
+def build_tables(n_users):
+    chat_context = {
+        'thing_to_remind': 'buy milk', 'user_id': 0, 'user_tag': '@someone', 'chat_id': 0,
+        'offset': -10800, 'remind_date_iso': '2023-05-01T12:00:00',
+    }
+    Base.metadata.drop_all(get_engine(), tables=STATE_TABLES)
+    Base.metadata.create_all(get_engine(), tables=STATE_TABLES)
+    with transaction() as conn:
+        conn.execute(text('INSERT INTO user_state (user_id, data) VALUES (:id, :data)'), [
+            {'id': i, 'data': json.dumps({'offset': -10800})} for i in range(n_users)
+        ])
+        conn.execute(text('INSERT INTO chat_state (chat_id, data) VALUES (:id, :data)'), [
+            {'id': i, 'data': json.dumps(dict(chat_context, user_id=i, chat_id=i))} for i in range(n_users)
+        ])
+        conn.execute(text('INSERT INTO conversation_state (name, key, state) VALUES (:name, :key, :state)'), [
+            {'name': name, 'key': str((i, i)), 'state': json.dumps(20)}
+            for name in CONVERSATIONS for i in range(0, n_users, 10)
+        ])
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def run(n_users):
+    build_tables(n_users)
+    persistence = PSQLPersistence()
+
+    def load():
+        user_data = persistence.get_user_data()
+        persistence.get_chat_data()
+        for name in CONVERSATIONS:
+            persistence.get_conversations(name)
+        return user_data
+
+    load_time, user_data = timed(load)
+
+    def touch(fraction):
+        for user_id in range(0, n_users, int(1 / fraction)):
+            user_data[user_id]['offset'] += 1
+            persistence.update_user_data(user_id, user_data[user_id])
+
+    touch_time, _ = timed(lambda: touch(0.01))
+    small_flush_time, _ = timed(persistence.checkpoint)
+    touch(1)
+    full_flush_time, _ = timed(persistence.checkpoint)
+
+    return {
+        'users': n_users,
+        'load_s': load_time,
+        'update_1%_s': touch_time,
+        'flush_1%_s': small_flush_time,
+        'flush_all_s': full_flush_time,
+    }
+
+
+def main(sizes):
+    logging.disable(logging.CRITICAL)
+    print(f"{'users':>8} {'load':>10} {'update 1%':>10} {'flush 1%':>10} {'flush all':>10}")
+    for n_users in sizes:
+        r = run(n_users)
+        print(f"{r['users']:>8} {r['load_s']:>10.4f} {r['update_1%_s']:>10.4f}"
+              f" {r['flush_1%_s']:>10.4f} {r['flush_all_s']:>10.4f}")
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [1000, 10000, 100000])
@@ -0,0 +1,81 @@
+"""
+    Startup benchmark: time-to-first-poll and an import-time profile of the bot.
+
+    Every run is a fresh interpreter, so import costs are paid like on a cold start.
+    Run with `python -m benchmarks.startup [runs]`
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+CHILD_FLAG = '--child'
+
+
+def child():
+    """Start the bot against a fake Bot API and report how long each phase took"""
+    start = time.perf_counter()
+    os.environ.setdefault('DATABASE_URL', 'sqlite://')
+    os.environ['STATE_JOURNAL_PATH'] = os.devnull
+
+    import logging
+    import bot.__main__ as entrypoint
+    logging.disable(logging.CRITICAL)
+    imported = time.perf_counter()
+
+    from benchmarks.fakes import FakeBot
+    fake_bot = FakeBot()
+    updater = entrypoint.create_updater(bot=fake_bot)
+    created = time.perf_counter()
+
+    updater.start_polling(poll_interval=0)
+    fake_bot.request.first_poll.wait(30)
+    polled = time.perf_counter()
+    updater.stop()
+
+    print(json.dumps({
+        'import_s': imported - start,
+        'create_updater_s': created - imported,
+        'first_poll_s': polled - start,
+    }))
+
+
+def run_child(*python_flags):
+    return subprocess.run(
+        [sys.executable, *python_flags, '-m', 'benchmarks.startup', CHILD_FLAG],
+        capture_output=True, text=True, check=True,
+    )
+
+
+def import_profile(top=15):
+    """Parse `python -X importtime` output into the slowest top level imports"""
+    stderr = run_child('-X', 'importtime').stderr
+    cumulative = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        # Nested imports are indented under the module that imported them
+        if len(name) - len(name.lstrip()) == 1:
+            cumulative.append((int(cumulative_us), name.strip()))
+    return sorted(cumulative, reverse=True)[:top]
+
+
+def main(runs):
+    results = [json.loads(run_child().stdout.strip().splitlines()[-1]) for _ in range(runs)]
+    print(f'Startup over {runs} runs (median)')
+    for phase in ('import_s', 'create_updater_s', 'first_poll_s'):
+        print(f'{phase:<18} {statistics.median(r[phase] for r in results):>8.3f}s')
+
+    print('\nSlowest top level imports (cumulative)')
+    for cumulative_us, name in import_profile():
+        print(f'{name:<40} {cumulative_us / 1000:>8.1f}ms')
+
+
+if __name__ == '__main__':
+    if CHILD_FLAG in sys.argv:
+        child()
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,237 @@
+"""
+    Benchmark suite of the operations a release is likely to make slower: the /q and /remind
+    handlers, load_reminders, PSQLPersistence.flush and _load_state_from_db.
+
+    Every size runs on a fresh interpreter against a sqlite file db seeded with that many
+    users and reminders, with a fake Bot API. Each operation reports throughput, p50/p99
+    latency, peak traced memory and the SQL statements it ran. Results are written as json,
+    so runs of different releases can be compared.
+    Run with `python -m benchmarks.suite [--output results.json] [sizes ...]`
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from benchmarks.dispatch import command_update
+
+CHILD_FLAG = '--child'
+SIZES = [1000, 100000, 1000000]
+# Reminders are due over the next month, so about 1/30 of them are within a 24h horizon
+REMINDERS_SPREAD = timedelta(days=30)
+SEED_BATCH_SIZE = 10000
+OFFSET = -10800
+
+
+def callback_update(update_id, user_id, data):
+    chat = {'id': user_id, 'type': 'private'}
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': update_id, 'date': int(time.time()), 'chat': chat,
+                'from': {'id': 1000, 'is_bot': True, 'first_name': 'RemindersBot'},
+                'text': 'Perfect👌 Now choose when to be reminded. 🕙',
+            },
+        },
+    }
+
+
+def seed(size):
+    """Insert `size` users with their chat and one pending reminder each"""
+    from sqlalchemy import text
+
+    from bot.db import transaction
+    from bot.jobs.models import Reminder
+
+    now = datetime.utcnow()
+    for first in range(1, size + 1, SEED_BATCH_SIZE):
+        user_ids = range(first, min(first + SEED_BATCH_SIZE, size + 1))
+        with transaction() as conn:
+            conn.execute(text('INSERT INTO user_state (user_id, data) VALUES (:id, :data)'), [
+                {'id': user_id, 'data': json.dumps({'offset': OFFSET})} for user_id in user_ids
+            ])
+            conn.execute(text('INSERT INTO chat_state (chat_id, data) VALUES (:id, :data)'), [
+                {'id': user_id, 'data': '{}'} for user_id in user_ids
+            ])
+            reminders = []
+            for user_id in user_ids:
+                remind_time = now + REMINDERS_SPREAD * user_id / size
+                job_context = {
+                    'thing_to_remind': f'reminder {user_id}', 'user_id': user_id, 'user_tag': f'@user{user_id}',
+                    'chat_id': user_id, 'offset': OFFSET, 'remind_date_iso': remind_time.isoformat(),
+                }
+                reminders.append({
+                    'key': f'{user_id}>reminder {user_id}>{remind_time.isoformat()}', 'text': job_context['thing_to_remind'],
+                    'user_id': user_id, 'user_tag': job_context['user_tag'], 'remind_time': remind_time,
+                    'chat_id': user_id, 'offset': OFFSET, 'expired': False, 'job_context': job_context,
+                })
+            conn.execute(Reminder.__table__.insert(), reminders)
+
+
+class SqlCounter(object):
+    """Count the statements sent to the db. An executemany counts once"""
+    def __init__(self, engine):
+        from sqlalchemy import event
+
+        self.statements = 0
+        event.listen(engine, 'before_cursor_execute', self.count)
+
+    def count(self, *args):
+        self.statements += 1
+
+
+def measure(name, operation, runs, sql, setup=None):
+    """Time `runs` calls of operation(i), then trace the memory of one more call.
+
+    Memory is traced apart as tracemalloc slows down what it traces. `setup(i)` prepares a
+    call without being measured.
+    """
+    timings, statements = [], 0
+    for i in range(runs + 1):
+        if setup is not None:
+            setup(i)
+        before = sql.statements
+        if i < runs:
+            start = time.perf_counter()
+            operation(i)
+            timings.append(time.perf_counter() - start)
+            statements += sql.statements - before
+        else:
+            tracemalloc.start()
+            operation(i)
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    timings.sort()
+    return {
+        'operation': name,
+        'runs': runs,
+        'ops_per_s': runs / sum(timings),
+        'p50_ms': timings[len(timings) // 2] * 1000,
+        'p99_ms': timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000,
+        'peak_memory_kb': peak_memory / 1024,
+        'sql_per_op': statements / runs,
+    }
+
+
+def child(size, handler_runs, bulk_runs):
+    import logging
+    logging.disable(logging.CRITICAL)
+    os.environ['DATABASE_URL'] = f'sqlite:///{tempfile.mkdtemp()}/suite.db'
+    os.environ['STATE_JOURNAL_PATH'] = os.devnull
+    os.environ['CONCURRENT_HANDLERS'] = '0'
+    # Checkpoints are measured on their own
+    os.environ['CHECKPOINT_INTERVAL'] = os.environ['CHECKPOINT_MAX_CHANGES'] = str(10 ** 9)
+
+    from telegram import Update
+    from telegram.ext import JobQueue
+
+    import bot.__main__ as entrypoint
+    from benchmarks.fakes import FakeBot
+    from bot.db import get_engine
+    from bot.jobs.job_loader import load_reminders
+    from bot.jobs.models import create_tables
+    from bot.persistence.psqlpersistence import PSQLPersistence
+
+    create_tables()
+    start = time.perf_counter()
+    seed(size)
+    seed_s = time.perf_counter() - start
+
+    sql = SqlCounter(get_engine())
+    fake_bot = FakeBot()
+    results = [
+        measure('load_state', lambda i: PSQLPersistence()._load_state_from_db(), bulk_runs, sql),
+        measure('load_reminders', lambda i: load_reminders(fake_bot, JobQueue()), bulk_runs, sql),
+    ]
+
+    updater = entrypoint.create_updater(bot=fake_bot)
+    dispatcher, persistence = updater.dispatcher, updater.persistence
+    # Users are spread over the db, so every run hits a user that has not been cached
+    user_ids = [1 + (i * 7919) % size for i in range(2 * (handler_runs + 1))]
+
+    def quick(i):
+        user_id = user_ids[i]
+        dispatcher.process_update(Update.de_json(command_update(i, user_id, '/q water the plants, 20'), fake_bot))
+
+    def remind(i):
+        user_id = user_ids[handler_runs + 1 + i]
+        dispatcher.process_update(Update.de_json(command_update(i, user_id, '/remind call mom'), fake_bot))
+        dispatcher.process_update(Update.de_json(callback_update(i, user_id, '3600'), fake_bot))
+
+    def touch_users(i):
+        for user_id in range(1, size + 1, 100):
+            persistence.update_user_data(user_id, {'offset': OFFSET, 'run': i})
+
+    results += [
+        measure('/q', quick, handler_runs, sql),
+        measure('/remind', remind, handler_runs, sql),
+        # Checkpoint of 1% of the users, which is what flush writes on shutdown
+        measure('flush', lambda i: persistence.checkpoint(), bulk_runs, sql, setup=touch_users),
+    ]
+    sent = len(fake_bot.sent)
+    assert sent >= 3 * (handler_runs + 1), f'Handlers failed, only {sent} messages were sent'
+
+    print(json.dumps({'size': size, 'seed_s': seed_s, 'operations': results}))
+
+
+def run_child(size, handler_runs, bulk_runs):
+    result = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.suite', CHILD_FLAG, str(size), str(handler_runs), str(bulk_runs)],
+        capture_output=True, text=True, check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('sizes', nargs='*', type=int, default=SIZES, help='users and reminders on the db')
+    parser.add_argument('--output', help='json file to write the results to')
+    parser.add_argument('--handler-runs', type=int, default=200, help='updates sent to each handler')
+    parser.add_argument('--bulk-runs', type=int, default=3, help='runs of loads and flushes')
+    args = parser.parse_args()
+
+    report = {
+        'commit': git_commit(),
+        'started_at': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'runs': [],
+    }
+    print(f"{'size':>8} {'operation':<16} {'ops/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'peak KiB':>10} {'sql/op':>7}")
+    for size in args.sizes:
+        run = run_child(size, args.handler_runs, args.bulk_runs)
+        report['runs'].append(run)
+        for r in run['operations']:
+            print(f"{size:>8} {r['operation']:<16} {r['ops_per_s']:>10.1f} {r['p50_ms']:>9.2f} {r['p99_ms']:>9.2f}"
+                  f" {r['peak_memory_kb']:>10.0f} {r['sql_per_op']:>7.1f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    if CHILD_FLAG in sys.argv:
+        child(*map(int, sys.argv[2:5]))
+    else:
+        main()
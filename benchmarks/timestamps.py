@@ -0,0 +1,59 @@
+"""
+    Compare decoding stored reminder timestamps with dateparser and with bot.timestamps.
+
+    dateparser is too slow to run over every stored reminder, so it runs over a sample and
+    its total is extrapolated.
+    Run with `python -m benchmarks.timestamps [n_reminders] [dateparser_sample]`
+"""
+import logging
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import dateparser
+
+from bot import timestamps
+
+
+def stored_timestamps(n_reminders):
+    """Timestamps as stored by the bot. Popular times like o'clock hours repeat often"""
+    now = datetime.utcnow()
+    return [
+        (now + timedelta(minutes=random.choice((5, 10, 20, 30, 60, 120)))).isoformat()
+        if random.random() < 0.3 else
+        (now + timedelta(seconds=random.randrange(90 * 24 * 3600))).isoformat()
+        for _ in range(n_reminders)
+    ]
+
+
+def per_call(func, values):
+    start = time.perf_counter()
+    for value in values:
+        func(value)
+    return (time.perf_counter() - start) / len(values)
+
+
+def main(n_reminders, dateparser_sample):
+    logging.disable(logging.CRITICAL)
+    values = stored_timestamps(n_reminders)
+    # Non isoformat values repeat a lot, as they come from a handful of old formats
+    legacy_values = [value.replace('T', ' at ')[:19] for value in random.sample(values, 50)] * (n_reminders // 50)
+    # Warm up dateparser language data, it is loaded on first use
+    dateparser.parse(values[0])
+
+    results = [
+        ('dateparser.parse', per_call(dateparser.parse, values[:dateparser_sample])),
+        ('datetime.fromisoformat', per_call(datetime.fromisoformat, values)),
+        ('timestamps.decode', per_call(timestamps.decode, values)),
+        ('timestamps.decode legacy', per_call(timestamps.decode, legacy_values)),
+    ]
+    print(f'Decoding {n_reminders} stored timestamps')
+    print(f"{'decoder':<26} {'per call (us)':>14} {'total (s)':>10}")
+    for name, seconds in results:
+        print(f'{name:<26} {seconds * 1e6:>14.2f} {seconds * n_reminders:>10.3f}')
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [100000, 1000][len(args):]))
@@ -0,0 +1,122 @@
+"""
+    Tracing overhead: time /q updates through the dispatcher under each sentry setting.
+
+    Every setting runs on a fresh interpreter, as sentry is set up once per process.
+    Envelopes go to a transport that drops them, so the network cost of sending is not
+    included, only the cost of recording, sampling and serializing.
+    Run with `python -m benchmarks.tracing [updates]`
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.dispatch import command_update
+
+CHILD_FLAG = '--child'
+FAKE_DSN = 'https://public@sentry.example.com/1'
+
+SETTINGS = {
+    'no sentry': None,
+    'everything 1.0': {'traces_sample_rate': 1.0, 'profiles_sample_rate': 1.0},
+    'policy defaults': {},
+    'policy, rates 0': {'SENTRY_TRACES_RATES': 'default=0', 'SENTRY_PROFILES_RATES': '', 'SENTRY_SLOW_SECONDS': '0'},
+    'policy, slow only': {'SENTRY_TRACES_RATES': 'default=0', 'SENTRY_PROFILES_RATES': '',
+                          'SENTRY_SLOW_SECONDS': '0.000001'},
+    'policy, keep all': {'SENTRY_TRACES_RATES': 'default=1', 'SENTRY_PROFILES_RATES': '',
+                         'SENTRY_TRACES_PER_MINUTE': '1000000'},
+}
+
+
+def child(setting, updates):
+    import logging
+    logging.disable(logging.CRITICAL)
+    os.environ['DATABASE_URL'] = f'sqlite:///{tempfile.mkdtemp()}/tracing.db'
+    os.environ['STATE_JOURNAL_PATH'] = os.devnull
+    os.environ['CONCURRENT_HANDLERS'] = '0'
+    os.environ['SENTRY_DSN'] = FAKE_DSN
+    options = SETTINGS[setting]
+
+    import sentry_sdk
+    from sentry_sdk.transport import Transport
+    from sqlalchemy import text
+    from telegram import Update
+
+    import bot.__main__ as entrypoint
+    from benchmarks.fakes import FakeBot
+    from bot import tracing
+    from bot.db import transaction
+    from bot.jobs.models import create_tables
+
+    class DropTransport(Transport):
+        envelopes = 0
+
+        def capture_envelope(self, envelope):
+            envelope.serialize()
+            DropTransport.envelopes += 1
+
+        def capture_event(self, event):
+            DropTransport.envelopes += 1
+
+    policy = None
+    if options is not None and 'traces_sample_rate' in options:
+        # Like main() used to set it up
+        sentry_sdk.init(dsn=FAKE_DSN, transport=DropTransport, **options)
+    elif options is not None:
+        os.environ.update(options)
+        policy = tracing.init(transport=DropTransport)
+
+    create_tables()
+    with transaction() as conn:
+        conn.execute(text('INSERT INTO user_state (user_id, data) VALUES (:id, :data)'), [
+            {'id': user_id, 'data': json.dumps({'offset': -10800})} for user_id in range(1, updates + 1)
+        ])
+    fake_bot = FakeBot()
+    updater = entrypoint.create_updater(bot=fake_bot)
+    if options is not None:
+        tracing.trace(updater, policy)
+
+    timings = []
+    for user_id in range(1, updates + 1):
+        update = Update.de_json(command_update(user_id, user_id, '/q water the plants, 20'), fake_bot)
+        start = time.perf_counter()
+        updater.dispatcher.process_update(update)
+        timings.append(time.perf_counter() - start)
+    sentry_sdk.flush()
+
+    assert len(fake_bot.sent) == updates, 'Handlers failed'
+    timings.sort()
+    print(json.dumps({
+        'mean_us': sum(timings) / len(timings) * 1e6,
+        'p50_us': timings[len(timings) // 2] * 1e6,
+        'p99_us': timings[int(len(timings) * 0.99)] * 1e6,
+        'sent': DropTransport.envelopes,
+    }))
+
+
+def run_child(setting, updates):
+    result = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.tracing', CHILD_FLAG, setting, str(updates)],
+        capture_output=True, text=True, check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main(updates):
+    print(f'{updates} /q updates per setting')
+    print(f"{'setting':<20} {'mean us':>9} {'p50 us':>9} {'p99 us':>9} {'overhead':>9} {'sent':>6}")
+    baseline = None
+    for setting in SETTINGS:
+        r = run_child(setting, updates)
+        baseline = baseline or r['mean_us']
+        print(f"{setting:<20} {r['mean_us']:>9.0f} {r['p50_us']:>9.0f} {r['p99_us']:>9.0f}"
+              f" {r['mean_us'] - baseline:>+9.0f} {r['sent']:>6}")
+
+
+if __name__ == '__main__':
+    if CHILD_FLAG in sys.argv:
+        child(sys.argv[2], int(sys.argv[3]))
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,83 @@
+"""
+    Webhook harness: POST synthetic updates to the bot's webhook and time them end to end.
+
+    The bot runs against a fake Bot API, with its webhook on localhost. Reports how long the
+    webhook took to acknowledge each update and how long until the handler's reply was sent.
+    Run with `python -m benchmarks.webhook [updates] [concurrency]`
+"""
+import http.client
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.dispatch import command_update
+
+PORT = 8787
+SECRET = 'benchmark-secret'
+
+
+def post_update(update, secret=SECRET):
+    conn = http.client.HTTPConnection('127.0.0.1', PORT, timeout=10)
+    conn.request('POST', '/telegram', body=json.dumps(update), headers={
+        'Content-Type': 'application/json',
+        'X-Telegram-Bot-Api-Secret-Token': secret,
+    })
+    status = conn.getresponse().status
+    conn.close()
+    return status
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000
+
+
+def main(updates, concurrency):
+    logging.disable(logging.CRITICAL)
+    os.environ['DATABASE_URL'] = f'sqlite:///{tempfile.mkdtemp()}/webhook.db'
+    os.environ['STATE_JOURNAL_PATH'] = os.devnull
+    os.environ['WEBHOOK_SECRET'] = SECRET
+
+    import bot.__main__ as entrypoint
+    from benchmarks.fakes import FakeBot
+    from bot.jobs.models import create_tables
+    from bot.webhook import start_webhook
+
+    create_tables()
+    fake_bot = FakeBot()
+    updater = entrypoint.create_updater(bot=fake_bot)
+    start_webhook(updater, PORT, 'https://bot.example.com', listen='127.0.0.1')
+    time.sleep(0.5)
+
+    assert post_update(command_update(0, 1, '/myreminders'), secret='wrong') == 403, 'Secret not checked'
+
+    posted_at, acked = {}, []
+
+    def post(user_id):
+        posted_at[user_id] = time.monotonic()
+        assert post_update(command_update(user_id, user_id, '/myreminders')) == 200
+        acked.append(time.monotonic() - posted_at[user_id])
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(post, range(1, updates + 1)))
+    while len(fake_bot.sent) < updates:
+        time.sleep(0.01)
+    elapsed = time.monotonic() - start
+    threading.Thread(target=updater.stop, daemon=True).start()
+
+    end_to_end = [sent_at - posted_at[int(data['chat_id'])] for sent_at, _, data in fake_bot.sent]
+    print(f'{updates} updates over {concurrency} connections in {elapsed:.2f}s ({updates / elapsed:.0f}/s)')
+    print(f'ack          p50 {percentile(acked, 0.5):>7.1f}ms   p99 {percentile(acked, 0.99):>7.1f}ms')
+    print(f'end to end   p50 {percentile(end_to_end, 0.5):>7.1f}ms   p99 {percentile(end_to_end, 0.99):>7.1f}ms')
+
+
+if __name__ == '__main__':
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    main(updates, concurrency)
@@ -3,12 +3,9 @@
 import logging
 import os
 import sys
-from bot.jobs.models import create_tables
+import time
 
-import sentry_sdk
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
-
-from bot.handlers.todo import add_todo_cmd, show_todos_cmd, mark_as_done_cmd
+STARTUP_TIME = time.perf_counter()
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s [%(funcName)s] %(message)s',
@@ -18,39 +15,36 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 from bot.constants import NORMAL_EXIT, ERROR_EXIT
-from bot.handlers.event import events_set
-from bot.handlers.feedback import add_feedback
-from bot.handlers.misc import start, default, ups_handler
-from bot.handlers.delete import remove_reminders
-from bot.handlers.quick import quick_reminder
-from bot.handlers.repeat import repeat_reminder
-from bot.handlers.remind import reminders_set
-from bot.handlers.mytimezone import change_timezone, check_timezone
-from bot.handlers.myreminders import see_user_reminders
-from bot.jobs.job_loader import load_reminders
-from bot.persistence.psqlpersistence import PSQLPersistence
-
 
-def main():
-    sentry_sdk.init(
-        dsn=os.environ.get('SENTRY_DSN'),
-        traces_sample_rate=1.0,
-        profiles_sample_rate=1.0,
-    )
 
-    bot_persistence = PSQLPersistence(os.environ.get('DATABASE_URL', 'Missing'))
-    updater = Updater(os.environ.get('BOT_KEY', 'Missing'), persistence=bot_persistence, use_context=True)
-    dp = updater.dispatcher
+def register_handlers(dp):
+    # Handlers are imported here so that importing this module stays cheap.
+    # See benchmarks/startup.py
+    from telegram.ext import CommandHandler, MessageHandler, Filters
+
+    from bot.handlers.event import events_set
+    from bot.handlers.feedback import add_feedback
+    from bot.handlers.misc import start, default, ups_handler
+    from bot.handlers.delete import remove_reminders
+    from bot.handlers.quick import quick_reminder
+    from bot.handlers.every import recurring_reminder
+    from bot.handlers.repeat import repeat_reminder, reminder_done
+    from bot.handlers.remind import reminders_set
+    from bot.handlers.mytimezone import change_timezone, check_timezone
+    from bot.handlers.myreminders import see_user_reminders, reminders_page
+    from bot.handlers.todo import add_todo_cmd, show_todos_cmd, mark_as_done_cmd, todos_page
+    from bot.handlers.imports import import_cmd, import_document
+    from bot.handlers.export import export_cmd
 
     start_handler = CommandHandler('start', start)
     fallback_handler = MessageHandler(Filters.all, default)
 
-    # Load reminders that were lost on bot restart (job_queue is not persistent)
-    loaded_reminders = load_reminders(updater.bot, updater.job_queue)
-    logger.info(f"Recovered {loaded_reminders} reminders")
-
     # Add bot handlers
     dp.add_handler(start_handler)
+    # Before the conversations, as they take any button press while waiting for a time selection
+    dp.add_handler(reminders_page)
+    dp.add_handler(todos_page)
+    dp.add_handler(reminder_done)
     dp.add_handler(reminders_set)
     dp.add_handler(repeat_reminder)
     dp.add_handler(remove_reminders)
@@ -59,23 +53,139 @@ def main():
     dp.add_handler(check_timezone)
     dp.add_handler(add_feedback)
     dp.add_handler(quick_reminder)
+    dp.add_handler(recurring_reminder)
     dp.add_handler(events_set)
     dp.add_handler(add_todo_cmd)
     dp.add_handler(show_todos_cmd)
     dp.add_handler(mark_as_done_cmd)
+    dp.add_handler(import_cmd)
+    dp.add_handler(import_document)
+    dp.add_handler(export_cmd)
 
     # Add special handlers. Error handler and fallback handler.
     dp.add_error_handler(ups_handler)
     dp.add_handler(fallback_handler)
 
-    logger.info('Up and running')
+
+def create_updater(bot=None):
+    """Build an updater with persistence, recovered reminders and every handler registered.
+
+    A `bot` can be given to use instead of one built from BOT_KEY. It can be a plain Bot, which
+    sends messages right away instead of through an outbound queue.
+    """
+    from telegram.utils.request import Request
+
+    from bot.outbound import QueuedBot
+    from bot.persistence.psqlpersistence import PSQLPersistence
+    from bot.sharding import SHARD_COUNT, SHARD_INDEX, shard_guard
+    from bot.utils import SCHEDULER
+    from bot.webhook import WebhookUpdater
+
+    # Threads running concurrent handlers. See bot.utils.concurrent
+    workers = int(os.environ.get('BOT_WORKERS', 16))
+    default_journal = f'state.{SHARD_INDEX}.journal' if SHARD_COUNT > 1 else 'state.journal'
+    bot_persistence = PSQLPersistence(journal_path=os.environ.get('STATE_JOURNAL_PATH', default_journal))
+    if bot is None:
+        # Same pool size Updater would use, plus a connection for the outbound queue
+        bot = QueuedBot(os.environ.get('BOT_KEY', 'Missing'), request=Request(con_pool_size=workers + 4 + 1))
+    updater = WebhookUpdater(bot=bot, workers=workers, persistence=bot_persistence, use_context=True)
+
+    # Write state changes to db periodically so a crash does not lose them until next restart
+    bot_persistence.start_checkpointing(
+        interval=int(os.environ.get('CHECKPOINT_INTERVAL', 60)),
+        max_changes=int(os.environ.get('CHECKPOINT_MAX_CHANGES', 100)),
+    )
+
+    if SCHEDULER == 'db':
+        from bot.jobs.scheduler import ReminderScheduler, POLL_INTERVAL
+
+        # Due reminders are polled from the db, possibly alongside other scheduler workers
+        scheduler = ReminderScheduler(updater.bot)
+        updater.job_queue.run_repeating(scheduler.poll, interval=POLL_INTERVAL, first=0)
+    else:
+        from bot.jobs.expiry import expiry_buffer, FLUSH_INTERVAL
+        from bot.jobs.job_loader import load_reminders, top_up_interval, top_up_reminders
+
+        # Fails on a bad horizon before anything is scheduled
+        top_up_every = top_up_interval()
+        # Load reminders that were lost on bot restart (job_queue is not persistent)
+        loaded_reminders = load_reminders(updater.bot, updater.job_queue)
+        logger.info(f"Recovered {loaded_reminders} reminders")
+        # Later reminders are queued as they get close to their due time
+        updater.job_queue.run_repeating(top_up_reminders, interval=top_up_every, first=top_up_every)
+        # Delivered reminders are expired in batches
+        updater.job_queue.run_repeating(expiry_buffer.flush, interval=FLUSH_INTERVAL, first=FLUSH_INTERVAL)
+
+    from bot.jobs.compaction import compact_reminders, COMPACTION_INTERVAL
+
+    # Reminders that expired a while ago are moved to the archive
+    updater.job_queue.run_repeating(compact_reminders, interval=COMPACTION_INTERVAL, first=COMPACTION_INTERVAL)
+
+    if SHARD_COUNT > 1:
+        updater.dispatcher.add_handler(shard_guard, group=-1)
+    register_handlers(updater.dispatcher)
+
+    if os.environ.get('METRICS_PORT'):
+        from bot.metrics import instrument
+        instrument(updater)
+    return updater
+
+
+def start_receiving(updater):
+    """Receive updates on a webhook if WEBHOOK_URL is set. Long poll for them otherwise"""
+    from bot.sharding import SHARD_COUNT
+    from bot.webhook import start_webhook
+
+    port = int(os.environ.get('PORT', 8080))
+    if SHARD_COUNT > 1:
+        # bot.router owns the webhook and forwards this shard its updates
+        start_webhook(updater, port)
+        return
+
+    webhook_url = os.environ.get('WEBHOOK_URL')
+    if webhook_url:
+        from telegram.error import TelegramError
+
+        try:
+            start_webhook(updater, port, webhook_url)
+            return
+        except TelegramError:
+            logger.exception('Could not set webhook. Falling back to polling')
+
+    # Polling deletes the webhook, if any
     updater.start_polling()
+
+
+def main():
+    from bot import tracing
+
+    # Before anything else, so startup errors are reported too
+    policy = tracing.init()
+    updater = create_updater()
+    tracing.trace(updater, policy)
+
+    logger.info('Up and running')
+    start_receiving(updater)
+    logger.info(f'Receiving updates {time.perf_counter() - STARTUP_TIME:.2f}s after startup')
     updater.idle()
+    # Plain bots, like the ones of benchmarks, send right away
+    queue = getattr(updater.bot, 'queue', None)
+    if queue is not None:
+        queue.stop()
+
+    # The job_queue is stopped by now. Finish what the notifications sent meanwhile left, and
+    # expire reminders delivered since its last flush.
+    from bot.jobs.expiry import expiry_buffer
+    from bot.utils import run_follow_ups
+    run_follow_ups(updater.job_queue, updater.dispatcher)
+    expiry_buffer.flush()
 
     return NORMAL_EXIT
 
 
 if __name__ == '__main__':
+    from bot.jobs.models import create_tables
+
     create_tables()
     try:
         sys.exit(main())
@@ -3,4 +3,7 @@ READ_REMINDER, READ_TIME_SELECTION, READ_CUSTOM_DATE = 10, 20, 30
 READ_DELETE = 100
 NORMAL_EXIT = 0
 ERROR_EXIT = -1
-MINUTE = 60
\ No newline at end of file
+MINUTE = 60
+HOUR = 60 * MINUTE
+# Longest time between reminder top-ups. See job_loader.top_up_interval
+TOP_UP_INTERVAL = HOUR
@@ -0,0 +1,119 @@
+"""
+    Single entry point to the database. Every query goes through the pooled engine below.
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+logger = logging.getLogger(__name__)
+
+pool_stats = {
+    'connects': 0,
+    'checkouts': 0,
+    'checkins': 0,
+    'invalidated': 0,
+    'checked_out': 0,
+    'wait_seconds_total': 0.0,
+    'wait_seconds_max': 0.0,
+}
+
+
+def _engine_options(url):
+    if not url.startswith('postgres'):
+        return {}
+
+    return {
+        # Fly proxy drops idle connections. Test them before use instead of recycling them blindly
+        # See https://community.fly.io/t/postgresql-connection-is-closed-error-after-a-few-minutes-of-activity/4768/3
+        'pool_pre_ping': True,
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 5)),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'connect_args': {
+            # Timestamps are read back in UTC, whatever the server timezone is
+            'options': '-c timezone=utc',
+            'keepalives': 1,
+            'keepalives_idle': 60,
+        },
+    }
+
+
+Session = scoped_session(sessionmaker(expire_on_commit=False))
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """Return the engine, creating it from DATABASE_URL on first use.
+
+    Creating it lazily lets modules be imported without a db, and keeps connecting
+    to it off the import path.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            url = os.environ['DATABASE_URL']
+            _engine = create_engine(url, **_engine_options(url))
+            event.listen(_engine, 'connect', _on_connect)
+            event.listen(_engine, 'checkout', _on_checkout)
+            event.listen(_engine, 'checkin', _on_checkin)
+            event.listen(_engine, 'invalidate', _on_invalidate)
+            Session.configure(bind=_engine)
+    return _engine
+
+
+def _on_connect(dbapi_connection, connection_record):
+    pool_stats['connects'] += 1
+
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    pool_stats['checkouts'] += 1
+    pool_stats['checked_out'] += 1
+
+
+def _on_checkin(dbapi_connection, connection_record):
+    pool_stats['checkins'] += 1
+    pool_stats['checked_out'] -= 1
+
+
+def _on_invalidate(dbapi_connection, connection_record, exception):
+    pool_stats['invalidated'] += 1
+
+
+def _timed_checkout(checkout):
+    """Run `checkout` recording how long it waited for a pooled connection"""
+    start = time.perf_counter()
+    connection = checkout()
+    waited = time.perf_counter() - start
+    pool_stats['wait_seconds_total'] += waited
+    pool_stats['wait_seconds_max'] = max(pool_stats['wait_seconds_max'], waited)
+    return connection
+
+
+@contextmanager
+def session_scope():
+    """Provide a transactional ORM session that is committed and returned to the pool on exit"""
+    get_engine()
+    session = Session()
+    try:
+        _timed_checkout(session.connection)
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        Session.remove()
+
+
+@contextmanager
+def transaction():
+    """Provide a core connection inside a transaction, for raw sql statements"""
+    with _timed_checkout(get_engine().connect) as conn:
+        with conn.begin():
+            yield conn
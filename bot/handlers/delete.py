@@ -8,10 +8,12 @@ from telegram.ext import ConversationHandler, CommandHandler, MessageHandler, Fi
 from bot.constants import READ_DELETE
 from bot.handlers.misc import cancel
 from bot.jobs.db_ops import remove_reminder
+from bot.utils import concurrent
 
 logger = logging.getLogger(__name__)
 
 
+@concurrent
 def rm_reminder(update, context):
     logger.info("STARTED new reminder removal")
     if not context.args:
@@ -23,6 +25,7 @@ def rm_reminder(update, context):
     return _delete_reminder(update, reminder_key)
 
 
+@concurrent
 def rm_reminder_from_text(update, context):
     reminder_key = update.message.text
     return _delete_reminder(update, reminder_key)
@@ -31,7 +34,7 @@ def rm_reminder_from_text(update, context):
 def _delete_reminder(update, reminder_key):
     msg = remove_reminder(
         text=reminder_key,
-        user_id=str(update.message.from_user.id),
+        user_id=update.message.from_user.id,
     )
     update.message.reply_text(msg, parse_mode='markdown')
 
@@ -0,0 +1,53 @@
+"""
+    Handler that sets up recurring reminders
+"""
+import logging
+from datetime import datetime, timezone
+
+from telegram.ext import CommandHandler
+
+from bot.recurrence import InvalidRule, parse_rule, next_occurrence
+from bot.utils import concurrent, init_reminder_context, _setup_reminder_and_reply
+
+logger = logging.getLogger(__name__)
+
+USAGE = ("Mmm not like that\n"
+         "/every water the plants, 2d\n"
+         "/every standup, weekdays 9:30\n"
+         "/every pay rent, cron 0 10 1 * *")
+
+
+@concurrent
+def set_recurring(update, context):
+    user_offset = context.user_data.get('offset')
+    msg = update.message
+
+    if user_offset is None:
+        msg.reply_text('Please first set your current time with /setmytime')
+        return
+
+    to_remind, sep, rule_text = ' '.join(context.args).rpartition(',')
+    if not to_remind.strip():
+        msg.reply_text(USAGE)
+        return
+    try:
+        rule = parse_rule(rule_text)
+    except InvalidRule as e:
+        msg.reply_text(f'{e}\n\n{USAGE}')
+        return
+
+    now = datetime.now(timezone.utc)
+    when = next_occurrence(rule, now, user_offset, now).replace(tzinfo=None)
+    job_context = init_reminder_context(
+        to_remind.strip(), msg.from_user, msg.chat_id, user_offset,
+        remind_date_iso=when.isoformat(), recurrence=rule,
+    )
+    logger.info(f'Setting up a new recurring reminder {rule!r}')
+    try:
+        _setup_reminder_and_reply(update, context.job_queue, job_context, when)
+    except Exception:
+        logger.exception('Error writing reminder')
+        msg.reply_text("I'm not perfect ¯\\_(ツ)_/¯")
+
+
+recurring_reminder = CommandHandler('every', set_recurring)
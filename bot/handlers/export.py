@@ -0,0 +1,65 @@
+"""
+    Handler that sends users all their reminders as a .csv or .ics file
+"""
+import logging
+import tempfile
+import time
+from datetime import datetime
+
+from telegram.ext import CommandHandler
+
+from bot.jobs.db_ops import iter_user_reminders
+from bot.reminder_files import CSV, ICS, write_csv, write_ics
+from bot.utils import concurrent
+
+logger = logging.getLogger(__name__)
+
+# Exports bigger than this are spooled to disk while they are written
+SPOOL_BYTES = 1024 * 1024
+# Bots can't send bigger documents
+MAX_DOCUMENT_BYTES = 50 * 1024 * 1024
+USAGE = 'Mmm not like that\n/export to get your reminders as a csv file\n/export ics to get them as a calendar'
+
+
+@concurrent
+def export_reminders(update, context):
+    msg = update.message
+    kind = context.args[0].lower().lstrip('.') if context.args else CSV
+    if kind not in (CSV, ICS):
+        msg.reply_text(USAGE)
+        return
+
+    start = time.perf_counter()
+    exported = 0
+
+    def counted(reminders):
+        nonlocal exported
+        for reminder in reminders:
+            exported += 1
+            yield reminder
+
+    reminders = counted(iter_user_reminders(msg.from_user.id))
+    if kind == CSV:
+        chunks = write_csv(reminders, context.user_data.get('offset', 0))
+    else:
+        chunks = write_ics(reminders, datetime.utcnow())
+
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES) as buffer:
+        # Rows are streamed from the db into the buffer, which is done with the db before uploading
+        for chunk in chunks:
+            buffer.write(chunk.encode())
+        size = buffer.tell()
+        logger.info(f'Exported {exported} reminders of {msg.from_user.name} as {kind},'
+                    f' {size} bytes in {time.perf_counter() - start:.3f}s')
+
+        if not exported:
+            msg.reply_text('No reminders set yet')
+            return
+        if size > MAX_DOCUMENT_BYTES:
+            msg.reply_text('🚫 You have too many reminders to send them in a file')
+            return
+        buffer.seek(0)
+        msg.reply_document(document=buffer, filename=f'reminders.{kind}', caption=f'📤 {exported} reminders')
+
+
+export_cmd = CommandHandler('export', export_reminders)
@@ -0,0 +1,150 @@
+"""
+    Handler that imports reminders from .ics and .csv files sent to the bot
+"""
+import io
+import logging
+import os
+import tempfile
+import time
+from datetime import datetime
+
+from telegram.ext import BaseFilter, CommandHandler, MessageHandler, Filters
+
+from bot.jobs.db_ops import add_reminders
+from bot.reminder_files import file_kind, read_entries
+from bot.utils import (
+    REMINDER_HORIZON, SCHEDULER, concurrent, init_reminder_context, reminder_columns, reminder_key,
+    send_notification, utc_time_from_user_date,
+)
+
+logger = logging.getLogger(__name__)
+
+# Rows per INSERT. Each row is about ten bind parameters, and sqlite takes up to 32766
+BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 1000))
+# Bots can't download bigger files
+MAX_FILE_BYTES = 20 * 1024 * 1024
+# Downloads bigger than this are spooled to disk
+SPOOL_BYTES = 1024 * 1024
+MAX_REPORTED_ERRORS = 5
+
+USAGE = ("Send me a .ics calendar or a .csv file in a private chat and I will remind you of everything in it.\n\n"
+         "CSV files need a text and a date column, in your time:\n"
+         "text,date\n"
+         "call mom,2024-05-01 18:30\n"
+         "pay rent,01/06/2024 10:00\n\n"
+         "An optional recurrence column takes /every rules, like weekdays 9:30")
+
+
+def import_help(update, context):
+    update.message.reply_text(USAGE)
+
+
+def to_utc(when, offset):
+    """Naive utc datetime of an entry date. Naive dates are in the user's time"""
+    if when.tzinfo is not None:
+        return datetime.utcfromtimestamp(when.timestamp())
+    return utc_time_from_user_date(when, offset)
+
+
+def import_reminders(entries, base_context, job_queue):
+    """Save the reminders of entries in batches. Reminders due within the horizon are queued.
+
+    Reminders already saved, like the ones of a file imported twice, are skipped. Returns
+    counts of what happened to the entries, and the first errors found.
+    """
+    start = time.perf_counter()
+    now = datetime.utcnow()
+    stats = {'imported': 0, 'queued': 0, 'duplicated': 0, 'past': 0, 'invalid': 0}
+    errors, batch = [], {}
+
+    for entry in entries:
+        if entry.error is not None:
+            stats['invalid'] += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append(f'Line {entry.line}: {entry.error}')
+            continue
+        when = to_utc(entry.when, base_context['offset'])
+        if when <= now:
+            stats['past'] += 1
+            continue
+
+        job_context = {**base_context, 'thing_to_remind': entry.text, 'remind_date_iso': when.isoformat()}
+        if entry.recurrence:
+            job_context['recurrence'] = entry.recurrence
+        batch[reminder_key(job_context)] = job_context
+        if len(batch) >= BATCH_SIZE:
+            _save_batch(batch, job_queue, now, stats)
+            batch = {}
+    if batch:
+        _save_batch(batch, job_queue, now, stats)
+
+    logger.info(f'Imported {stats} for user {base_context["user_id"]} in {time.perf_counter() - start:.3f}s')
+    return stats, errors
+
+
+def _save_batch(batch, job_queue, now, stats):
+    saved = add_reminders([reminder_columns(job_context) for job_context in batch.values()])
+    stats['imported'] += len(saved)
+    stats['duplicated'] += len(batch) - len(saved)
+    if SCHEDULER != 'jobqueue':
+        return
+
+    horizon = now + REMINDER_HORIZON
+    for key, reminder_id in saved.items():
+        job_context = batch[key]
+        when = datetime.fromisoformat(job_context['remind_date_iso'])
+        if when <= horizon:
+            job_queue.run_once(send_notification, when, context={**job_context, 'reminder_id': reminder_id}, name=key)
+            stats['queued'] += 1
+
+
+def summary(stats, errors):
+    text = f"✅ Imported {stats['imported']} reminders"
+    skipped = [
+        f'{stats[reason]} {label}' for reason, label in
+        (('duplicated', 'already saved'), ('past', 'in the past'), ('invalid', 'not understood')) if stats[reason]
+    ]
+    if skipped:
+        text += f"\nSkipped {', '.join(skipped)}"
+    if errors:
+        text += '\n\n' + '\n'.join(errors)
+    return text
+
+
+@concurrent
+def import_file(update, context):
+    user_offset = context.user_data.get('offset')
+    msg = update.message
+
+    if user_offset is None:
+        msg.reply_text('Please first set your current time with /setmytime')
+        return
+    document = msg.document
+    kind = file_kind(document.file_name)
+    if document.file_size and document.file_size > MAX_FILE_BYTES:
+        msg.reply_text('🚫 The file is too big. Split it in files of up to 20MB')
+        return
+
+    base_context = init_reminder_context(None, msg.from_user, msg.chat_id, user_offset)
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES) as buffer:
+        context.bot.get_file(document.file_id).download(out=buffer)
+        buffer.seek(0)
+        with io.TextIOWrapper(buffer, encoding='utf-8-sig', errors='replace', newline='') as lines:
+            stats, errors = import_reminders(read_entries(kind, lines), base_context, context.job_queue)
+
+    msg.reply_text(summary(stats, errors))
+
+
+class _ReminderFile(BaseFilter):
+    """Documents that are .csv or .ics files"""
+    name = 'reminder_file'
+
+    def filter(self, message):
+        return message.document is not None and file_kind(message.document.file_name) is not None
+
+
+reminder_file = _ReminderFile()
+
+import_cmd = CommandHandler('import', import_help)
+# Files sent to groups are meant for their members, not for the bot
+import_document = MessageHandler(Filters.private & reminder_file, import_file)
@@ -28,6 +28,13 @@ I also have a quick reminder shortcut:
 /q something, 20
 that will let you set a reminder of _something_ in 20 minutes in just one message
 
+And repeating ones:
+/every something, weekdays 9:00
+that will remind you of _something_ every weekday at 9:00 until you /delete it
+
+To bring your calendar over, send me its .ics or .csv file. See /import
+And /export gives you all your reminders in one
+
 If you have any feedback you can send it via /feedback
 """, parse_mode='markdown')
 
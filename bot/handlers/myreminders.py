@@ -1,37 +1,100 @@
 """
-    Handler that shows the reminders of a given user
+    Handler that shows the reminders of a given user, a page at a time
 """
 
 import logging
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone
 
-from telegram.ext import CommandHandler
+from telegram import InlineKeyboardMarkup, InlineKeyboardButton as Button
+from telegram.ext import CommandHandler, CallbackQueryHandler
 
-from bot.jobs.db_ops import get_reminders
-from bot.utils import isoformat_to_datetime
+from bot.jobs.db_ops import get_reminders_page
+from bot.recurrence import describe
+from bot.utils import concurrent, user_time_from_utc
 
 logger = logging.getLogger(__name__)
 
+PAGE_SIZE = 10
+# Keeps a page well under the 4096 characters of a message
+MAX_TEXT_LENGTH = 200
+PAGE_PREFIX = 'rp'
+NEXT, PREVIOUS = 'n', 'p'
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
 
-def show_user_reminders(update, context):
-    user = update.message.from_user
-    logger.info(f"Showing user reminders to {user.name}")
-    reminders = get_reminders(user_id=str(user.id), expired=False, order_attr='remind_time')
+
+def _encode_position(reminder):
+    """(remind_time, id) of a reminder as a compact string, to fit in callback data"""
+    remind_time = reminder.remind_time
+    if remind_time.tzinfo is None:
+        remind_time = remind_time.replace(tzinfo=timezone.utc)
+    return f'{(remind_time - EPOCH) // timedelta(microseconds=1)}:{reminder.id}'
+
+
+def _decode_position(position):
+    micros, reminder_id = position.split(':')
+    return EPOCH + timedelta(microseconds=int(micros)), int(reminder_id)
+
+
+def _page_button(label, direction, user_id, reminder):
+    return Button(label, callback_data=f'{PAGE_PREFIX}|{direction}|{user_id}|{_encode_position(reminder)}')
+
+
+def render_page(user_id, offset, direction=None, position=None):
+    """Text and navigation buttons of the reminders page next to or before position"""
+    if direction == PREVIOUS:
+        reminders, more = get_reminders_page(user_id, PAGE_SIZE, before=position)
+        has_previous, has_next = more, True
+    else:
+        reminders, more = get_reminders_page(user_id, PAGE_SIZE, after=position)
+        has_previous, has_next = position is not None, more
+
+    if not reminders and position is not None:
+        # Reminders were deleted since the page was shown
+        return render_page(user_id, offset)
 
     def format_reminder(rem, offset):
         width = 10
-        datetime_obj = isoformat_to_datetime(rem.remind_time)
-        user_date = datetime_obj + timedelta(seconds=offset)
+        user_date = user_time_from_utc(rem.remind_time, offset)
         date_text = user_date.strftime('%d/%m/%Y %H:%M')
-        return f"{rem.text:{width}} | `{date_text}`"
+        text = rem.text if len(rem.text) <= MAX_TEXT_LENGTH else f'{rem.text[:MAX_TEXT_LENGTH]}…'
+        if rem.recurrence:
+            # remind_time of recurring reminders is already their next occurrence
+            date_text = f'{date_text}` 🔁 `{describe(rem.recurrence)}'
+        return f"{text:{width}} | `{date_text}`"
 
+    text = '\n'.join(format_reminder(rem, offset) for rem in reminders)
+    buttons = []
+    if has_previous:
+        buttons.append(_page_button('⬅️ Previous', PREVIOUS, user_id, reminders[0]))
+    if has_next:
+        buttons.append(_page_button('Next ➡️', NEXT, user_id, reminders[-1]))
+
+    return text or 'No reminders set yet', InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+@concurrent
+def show_user_reminders(update, context):
+    user = update.message.from_user
+    logger.info(f"Showing user reminders to {user.name}")
     offset = context.user_data.get('offset', 0)
-    logger.info(f"Formatting reminders with offset {offset}..")
-    text = '\n'.join(
-        format_reminder(rem, offset) for rem in reminders
-    )
-    update.message.reply_text(text or 'No reminders set yet', parse_mode='markdown')
+    text, buttons = render_page(user.id, offset)
+    update.message.reply_text(text, reply_markup=buttons, parse_mode='markdown')
     logger.info('Reminders shown')
 
 
+@concurrent
+def turn_page(update, context):
+    query = update.callback_query
+    _, direction, user_id, position = query.data.split('|')
+    if int(user_id) != query.from_user.id:
+        query.answer('These are not your reminders. Use /myreminders')
+        return
+
+    query.answer()
+    offset = context.user_data.get('offset', 0)
+    text, buttons = render_page(int(user_id), offset, direction, _decode_position(position))
+    query.edit_message_text(text, reply_markup=buttons, parse_mode='markdown')
+
+
 see_user_reminders = CommandHandler('myreminders', show_user_reminders)
+reminders_page = CallbackQueryHandler(turn_page, pattern=rf'^{PAGE_PREFIX}\|')
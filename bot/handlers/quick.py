@@ -3,15 +3,16 @@ import logging
 from telegram.ext import CommandHandler
 
 from bot.constants import MINUTE
-from bot.utils import datetime_from_answer, init_reminder_context, _setup_reminder_and_reply
+from bot.utils import concurrent, datetime_from_answer, init_reminder_context, _setup_reminder_and_reply
 
 logger = logging.getLogger(__name__)
 
+@concurrent
 def quicky(update, context):
     user_offset = context.user_data.get('offset')
     msg = update.message
 
-    if not user_offset:
+    if user_offset is None:
         msg.reply_text('Please first set your current time with /setmytime')
         return
     if not context.args:
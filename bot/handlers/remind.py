@@ -4,13 +4,14 @@
 import copy
 import logging
 
-import dateparser
 from telegram.ext import ConversationHandler, CommandHandler, MessageHandler, CallbackQueryHandler, Filters
 
 from bot.constants import READ_REMINDER, READ_TIME_SELECTION, READ_CUSTOM_DATE, CUSTOM, MINUTE
 from bot.handlers.misc import cancel
+from bot.timestamps import parse_user_date
 from bot.utils import (
     init_reminder_context,
+    reminder_draft,
     datetime_from_answer,
     _show_time_options,
     _setup_reminder_and_reply,
@@ -20,12 +21,15 @@ from bot.utils import (
 
 logger = logging.getLogger(__name__)
 
+# Seconds of a time option button, or CUSTOM
+TIME_OPTION_PATTERN = r'^-?\d+$'
+
 
 def remind(update, context):
     """Initialize reminder context and ask for reminder if it isn't yet known"""
     logger.info('STARTED new /remind conversation')
     user_offset = context.user_data.get('offset')
-    if not user_offset:
+    if user_offset is None:
         update.message.reply_text('Please first set your current time with /setmytime')
         return ConversationHandler.END
     if not context.args:
@@ -39,7 +43,7 @@ def remind(update, context):
     logger.info(f'Reminder args: {thing_to_remind}')
 
     reminder_context = init_reminder_context(thing_to_remind, msg.from_user, msg.chat_id, user_offset)
-    context.chat_data.update(reminder_context)
+    reminder_draft(context, msg.chat_id).update(reminder_context)
     logger.info(f"Read '{thing_to_remind}' from {reminder_context['user_tag']}."
                 f" Offering time options..")
 
@@ -55,7 +59,7 @@ def read_reminder(update, context):
         logger.info(f'Read user input: {msg.text}')
         user_offset = context.user_data.get('offset', 0)
         reminder_context = init_reminder_context(msg.text, msg.from_user, msg.chat_id, user_offset)
-        context.chat_data.update(reminder_context)
+        reminder_draft(context, msg.chat_id).update(reminder_context)
         logger.info('Showing time options..')
         _show_time_options(update)
 
@@ -68,11 +72,11 @@ def read_reminder(update, context):
 
 
 def read_time_selection_from_button(update, context):
-    chat_data = context.chat_data
+    draft = reminder_draft(context, update.effective_chat.id)
     job_queue = context.job_queue
 
-    if not chat_data:
-        logger.error(f"No chat data/user_data available to set reminder. Chat: {chat_data}. Update: {update.to_dict()}")
+    if not draft:
+        logger.error(f"No reminder draft available to set reminder. Update: {update.to_dict()}")
         update.callback_query.message.reply_text("I'm sorry, I forgot who you are! let's try again ")
         return ConversationHandler.END
 
@@ -105,8 +109,8 @@ def read_time_selection_from_button(update, context):
     # Get datetime from requested_delay seconds
     when = datetime_from_answer(requested_delay)
     logger.info("Setting up new reminder from callback selection")
-    chat_data.update({'remind_date_iso': when.isoformat()})
-    job_context = copy.deepcopy(chat_data)
+    draft.update({'remind_date_iso': when.isoformat()})
+    job_context = copy.deepcopy(draft)
 
     _setup_reminder_and_reply(update, job_queue, job_context, when, from_callback=True)
 
@@ -116,7 +120,7 @@ def read_time_selection_from_button(update, context):
 
 def read_custom_date(update, context):
     """Parse offseted date from user and save a job in utc time. Show reminder details localized"""
-    chat_data = context.chat_data
+    draft = reminder_draft(context, update.effective_chat.id)
     job_queue = context.job_queue
     user_data = context.user_data
     user_date = update.message.text
@@ -124,7 +128,7 @@ def read_custom_date(update, context):
     user_offset = user_data.get('offset', 0)
     logger.info(f'User input date: {user_date}. Attempting parsing with offset: {user_offset}')
 
-    date = dateparser.parse(
+    date = parse_user_date(
         update.message.text,
         settings={'PREFER_DATES_FROM': 'future',
                   'RELATIVE_BASE': user_current_time(user_offset)}
@@ -140,8 +144,8 @@ def read_custom_date(update, context):
     logger.info(f"Parsed local {date} into  UTC {utc_date}")
     logger.info("Setting up new reminder from custom date")
 
-    chat_data.update({'remind_date_iso': utc_date.isoformat()})
-    job_context = copy.deepcopy(chat_data)
+    draft.update({'remind_date_iso': utc_date.isoformat()})
+    job_context = copy.deepcopy(draft)
 
     _setup_reminder_and_reply(update, job_queue, job_context, utc_date)
 
@@ -160,7 +164,7 @@ reminders_set = ConversationHandler(
         ],
         READ_TIME_SELECTION: [
             # Wait for user input on when s/he wants to be reminded
-            CallbackQueryHandler(read_time_selection_from_button)
+            CallbackQueryHandler(read_time_selection_from_button, pattern=TIME_OPTION_PATTERN)
         ],
         READ_CUSTOM_DATE: [
             # If user selected Custom option, wait until it writes a date as remind time
@@ -8,15 +8,69 @@ from telegram.ext import ConversationHandler, CallbackQueryHandler, MessageHandl
 
 from bot.constants import READ_TIME_SELECTION, READ_CUSTOM_DATE
 from bot.handlers.misc import cancel
-from bot.keyboard import DONE, REMIND_AGAIN
-from bot.jobs.db_ops import remove_reminder, get_reminders
-from bot.handlers.remind import read_custom_date, read_time_selection_from_button
-from bot.utils import msg_admin, init_reminder_context, _show_time_options, get_reminder_key_from_text
+from bot.keyboard import DONE, REMIND_AGAIN, DONE_PREFIX, REMIND_AGAIN_PREFIX
+from bot.jobs.db_ops import remove_reminder, get_reminders, get_reminder, delete_reminder
+from bot.handlers.remind import read_custom_date, read_time_selection_from_button, TIME_OPTION_PATTERN
+from bot.utils import msg_admin, init_reminder_context, reminder_draft, _show_time_options, get_reminder_key_from_text
 
 logger = logging.getLogger(__name__)
 
 
+def _congratulate(cbackquery):
+    CONGRATZ_ICON = random.choice('🥇🏆🏅🎖')
+    cbackquery.message.edit_text(
+        f'Well done! {CONGRATZ_ICON}',
+        reply_markup=None
+    )
+
+
+def _offer_time_options(update, context, reminder_text):
+    cbackquery = update.callback_query
+    reminder_context = init_reminder_context(
+        reminder_text,
+        cbackquery.from_user,
+        cbackquery.from_user.id,
+        context.user_data.get('offset', 0)
+    )
+    reminder_draft(context, update.effective_chat.id).update(reminder_context)
+
+    logger.info("Showing time options..")
+    _show_time_options(update, from_remind_again=True)
+
+    return READ_TIME_SELECTION
+
+
+def _reminder_id(cbackquery):
+    return int(cbackquery.data.split(':')[1])
+
+
+def mark_done(update, context):
+    """Delete the reminder whose Done button was pressed"""
+    cbackquery = update.callback_query
+    reminder_id = _reminder_id(cbackquery)
+    _congratulate(cbackquery)
+    try:
+        delete_reminder(reminder_id, cbackquery.from_user.id)
+    except Exception:
+        logger.exception(f'Error deleting reminder {reminder_id}')
+        msg_admin(context.bot, f"Error deleting reminder {reminder_id} from {cbackquery.from_user.name}")
+
+
+def remind_again(update, context):
+    """Offer time options to repeat the reminder whose Remind again button was pressed"""
+    logger.info("STARTED new repeat conversation")
+    cbackquery = update.callback_query
+    reminder = get_reminder(_reminder_id(cbackquery), cbackquery.from_user.id)
+    if reminder is None:
+        cbackquery.message.edit_text('👻! Try again', reply_markup=None)
+        logger.error('Conversation ended, reminder not found.')
+        return ConversationHandler.END
+
+    return _offer_time_options(update, context, reminder.text)
+
+
 def handle_repeat_decision(update, context):
+    """Done or Remind again on notifications sent before buttons carried the reminder id"""
     # Get reminder key (user_id, text, date)
     logger.info("STARTED new repeat decision conversation")
     cbackquery = update.callback_query
@@ -27,13 +81,9 @@ def handle_repeat_decision(update, context):
     logger.info(f"Reminder key: {reminder_key!r}")
 
     if answer == DONE:
-        CONGRATZ_ICON = random.choice('🥇🏆🏅🎖')
-        update.callback_query.message.edit_text(
-            f'Well done! {CONGRATZ_ICON}',
-            reply_markup=None
-        )
+        _congratulate(cbackquery)
         try:
-            remove_reminder(text=reminder_key, user_id=str(cbackquery.from_user.id))
+            remove_reminder(text=reminder_key, user_id=cbackquery.from_user.id)
         except Exception:
             msg_admin(context.bot,f"Error deleting reminder {reminder_key} from {cbackquery.from_user.name}")
 
@@ -44,9 +94,9 @@ def handle_repeat_decision(update, context):
         # Fetch reminder from db
         try:
             reminders = get_reminders(
-                user_id=str(cbackquery.from_user.id),
+                user_id=cbackquery.from_user.id,
                 text=reminder_key,
-            ).all()
+            )
         except Exception:
             logger.error('Reminder not found. %s', reminder_key)
             cbackquery.message.edit_text(
@@ -63,18 +113,7 @@ def handle_repeat_decision(update, context):
 
         reminder = reminders[0]
         logger.info(f"Reminder to repeat {reminder}")
-        reminder_context = init_reminder_context(
-            reminder.text,
-            cbackquery.from_user,
-            cbackquery.from_user.id,
-            context.user_data.get('offset', 0)
-        )
-        context.chat_data.update(reminder_context)
-
-        logger.info("Showing time options..")
-        _show_time_options(update, from_remind_again=True)
-
-        return READ_TIME_SELECTION
+        return _offer_time_options(update, context, reminder.text)
     else:
         logger.error(f"Unexpected callback data {answer}")
         cbackquery.message.edit_text(
@@ -87,6 +126,7 @@ def handle_repeat_decision(update, context):
 
 repeat_reminder = ConversationHandler(
     entry_points=[
+        CallbackQueryHandler(remind_again, pattern=rf'^{REMIND_AGAIN_PREFIX}:\d+$'),
         # Capture if the user is Done with the reminder, or wants to repeat it
         CallbackQueryHandler(handle_repeat_decision)],
     states={
@@ -94,6 +134,7 @@ repeat_reminder = ConversationHandler(
             # Wait for user input on when s/he wants to be reminded
             CallbackQueryHandler(
                 read_time_selection_from_button,
+                pattern=TIME_OPTION_PATTERN,
             )
         ],
         READ_CUSTOM_DATE: [
@@ -104,4 +145,7 @@ repeat_reminder = ConversationHandler(
     fallbacks=[CommandHandler('cancel', cancel)],
     name='Repeat reminder',
     persistent=True
-)
\ No newline at end of file
+)
+
+# A single delete by id. Doesn't need a conversation
+reminder_done = CallbackQueryHandler(mark_done, pattern=rf'^{DONE_PREFIX}:\d+$')
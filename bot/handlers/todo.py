@@ -1,8 +1,36 @@
-from telegram.ext import CommandHandler
+import re
 
-from bot.jobs.models import Session, Todo
+from telegram import InlineKeyboardMarkup, InlineKeyboardButton as Button
+from telegram.ext import CommandHandler, CallbackQueryHandler
 
+from bot.db import session_scope
+from bot.jobs.db_ops import get_todos_page, complete_todos
+from bot.jobs.models import Todo
+from bot.utils import concurrent
 
+PAGE_SIZE = 20
+PAGE_PREFIX = 'tp'
+NEXT, PREVIOUS = 'n', 'p'
+# Ranges a single /mark_todo_as_done takes, as each one is a condition of the UPDATE
+MAX_RANGES = 50
+ID_RANGE = re.compile(r'(\d+)(?:-(\d+))?')
+
+
+def parse_id_ranges(text):
+    """'1-5,8' into [(1, 5), (8, 8)]. Raises ValueError if it is not a list of ids and ranges"""
+    id_ranges = []
+    for part in filter(None, (part.strip() for part in text.split(','))):
+        match = ID_RANGE.fullmatch(part)
+        if match is None:
+            raise ValueError(part)
+        first, last = int(match.group(1)), int(match.group(2) or match.group(1))
+        id_ranges.append((min(first, last), max(first, last)))
+    if not id_ranges or len(id_ranges) > MAX_RANGES:
+        raise ValueError(text)
+    return id_ranges
+
+
+@concurrent
 def add_todo(update, context):
     todo_text = context.args
     if not todo_text:
@@ -10,9 +38,9 @@ def add_todo(update, context):
     else:
         try:
             todo = ' '.join(todo_text)
-            session = Session()
-            session.add(Todo(text=todo))
-            session.commit()
+            message = update.effective_message
+            with session_scope() as session:
+                session.add(Todo(text=todo, user_id=message.from_user.id, chat_id=message.chat_id))
             msg = '✅ Saved'
         except Exception as e:
             msg = f'Error: {repr(e)}'
@@ -20,39 +48,76 @@ def add_todo(update, context):
     update.effective_message.reply_markdown(msg)
 
 
+def _page_button(label, direction, user_id, done, todo):
+    return Button(label, callback_data=f'{PAGE_PREFIX}|{direction}|{user_id}|{int(done)}|{todo.id}')
+
+
+def render_page(user_id, chat_id, done, direction=None, position=None):
+    """Text and navigation buttons of the todos page next to or before the todo id position"""
+    if direction == PREVIOUS:
+        todos, more = get_todos_page(user_id, chat_id, done, PAGE_SIZE, before=position)
+        has_previous, has_next = more, True
+    else:
+        todos, more = get_todos_page(user_id, chat_id, done, PAGE_SIZE, after=position)
+        has_previous, has_next = position is not None, more
+
+    if not todos and position is not None:
+        # Todos were completed since the page was shown
+        return render_page(user_id, chat_id, done)
+
+    buttons = []
+    if has_previous:
+        buttons.append(_page_button('⬅️ Previous', PREVIOUS, user_id, done, todos[0]))
+    if has_next:
+        buttons.append(_page_button('Next ➡️', NEXT, user_id, done, todos[-1]))
+
+    text = '\n'.join(f"{todo.id}: {todo.text}" for todo in todos)
+    return text or 'No pending todos', InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+@concurrent
 def show_todos(update, context):
     text = context.args
-    session = Session()
 
     include_done_tasks = '--all' in ' '.join(text)
-    todos = session.query(Todo).filter_by(done=include_done_tasks).all()
-    if not todos:
-        msg = 'No pending todos'
-    else:
-        msg = '\n'.join(f"{todo.id}: {todo.text}" for todo in todos)
+    message = update.effective_message
+    msg, buttons = render_page(message.from_user.id, message.chat_id, include_done_tasks)
+    message.reply_text(msg, reply_markup=buttons)
 
-    update.effective_message.reply_text(msg)
 
+@concurrent
+def turn_page(update, context):
+    query = update.callback_query
+    _, direction, user_id, done, position = query.data.split('|')
+    if int(user_id) != query.from_user.id:
+        query.answer('These are not your todos. Use /todos')
+        return
+
+    query.answer()
+    msg, buttons = render_page(int(user_id), query.message.chat_id, bool(int(done)), direction, int(position))
+    query.edit_message_text(msg, reply_markup=buttons)
 
+
+@concurrent
 def mark_as_done(update, context):
     todo = context.args
     if not todo:
-        update.message.reply_text('Missing todo id')
+        update.message.reply_text('Missing todo id. i.e `/mark_todo_as_done 1-5,8`')
         return
     try:
-        todo_id = int(todo[0])
+        id_ranges = parse_id_ranges(''.join(todo))
     except ValueError:
-        update.message.reply_text('Todo id must be a digit')
+        update.message.reply_text(f'Todo ids must be digits or ranges, up to {MAX_RANGES}. i.e 1-5,8')
         return
 
-    s = Session()
-    todo = s.query(Todo).filter_by(id=todo_id, done=False).first()
-    if todo is None:
-        msg = f'🚫 No pending todo with id `{todo_id}`'
+    message = update.effective_message
+    completed = complete_todos(message.from_user.id, message.chat_id, id_ranges)
+    if not completed:
+        msg = f'🚫 No pending todo with id `{"".join(todo)}`'
+    elif completed == 1:
+        msg = "✅ Congratz. You've finished one todo"
     else:
-        todo.done = True
-        s.commit()
-        msg = f"✅ Congratz. You've finished one todo"
+        msg = f"✅ Congratz. You've finished {completed} todos"
 
     update.effective_message.reply_markdown(msg)
 
@@ -60,4 +125,4 @@ def mark_as_done(update, context):
 add_todo_cmd = CommandHandler('todo', add_todo)
 show_todos_cmd = CommandHandler('todos', show_todos)
 mark_as_done_cmd = CommandHandler('mark_todo_as_done', mark_as_done)
-
+todos_page = CallbackQueryHandler(turn_page, pattern=rf'^{PAGE_PREFIX}\|')
@@ -0,0 +1,183 @@
+"""
+    Compaction of expired reminders.
+
+    Delivered reminders are only flagged as expired, so without compaction they would stay
+    on the reminder table and its indexes forever. Compaction moves the ones that expired a
+    while ago to the reminder_archive table, in bounded batches each on its own short
+    transaction, and then purges archived reminders older than the retention period.
+
+    Reminders are kept for ARCHIVE_AFTER_DAYS after their due time, as the Done and Remind
+    again buttons of their notification still look them up. On postgres the archive is
+    partitioned by month of due time, unless ARCHIVE_BY_MONTH=0 when it was created, and
+    retention drops whole partitions instead of deleting rows.
+
+    Run once by hand with `python -m bot.jobs.compaction`
+"""
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import DateTime, bindparam, literal, select, text
+
+from bot.db import transaction
+from bot.jobs.migrations import MIGRATIONS_LOCK_ID
+from bot.jobs.models import ArchivedReminder, Reminder
+from bot.metrics import observe_compaction
+
+logger = logging.getLogger(__name__)
+
+COMPACTION_INTERVAL = int(os.environ.get('COMPACTION_INTERVAL', 3600))
+ARCHIVE_AFTER = timedelta(days=int(os.environ.get('ARCHIVE_AFTER_DAYS', 7)))
+# 0 keeps archived reminders forever
+RETENTION = timedelta(days=int(os.environ.get('ARCHIVE_RETENTION_DAYS', 365)))
+BATCH_SIZE = int(os.environ.get('COMPACTION_BATCH_SIZE', 1000))
+# Bounds the time a run takes. What is left is compacted by the next run
+MAX_BATCHES = int(os.environ.get('COMPACTION_MAX_BATCHES', 50))
+
+ARCHIVED_COLUMNS = ['id', 'key', 'text', 'user_id', 'user_tag', 'remind_time', 'chat_id', 'offset', 'job_context',
+                    'recurrence']
+PARTITION_PREFIX = 'reminder_archive_'
+IS_PARTITIONED = text("SELECT relkind = 'p' FROM pg_class WHERE relname = 'reminder_archive'")
+PARTITIONS = text(
+    'SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid'
+    " JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = 'reminder_archive'"
+)
+
+
+def _month_start(date):
+    return datetime(date.year, date.month, 1, tzinfo=timezone.utc)
+
+
+def _next_month(month):
+    return month.replace(year=month.year + month.month // 12, month=month.month % 12 + 1)
+
+
+def partition_name(month):
+    return f'{PARTITION_PREFIX}{month:%Y_%m}'
+
+
+class Compactor(object):
+    def __init__(self, archive_after=ARCHIVE_AFTER, retention=RETENTION, batch_size=BATCH_SIZE,
+                 max_batches=MAX_BATCHES):
+        self.archive_after = archive_after
+        self.retention = retention
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+
+    def run(self, context=None):
+        """Archive expired reminders and purge old archived ones. Returns how many rows were
+        moved and purged, and the time it took.
+        """
+        start = time.perf_counter()
+        now = datetime.now(timezone.utc)
+        stats = {'archived': 0, 'purged': 0}
+        try:
+            with transaction() as conn:
+                partitioned = conn.dialect.name == 'postgresql' and bool(conn.execute(IS_PARTITIONED).scalar())
+            self.archive(now - self.archive_after, now, partitioned, stats)
+            if self.retention:
+                self.purge(now - self.retention, partitioned, stats)
+        except Exception:
+            # Batches are committed as they go. The rest is retried on the next run
+            logger.exception('Error compacting reminders')
+
+        stats['seconds'] = time.perf_counter() - start
+        logger.info(f"Archived {stats['archived']} expired reminders and purged {stats['purged']}"
+                    f" archived ones in {stats['seconds']:.3f}s")
+        observe_compaction(stats)
+        return stats
+
+    def archive(self, cutoff, now, partitioned, stats):
+        """Move reminders that expired before cutoff to the archive, a batch per transaction"""
+        if partitioned:
+            self.create_partitions(cutoff)
+
+        # Compared with = rather than IS, so the (expired, remind_time) index is used
+        expired = select([Reminder.id]).where(Reminder.expired == True).where(Reminder.remind_time < cutoff)
+        expired = expired.order_by(Reminder.remind_time).limit(self.batch_size)
+        columns = [Reminder.__table__.c[column] for column in ARCHIVED_COLUMNS]
+        in_batch = Reminder.id.in_(bindparam('ids', expanding=True))
+        move = ArchivedReminder.__table__.insert().from_select(
+            ARCHIVED_COLUMNS + ['archived_at'],
+            select(columns + [literal(now, DateTime(timezone=True))]).where(in_batch),
+        )
+        delete = Reminder.__table__.delete().where(in_batch)
+
+        for _ in range(self.max_batches):
+            with transaction() as conn:
+                batch = expired
+                if conn.dialect.name == 'postgresql':
+                    # Concurrent compactors, like the ones of every shard, take different batches
+                    batch = expired.with_for_update(skip_locked=True)
+                ids = [reminder_id for reminder_id, in conn.execute(batch)]
+                if not ids:
+                    return
+                conn.execute(move, ids=ids)
+                conn.execute(delete, ids=ids)
+            stats['archived'] += len(ids)
+            if len(ids) < self.batch_size:
+                return
+
+    def create_partitions(self, cutoff):
+        """Create the monthly partitions the reminders that expired before cutoff go to"""
+        with transaction() as conn:
+            # IF NOT EXISTS still fails when another shard creates the same partition meanwhile.
+            # Held until commit, and not taken while migrations run.
+            conn.execute(text('SELECT pg_advisory_xact_lock(:id)'), id=MIGRATIONS_LOCK_ID)
+            oldest = conn.execute(
+                select([Reminder.remind_time]).where(Reminder.expired == True).where(Reminder.remind_time < cutoff)
+                .order_by(Reminder.remind_time).limit(1)
+            ).scalar()
+            if oldest is None:
+                return
+            month = _month_start(oldest)
+            while month <= cutoff:
+                following = _next_month(month)
+                conn.execute(text(
+                    f'CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF reminder_archive'
+                    f" FOR VALUES FROM ('{month.isoformat()}') TO ('{following.isoformat()}')"
+                ))
+                month = following
+
+    def purge(self, cutoff, partitioned, stats):
+        """Delete archived reminders due before cutoff.
+
+        Partitions are dropped only once every reminder in them is past the cutoff, so some
+        reminders are kept up to a month longer than the retention period.
+        """
+        if partitioned:
+            with transaction() as conn:
+                for name, in conn.execute(PARTITIONS).fetchall():
+                    month = datetime.strptime(name[len(PARTITION_PREFIX):], '%Y_%m').replace(tzinfo=timezone.utc)
+                    if _next_month(month) <= cutoff:
+                        stats['purged'] += conn.execute(text(f'SELECT count(*) FROM {name}')).scalar()
+                        conn.execute(text(f'DROP TABLE {name}'))
+                        logger.info(f'Dropped archive partition {name}')
+            return
+
+        archive = ArchivedReminder.__table__
+        old = select([archive.c.id]).where(archive.c.remind_time < cutoff).limit(self.batch_size)
+        for _ in range(self.max_batches):
+            with transaction() as conn:
+                purged = conn.execute(archive.delete().where(archive.c.id.in_(old))).rowcount
+            stats['purged'] += purged
+            if purged < self.batch_size:
+                return
+
+
+compactor = Compactor()
+
+
+def compact_reminders(context):
+    """Job that compacts reminders on the dispatcher pool, so the job_queue is not held meanwhile"""
+    context.dispatcher.run_async(compactor.run)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s [%(funcName)s] %(message)s',
+        level=logging.INFO
+    )
+    # Logs what it archived and purged
+    compactor.run()
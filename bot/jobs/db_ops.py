@@ -1,46 +1,250 @@
+import csv
+import io
+import json
 import logging
 
-from bot.jobs.models import Session, Reminder
+from sqlalchemy import bindparam, literal, or_, select, text, tuple_
+
+from bot.db import session_scope, transaction
+from bot.jobs.models import ArchivedReminder, Reminder, Todo
+from bot.sharding import SHARD_COUNT, owned_by_shard
 
 logger = logging.getLogger(__name__)
 
 
 def add_reminder(reminder):
-    session = Session()
-    session.add(reminder)
-    session.commit()
+    with session_scope() as session:
+        session.add(reminder)
+
+
+IMPORT_COLUMNS = ('key', 'text', 'user_id', 'user_tag', 'remind_time', 'chat_id', 'offset', 'job_context', 'recurrence')
+_import_columns = ', '.join(f'"{column}"' for column in IMPORT_COLUMNS)
+# Only the imported columns, without the constraints of reminder, like the NOT NULL id
+STAGE_IMPORT = text(
+    f'CREATE TEMP TABLE reminder_import ON COMMIT DROP AS SELECT {_import_columns} FROM reminder WITH NO DATA'
+)
+COPY_IMPORT = f'COPY reminder_import ({_import_columns}) FROM STDIN WITH (FORMAT csv)'
+INSERT_IMPORT = text(
+    f'INSERT INTO reminder ({_import_columns}, expired) SELECT {_import_columns}, false FROM reminder_import '
+    f'ON CONFLICT (key) DO NOTHING RETURNING key, id'
+)
+SELECT_IDS = text('SELECT key, id FROM reminder WHERE key IN :keys').bindparams(bindparam('keys', expanding=True))
+
+
+def add_reminders(rows):
+    """Insert reminder rows in bulk, skipping the ones whose key is taken.
+
+    On postgres rows are COPYed into a temporary table and moved from it with a single
+    INSERT that skips taken keys and returns the ids. Returns the {key: id} of the inserted
+    reminders.
+    """
+    with session_scope() as session:
+        if session.bind.dialect.name == 'postgresql':
+            session.execute(STAGE_IMPORT)
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for row in rows:
+                writer.writerow([
+                    json.dumps(row[column]) if column == 'job_context' else row[column] for column in IMPORT_COLUMNS
+                ])
+            buffer.seek(0)
+            with session.connection().connection.cursor() as cursor:
+                cursor.copy_expert(COPY_IMPORT, buffer)
+            return dict(session.execute(INSERT_IMPORT).fetchall())
+
+        # sqlite stand-in. No COPY nor RETURNING, inserted rows are told apart by their key
+        taken = dict(session.execute(SELECT_IDS, {'keys': [row['key'] for row in rows]}).fetchall())
+        rows = list({row['key']: row for row in rows if row['key'] not in taken}.values())
+        if not rows:
+            return {}
+        session.execute(Reminder.__table__.insert(), rows)
+        return dict(session.execute(SELECT_IDS, {'keys': [row['key'] for row in rows]}).fetchall())
 
 
 def expire_reminder(key):
-    session = Session()
-    reminder = session.query(Reminder).filter_by(key=key).first()
-    if reminder is None:
-        logger.info(f"Reminder {key!r} does not exist on db")
-        expired = False
-    else:
-        reminder.expired = True
-        session.commit()
-        logger.info(f"Reminder {key!r} Expired")
-        expired = True
+    with session_scope() as session:
+        reminder = session.query(Reminder).filter_by(key=key).first()
+        if reminder is None:
+            logger.info(f"Reminder {key!r} does not exist on db")
+            expired = False
+        else:
+            reminder.expired = True
+            logger.info(f"Reminder {key!r} Expired")
+            expired = True
 
     return expired
 
 
+def expire_reminders(keys):
+    """Expire every reminder in keys with a single statement. Returns how many were expired"""
+    with session_scope() as session:
+        return session.query(Reminder).filter(Reminder.key.in_(keys)).update(
+            {'expired': True}, synchronize_session=False
+        )
+
+
+def get_reminder(reminder_id, user_id):
+    with session_scope() as session:
+        return session.query(Reminder).filter_by(id=reminder_id, user_id=user_id).first()
+
+
+def advance_reminder(reminder_id, key, remind_time, job_context, lease_owner=None):
+    """Move a recurring reminder to its next occurrence, releasing its lease.
+
+    Scheduler workers pass their lease, so a reminder another worker leased meanwhile is left alone.
+    """
+    with session_scope() as session:
+        query = session.query(Reminder).filter_by(id=reminder_id)
+        if lease_owner is not None:
+            query = query.filter_by(lease_owner=lease_owner)
+        query.update(
+            {'key': key, 'remind_time': remind_time, 'job_context': job_context,
+             'lease_owner': None, 'leased_until': None},
+            synchronize_session=False,
+        )
+    logger.info(f"Reminder {reminder_id} advanced to {remind_time}")
+
+
+def delete_reminder(reminder_id, user_id):
+    """Delete a one-off reminder of the user by id. Returns whether it existed.
+
+    Recurring reminders are kept. Being done with one occurrence doesn't end the next ones.
+    """
+    with session_scope() as session:
+        deleted = session.query(Reminder).filter_by(id=reminder_id, user_id=user_id, recurrence=None).delete()
+    logger.info(f"Reminder {reminder_id} {'DELETED' if deleted else 'does not exist on db'}")
+    return bool(deleted)
+
+
 def remove_reminder(text, **kwargs):
-    session = Session()
-    reminder = session.query(Reminder).filter_by(text=text, **kwargs).first()
-    if reminder is None:
-        logger.info(f"Reminder {text} does not exist on db")
-        msg = f'🚫 El reminder `{text}` no existe en la base de datos'
-    else:
-        session.delete(reminder)
-        logger.info(f"Reminder {text!r} DELETED")
-        msg = f'✅ Reminder `{text}` borrado con éxito'
-
-    session.commit()
+    with session_scope() as session:
+        reminder = session.query(Reminder).filter_by(text=text, **kwargs).first()
+        if reminder is None:
+            logger.info(f"Reminder {text} does not exist on db")
+            msg = f'🚫 El reminder `{text}` no existe en la base de datos'
+        else:
+            session.delete(reminder)
+            logger.info(f"Reminder {text!r} DELETED")
+            msg = f'✅ Reminder `{text}` borrado con éxito'
+
     return msg
 
 
 def get_reminders(order_attr=None, **kwargs):
-    session = Session()
-    return session.query(Reminder).filter_by(**kwargs).order_by(order_attr)
+    with session_scope() as session:
+        return session.query(Reminder).filter_by(**kwargs).order_by(order_attr).all()
+
+
+def get_reminders_page(user_id, page_size, after=None, before=None):
+    """One page of the pending reminders of a user, by due time. Returns the page and whether
+    there are more reminders past it.
+
+    Pages are keyset paginated on (remind_time, id), so every page is a single index range
+    scan however many reminders the user has. `after` and `before` are the (remind_time, id)
+    of the last reminder of the previous page or the first one of the next page.
+    """
+    with session_scope() as session:
+        query = session.query(Reminder).filter_by(user_id=user_id, expired=False)
+        position = tuple_(Reminder.remind_time, Reminder.id)
+        if before is not None:
+            query = query.filter(position < tuple_(*before))
+            query = query.order_by(Reminder.remind_time.desc(), Reminder.id.desc())
+        else:
+            if after is not None:
+                query = query.filter(position > tuple_(*after))
+            query = query.order_by(Reminder.remind_time, Reminder.id)
+        reminders = query.limit(page_size + 1).all()
+
+    more = len(reminders) > page_size
+    reminders = reminders[:page_size]
+    if before is not None:
+        reminders.reverse()
+    return reminders, more
+
+
+def iter_pending_reminders(until, since=None, batch_size=500):
+    """Yield batches of non-expired reminders due up to `until` (and after `since`, if given).
+
+    Rows are paged by id on short-lived sessions, so memory is bounded by the batch size and
+    no connection is held while the caller processes a batch. When sharded, only reminders
+    of this shard's users are returned.
+    """
+    last_id = 0
+    while True:
+        with session_scope() as session:
+            query = session.query(Reminder).filter_by(expired=False).filter(
+                Reminder.remind_time <= until,
+                Reminder.id > last_id,
+            )
+            if since is not None:
+                query = query.filter(Reminder.remind_time > since)
+            if SHARD_COUNT > 1:
+                query = query.filter(text(owned_by_shard('reminder.user_id')))
+            batch = query.order_by(Reminder.id).limit(batch_size).all()
+
+        if not batch:
+            return
+        yield batch
+        last_id = batch[-1].id
+
+
+def get_todos_page(user_id, chat_id, done, page_size, after=None, before=None):
+    """One page of the todos of a user in a chat, by id. Returns the page and whether there
+    are more todos past it. Keyset paginated like get_reminders_page
+    """
+    with session_scope() as session:
+        query = session.query(Todo).filter_by(user_id=user_id, done=done, chat_id=chat_id)
+        if before is not None:
+            query = query.filter(Todo.id < before).order_by(Todo.id.desc())
+        else:
+            if after is not None:
+                query = query.filter(Todo.id > after)
+            query = query.order_by(Todo.id)
+        todos = query.limit(page_size + 1).all()
+
+    more = len(todos) > page_size
+    todos = todos[:page_size]
+    if before is not None:
+        todos.reverse()
+    return todos, more
+
+
+def complete_todos(user_id, chat_id, id_ranges):
+    """Mark the pending todos of a user in a chat within the (first, last) id ranges as done.
+
+    A single UPDATE whatever the number of ids, as every range is an index range.
+    Returns how many todos were completed.
+    """
+    in_ranges = or_(*(Todo.id.between(first, last) for first, last in id_ranges))
+    with session_scope() as session:
+        return session.query(Todo).filter_by(user_id=user_id, done=False, chat_id=chat_id).filter(
+            in_ranges
+        ).update({'done': True}, synchronize_session=False)
+
+
+def iter_user_reminders(user_id, batch_size=1000):
+    """Yield every reminder of a user, pending ones first and then by due time, and then
+    the archived ones.
+
+    Rows are read from a server-side cursor on postgres, `batch_size` at a time, so memory
+    is bounded whatever the number of reminders. Only the columns exports need are read.
+    The connection is held until the generator is exhausted or closed.
+    """
+    columns = [Reminder.id, Reminder.text, Reminder.remind_time, Reminder.recurrence, Reminder.expired]
+    reminders = select(columns).where(Reminder.user_id == user_id).order_by(
+        Reminder.expired, Reminder.remind_time, Reminder.id
+    )
+    archive = ArchivedReminder
+    archived = select([
+        archive.id, archive.text, archive.remind_time, archive.recurrence, literal(True).label('expired')
+    ]).where(archive.user_id == user_id).order_by(archive.remind_time)
+
+    with transaction() as conn:
+        for query in (reminders, archived):
+            result = conn.execution_options(stream_results=True).execute(query)
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+
@@ -0,0 +1,65 @@
+"""
+    Write-behind buffer for expiring reminders once they were delivered.
+
+    Delivering a reminder only records its key. Keys are expired on the db in one statement
+    every few seconds, so a burst of due reminders does not pay a db round-trip each.
+    A reminder delivered right before a crash may not get expired, and is delivered again
+    when reminders are recovered on restart.
+"""
+import logging
+import os
+import threading
+
+from bot.jobs.db_ops import expire_reminders
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = int(os.environ.get('EXPIRY_FLUSH_INTERVAL', 5))
+MAX_PENDING = int(os.environ.get('EXPIRY_MAX_PENDING', 500))
+
+
+class ExpiryBuffer(object):
+    """Collect keys of delivered reminders and expire them in batches.
+
+    Call `flush` every `FLUSH_INTERVAL` seconds and on shutdown, and as soon as `add` says
+    `max_pending` keys are waiting.
+    """
+
+    def __init__(self, max_pending=MAX_PENDING):
+        self.max_pending = max_pending
+        self._keys = set()
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        """Record a delivered reminder. Returns whether it is time to flush.
+
+        Doesn't flush itself, as it is called from the outbound sender thread.
+        """
+        with self._lock:
+            self._keys.add(key)
+            return len(self._keys) >= self.max_pending
+
+    def flush(self, context=None):
+        """Expire pending keys. Can be used as a job_queue callback"""
+        with self._lock:
+            keys, self._keys = self._keys, set()
+        if not keys:
+            return 0
+
+        try:
+            expired = expire_reminders(keys)
+        except Exception:
+            # Keep them for the next flush
+            with self._lock:
+                self._keys |= keys
+            logger.exception(f'Error expiring {len(keys)} reminders')
+            return 0
+
+        logger.info(f'Expired {expired} reminders')
+        return expired
+
+    def __len__(self):
+        return len(self._keys)
+
+
+expiry_buffer = ExpiryBuffer()
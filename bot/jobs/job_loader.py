@@ -1,33 +1,71 @@
 import logging
+import time
+from datetime import datetime, timedelta, timezone
 
-from bot.jobs.db_ops import get_reminders
-from bot.utils import send_notification, isoformat_to_datetime
+from bot.constants import TOP_UP_INTERVAL
+from bot.jobs.db_ops import iter_pending_reminders
+from bot.utils import send_notification, REMINDER_HORIZON
 
 logger = logging.getLogger(__name__)
 
 
 def load_reminders(bot, job_queue):
-    """Query all non-expired reminders and add them to the job_queue if they are not present."""
+    """Add non-expired reminders due within the horizon to the job_queue if they are not present.
+
+    Reminders due later are left on the db. They are scheduled by `top_up_reminders` as
+    they enter the horizon.
+    """
+    until = datetime.now(timezone.utc) + REMINDER_HORIZON
     try:
-        reminders = get_reminders(expired=False)
+        return _schedule_reminders(job_queue, until)
     except Exception:
         logger.error("Reminders could not be restored from db", exc_info=True)
         return 0
 
-    recovered_jobs = 0
-    job_names = [j.name for j in job_queue.jobs()]
-    reminders_to_recover = [r for r in reminders if r.text not in job_names]
-
-    logger.info(f'Found {len(reminders_to_recover)} reminders in db that are not in the job_queue')
-    for reminder in reminders_to_recover:
-        # Readd the reminder in the db.
-        job_queue.run_once(
-            send_notification,
-            when=isoformat_to_datetime(reminder.remind_time),
-            context=reminder.job_context,
-            name=reminder.text
-        )
-        logger.info('Job readded to job queue from database. %s', reminder)
-        recovered_jobs += 1
 
+def top_up_interval(horizon=REMINDER_HORIZON):
+    """Seconds between runs of `top_up_reminders`.
+
+    At most half the horizon, so a top-up that runs late still overlaps the window of the
+    previous one and no reminder is due before a top-up reaches it.
+    """
+    if horizon <= timedelta(0):
+        raise ValueError(f'REMINDER_HORIZON_HOURS must be positive, not {horizon.total_seconds() / 3600:g}')
+    return min(TOP_UP_INTERVAL, horizon.total_seconds() / 2)
+
+
+def top_up_reminders(context):
+    """Job that schedules the reminders that entered the horizon since the last run.
+
+    Only future reminders are considered, so a reminder whose job already ran but is not
+    expired on the db yet is not scheduled twice.
+    """
+    now = datetime.now(timezone.utc)
+    try:
+        _schedule_reminders(context.job_queue, now + REMINDER_HORIZON, since=now)
+    except Exception:
+        logger.error("Reminders could not be topped up from db", exc_info=True)
+
+
+def _schedule_reminders(job_queue, until, since=None):
+    start = time.perf_counter()
+    scheduled_keys = {job.name for job in job_queue.jobs()}
+    scanned, recovered_jobs = 0, 0
+
+    for batch in iter_pending_reminders(until, since=since):
+        scanned += len(batch)
+        for reminder in batch:
+            if reminder.key in scheduled_keys:
+                continue
+            job_queue.run_once(
+                send_notification,
+                when=reminder.remind_time,
+                context={**reminder.job_context, 'reminder_id': reminder.id},
+                name=reminder.key
+            )
+            scheduled_keys.add(reminder.key)
+            recovered_jobs += 1
+
+    logger.info(f'Scheduled {recovered_jobs} reminders due until {until:%d/%m %H:%M}.'
+                f' Scanned {scanned} rows in {time.perf_counter() - start:.3f}s')
     return recovered_jobs
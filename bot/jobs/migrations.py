@@ -0,0 +1,223 @@
+"""
+    Schema migrations that can run while the previous bot version keeps serving.
+
+    Every migration runs once and is recorded on the `schema_migrations` table. Migrations
+    are idempotent, so a fresh db that `create_all` already built with the latest models
+    just gets them recorded.
+"""
+import logging
+import time
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# Arbitrary key of the advisory lock that keeps two bot instances from migrating at once
+MIGRATIONS_LOCK_ID = 7170
+BACKFILL_BATCH_SIZE = 1000
+
+# column, target type as reported by information_schema, sql type, cast from legacy value
+TYPED_REMINDER_COLUMNS = [
+    ('remind_time', 'timestamp with time zone', 'timestamptz', "remind_time::timestamp AT TIME ZONE 'UTC'"),
+    ('job_context', 'jsonb', 'jsonb', 'job_context::jsonb'),
+    ('user_id', 'bigint', 'bigint', 'user_id::bigint'),
+    ('chat_id', 'bigint', 'bigint', 'chat_id::bigint'),
+]
+
+REMINDER_INDEXES = [
+    ('ix_reminder_key', 'CREATE UNIQUE INDEX CONCURRENTLY ix_reminder_key ON reminder (key)'),
+    ('ix_reminder_user_pending',
+     'CREATE INDEX CONCURRENTLY ix_reminder_user_pending ON reminder (user_id, expired, remind_time)'),
+    ('ix_reminder_due', 'CREATE INDEX CONCURRENTLY ix_reminder_due ON reminder (expired, remind_time)'),
+    ('ix_reminder_user_text', 'CREATE INDEX CONCURRENTLY ix_reminder_user_text ON reminder (user_id, text)'),
+]
+
+TODO_INDEXES = [
+    ('ix_todo_user_pending', 'CREATE INDEX CONCURRENTLY ix_todo_user_pending ON todo (user_id, done, id)'),
+]
+
+PAGE_INDEXES = [
+    ('ix_reminder_user_page',
+     'CREATE INDEX CONCURRENTLY ix_reminder_user_page ON reminder (user_id, expired, remind_time, id)'),
+]
+
+
+def _column_types(conn, table):
+    rows = conn.execute(
+        text("SELECT column_name, data_type FROM information_schema.columns WHERE table_name = :table"),
+        table=table,
+    )
+    return {name: data_type for name, data_type in rows}
+
+
+def typed_reminder_columns(engine):
+    """Convert legacy string/json-text reminder columns to timestamptz, jsonb and bigint.
+
+    New columns are added next to the legacy ones and backfilled in small batches, each on
+    its own transaction, so the table is never locked for long. Only the final swap takes an
+    exclusive lock, to backfill the rows inserted meanwhile and rename the columns.
+    """
+    with engine.connect() as conn:
+        column_types = _column_types(conn, 'reminder')
+
+    pending = [
+        (column, sql_type, cast)
+        for column, data_type, sql_type, cast in TYPED_REMINDER_COLUMNS
+        if column_types.get(column) != data_type
+    ]
+    if not pending:
+        logger.info('Reminder columns already typed')
+        return
+
+    with engine.begin() as conn:
+        for column, sql_type, _ in pending:
+            conn.execute(text(f'ALTER TABLE reminder ADD COLUMN IF NOT EXISTS {column}_typed {sql_type}'))
+
+    assignments = ', '.join(f'{column}_typed = {cast}' for column, _, cast in pending)
+    backfill = text(f'UPDATE reminder SET {assignments} WHERE id > :after AND id <= :upto')
+    last_id, backfilled = 0, 0
+    while True:
+        with engine.begin() as conn:
+            upto = conn.execute(
+                text('SELECT max(id) FROM (SELECT id FROM reminder WHERE id > :after ORDER BY id LIMIT :limit) batch'),
+                after=last_id, limit=BACKFILL_BATCH_SIZE,
+            ).scalar()
+            if upto is None:
+                break
+            backfilled += conn.execute(backfill, after=last_id, upto=upto).rowcount
+        last_id = upto
+        logger.info(f'Backfilled {backfilled} reminders up to id {last_id}')
+
+    with engine.begin() as conn:
+        conn.execute(text('LOCK TABLE reminder IN ACCESS EXCLUSIVE MODE'))
+        # Rows inserted by the running bot while backfilling
+        caught_up = conn.execute(text(f'UPDATE reminder SET {assignments} WHERE id > :after'), after=last_id).rowcount
+        for column, _, _ in pending:
+            conn.execute(text(f'ALTER TABLE reminder DROP COLUMN {column}'))
+            conn.execute(text(f'ALTER TABLE reminder RENAME COLUMN {column}_typed TO {column}'))
+
+    logger.info(f'Converted reminder columns {[column for column, _, _ in pending]}.'
+                f' Backfilled {backfilled} rows and {caught_up} rows on swap')
+
+
+def reminder_indexes(engine):
+    """Index reminders by key, by user pending reminders and by due time.
+
+    Indexes are built concurrently so writes are not blocked. Duplicated keys are removed
+    first, keeping the oldest reminder, as they would make the unique index fail.
+    """
+    with engine.begin() as conn:
+        removed = conn.execute(text(
+            'DELETE FROM reminder dup USING reminder original'
+            ' WHERE dup.key = original.key AND dup.id > original.id'
+        )).rowcount
+    if removed:
+        logger.info(f'Removed {removed} reminders with duplicated keys')
+
+    _create_indexes_concurrently(engine, REMINDER_INDEXES)
+
+
+def _create_indexes_concurrently(engine, indexes):
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+        for name, create_index in indexes:
+            # An interrupted concurrent build leaves an invalid index behind. Build it again.
+            valid = conn.execute(
+                text('SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid'
+                     ' WHERE c.relname = :name'),
+                name=name,
+            ).scalar()
+            if valid:
+                continue
+            if valid is False:
+                conn.execute(text(f'DROP INDEX CONCURRENTLY {name}'))
+            conn.execute(text(create_index))
+            logger.info(f'Created index {name}')
+
+
+def reminder_page_index(engine):
+    """Extend the pending reminders index with id, to keyset paginate on (remind_time, id).
+
+    The new index covers every query of the one it replaces.
+    """
+    _create_indexes_concurrently(engine, PAGE_INDEXES)
+    with engine.connect() as conn:
+        conn.execution_options(isolation_level='AUTOCOMMIT').execute(
+            text('DROP INDEX CONCURRENTLY IF EXISTS ix_reminder_user_pending')
+        )
+
+
+def reminder_leases(engine):
+    """Add the lease columns used by the db scheduler. Nullable columns are added without a rewrite"""
+    with engine.begin() as conn:
+        conn.execute(text('ALTER TABLE reminder ADD COLUMN IF NOT EXISTS lease_owner VARCHAR'))
+        conn.execute(text('ALTER TABLE reminder ADD COLUMN IF NOT EXISTS leased_until TIMESTAMPTZ'))
+
+
+def reminder_recurrence(engine):
+    """Add the recurrence rule of repeating reminders"""
+    with engine.begin() as conn:
+        conn.execute(text('ALTER TABLE reminder ADD COLUMN IF NOT EXISTS recurrence VARCHAR'))
+
+
+def todo_owner(engine):
+    """Give todos an owner user and chat, and index them by user"""
+    with engine.begin() as conn:
+        conn.execute(text('ALTER TABLE todo ADD COLUMN IF NOT EXISTS user_id BIGINT'))
+        conn.execute(text('ALTER TABLE todo ADD COLUMN IF NOT EXISTS chat_id BIGINT'))
+    _create_indexes_concurrently(engine, TODO_INDEXES)
+
+
+def conversation_owner(engine):
+    """Store the user of each conversation, which is the second element of its key when it has one.
+
+    Rows written by the previous version meanwhile are left without a user, and are told
+    apart from their key when loaded.
+    """
+    with engine.begin() as conn:
+        conn.execute(text('ALTER TABLE conversation_state ADD COLUMN IF NOT EXISTS user_id BIGINT'))
+        conn.execute(text(
+            "UPDATE conversation_state SET user_id = CAST(COALESCE("
+            "substring(key from '^\\(-?\\d+, (-?\\d+)'), substring(key from '^\\((-?\\d+),\\)$')"
+            ") AS BIGINT) WHERE user_id IS NULL"
+        ))
+
+
+MIGRATIONS = [
+    ('0001_typed_reminder_columns', typed_reminder_columns),
+    ('0002_reminder_indexes', reminder_indexes),
+    ('0003_reminder_leases', reminder_leases),
+    ('0004_reminder_page_index', reminder_page_index),
+    ('0005_reminder_recurrence', reminder_recurrence),
+    ('0006_todo_owner', todo_owner),
+    ('0007_conversation_owner', conversation_owner),
+]
+
+
+def run_migrations(engine):
+    """Apply pending migrations in order. Only postgres dbs are migrated."""
+    if engine.dialect.name != 'postgresql':
+        logger.info(f'Skipping migrations on {engine.dialect.name} db')
+        return
+
+    with engine.connect() as lock_conn:
+        lock_conn.execute(text('SELECT pg_advisory_lock(:id)'), id=MIGRATIONS_LOCK_ID)
+        try:
+            with engine.begin() as conn:
+                conn.execute(text(
+                    'CREATE TABLE IF NOT EXISTS schema_migrations'
+                    ' (name VARCHAR PRIMARY KEY, applied_at TIMESTAMPTZ NOT NULL DEFAULT now())'
+                ))
+                applied = {name for name, in conn.execute(text('SELECT name FROM schema_migrations'))}
+
+            for name, migrate in MIGRATIONS:
+                if name in applied:
+                    continue
+                logger.info(f'Applying migration {name}..')
+                start = time.perf_counter()
+                migrate(engine)
+                with engine.begin() as conn:
+                    conn.execute(text('INSERT INTO schema_migrations (name) VALUES (:name)'), name=name)
+                logger.info(f'Applied migration {name} in {time.perf_counter() - start:.2f}s')
+        finally:
+            lock_conn.execute(text('SELECT pg_advisory_unlock(:id)'), id=MIGRATIONS_LOCK_ID)
@@ -1,58 +1,77 @@
 import os
-import json
 
-from sqlalchemy import create_engine, Column, Integer, String, Boolean
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, DateTime, Index, JSON as AnyJSON
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.types import TypeDecorator, VARCHAR
-from sqlalchemy.dialects.postgresql import JSON
+from sqlalchemy.dialects.postgresql import JSON, JSONB
 
-Base = declarative_base()
+from bot.db import get_engine
+from bot.jobs.migrations import run_migrations
 
-MINUTE = 60 # See https://community.fly.io/t/postgresql-connection-is-closed-error-after-a-few-minutes-of-activity/4768/3
-engine = create_engine(os.environ['DATABASE_URL'], pool_recycle=30 * MINUTE)
-Session = sessionmaker(bind=engine)
+Base = declarative_base()
 
 
 def create_tables():
     # Also manually CREATE TABLE state (info json); ALTER TABLE state OWNER TO remindersbot; not tracked by alchemy
+    engine = get_engine()
     Base.metadata.create_all(engine)
+    # create_all does not alter existing tables. Bring them up to date with the models.
+    run_migrations(engine)
 
+class State(Base):
+    """Legacy single-blob bot state. Migrated into the per-entity tables below on load."""
+    __tablename__ = 'state'
+    id = Column(Integer, primary_key=True)
+    info = Column(JSON)
 
-class JSONEncodedValue(TypeDecorator):
-    """Represents an immutable structure as a json-encoded string."""
 
-    impl = VARCHAR
+class UserState(Base):
+    __tablename__ = 'user_state'
+    user_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    data = Column(JSON)
 
-    def process_bind_param(self, value, dialect):
-        if value is not None:
-            value = json.dumps(value)
-        return value
 
-    def process_result_value(self, value, dialect):
-        if value is not None:
-            value = json.loads(value)
-        return value
+class ChatState(Base):
+    __tablename__ = 'chat_state'
+    chat_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    data = Column(JSON)
 
-class State(Base):
-    __tablename__ = 'state'
-    id = Column(Integer, primary_key=True)
-    info = Column(JSON)
+
+class ConversationState(Base):
+    __tablename__ = 'conversation_state'
+    name = Column(String, primary_key=True)
+    key = Column(String, primary_key=True)
+    state = Column(JSON)
+    # User the conversation key belongs to, to load only the conversations of a shard
+    user_id = Column(BigInteger)
 
 class Reminder(Base):
     __tablename__ = 'reminder'
+    __table_args__ = (
+        # /myreminders pages: pending reminders of a user sorted by (date, id)
+        Index('ix_reminder_user_page', 'user_id', 'expired', 'remind_time', 'id'),
+        # Reminders due before a given time
+        Index('ix_reminder_due', 'expired', 'remind_time'),
+        # /delete and Done look reminders up by their text
+        Index('ix_reminder_user_text', 'user_id', 'text'),
+    )
 
     id = Column(Integer, primary_key=True)
 
-    key = Column(String)
+    key = Column(String, index=True, unique=True)
     text = Column(String)
-    user_id = Column(String)
+    user_id = Column(BigInteger)
     user_tag = Column(String)
-    remind_time = Column(String)
-    chat_id = Column(String)
+    remind_time = Column(DateTime(timezone=True))
+    chat_id = Column(BigInteger)
     offset = Column(Integer)
     expired = Column(Boolean, default=False)
-    job_context = Column(JSONEncodedValue)
+    # jsonb on postgres, plain json on the sqlite db used as a local stand-in
+    job_context = Column(AnyJSON().with_variant(JSONB, 'postgresql'))
+    # Set while a scheduler worker is delivering the reminder. See bot.jobs.scheduler
+    lease_owner = Column(String)
+    leased_until = Column(DateTime(timezone=True))
+    # Rule of recurring reminders, whose remind_time is their next occurrence. See bot.recurrence
+    recurrence = Column(String)
 
     def __repr__(self):
         return (f"Reminder(text={self.text}, user_id={self.user_id}, user_tag={self.user_tag},"
@@ -60,8 +79,42 @@ class Reminder(Base):
                 f" key={self.key}, expired={self.expired})")
 
 
+class ArchivedReminder(Base):
+    """Expired reminders moved out of the reminder table. See bot.jobs.compaction"""
+    __tablename__ = 'reminder_archive'
+    __table_args__ = (
+        # /export reads the archived reminders of a user
+        Index('ix_reminder_archive_user', 'user_id', 'remind_time'),
+        # Retention deletes by due time, when the archive is not partitioned
+        Index('ix_reminder_archive_time', 'remind_time'),
+        # On postgres, one partition per month of due time. Retention drops whole partitions
+        {'postgresql_partition_by': 'RANGE (remind_time)'} if os.environ.get('ARCHIVE_BY_MONTH', '1') == '1' else {},
+    )
+
+    # Partitioned tables need the partition column in their primary key
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    remind_time = Column(DateTime(timezone=True), primary_key=True)
+    key = Column(String)
+    text = Column(String)
+    user_id = Column(BigInteger)
+    user_tag = Column(String)
+    chat_id = Column(BigInteger)
+    offset = Column(Integer)
+    job_context = Column(AnyJSON().with_variant(JSONB, 'postgresql'))
+    recurrence = Column(String)
+    archived_at = Column(DateTime(timezone=True))
+
+
 class Todo(Base):
     __tablename__ = 'todo'
+    __table_args__ = (
+        # /todos pages and /mark_todo_as_done ranges: todos of a user by id
+        Index('ix_todo_user_pending', 'user_id', 'done', 'id'),
+    )
+
     id = Column(Integer, primary_key=True)
     text = Column(String)
     done = Column(Boolean, default=False)
+    # Todos written before they had an owner have none, and are not shown to anyone
+    user_id = Column(BigInteger)
+    chat_id = Column(BigInteger)
@@ -0,0 +1,198 @@
+"""
+    Db backed reminder scheduler.
+
+    Due reminders are not kept in memory. Workers poll the db for them, lease a batch, deliver
+    it and mark it as fired. Leases make it safe to run several workers at once: a reminder is
+    only delivered by the worker that leased it, and if that worker dies before marking it
+    fired the lease runs out and another worker delivers it.
+
+    Messages to a chat are rate limited, so a batch only takes up to SCHEDULER_MAX_PER_CHAT
+    reminders of each chat, and the lease is extended while the batch is still being sent.
+
+    Run standalone workers with `python -m bot.jobs.scheduler`
+"""
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import Future, wait
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func, or_
+
+from bot.db import session_scope
+from bot.jobs.models import Reminder
+from bot.outbound import BULK, QueuedBot
+from bot.jobs.db_ops import advance_reminder
+from bot.utils import notify, next_occurrence_context, reminder_key
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = int(os.environ.get('SCHEDULER_POLL_INTERVAL', 5))
+BATCH_SIZE = int(os.environ.get('SCHEDULER_BATCH_SIZE', 100))
+LEASE_SECONDS = int(os.environ.get('SCHEDULER_LEASE_SECONDS', 60))
+# Groups get 20 messages a minute, so 10 are sent well within the lease
+MAX_PER_CHAT = int(os.environ.get('SCHEDULER_MAX_PER_CHAT', 10))
+
+
+class ReminderScheduler(object):
+    def __init__(self, bot, batch_size=BATCH_SIZE, lease_seconds=LEASE_SECONDS, max_per_chat=MAX_PER_CHAT,
+                 worker_id=None):
+        self.bot = bot
+        self.batch_size = batch_size
+        self.lease = timedelta(seconds=lease_seconds)
+        self.max_per_chat = max_per_chat
+        self.worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}'
+        self._ticking = threading.Lock()
+
+    def claim_due(self, now):
+        """Lease a batch of due reminders. Returns the lease id and the leased reminders"""
+        lease_id = f'{self.worker_id}:{uuid.uuid4().hex[:8]}'
+        not_leased = or_(Reminder.leased_until.is_(None), Reminder.leased_until < now)
+        with session_scope() as session:
+            nth_of_chat = func.row_number().over(partition_by=Reminder.chat_id, order_by=Reminder.remind_time)
+            ranked = session.query(Reminder.id, nth_of_chat.label('nth')).filter_by(expired=False).filter(
+                Reminder.remind_time <= now,
+                not_leased,
+            ).subquery()
+            first_of_chat = session.query(ranked.c.id).filter(ranked.c.nth <= self.max_per_chat)
+            due = session.query(Reminder.id).filter(Reminder.id.in_(first_of_chat)).order_by(
+                Reminder.remind_time
+            ).limit(self.batch_size)
+            if session.bind.dialect.name == 'postgresql':
+                # Skip rows another worker is leasing right now instead of waiting for them
+                due = due.with_for_update(skip_locked=True)
+
+            due_ids = [reminder_id for reminder_id, in due]
+            if not due_ids:
+                return lease_id, []
+
+            # Conditions are checked again, for dbs without row locks
+            session.query(Reminder).filter_by(expired=False).filter(Reminder.id.in_(due_ids), not_leased).update(
+                {'lease_owner': lease_id, 'leased_until': now + self.lease},
+                synchronize_session=False,
+            )
+            return lease_id, session.query(Reminder).filter_by(lease_owner=lease_id).all()
+
+    def mark_fired(self, lease_id, reminder_ids):
+        with session_scope() as session:
+            session.query(Reminder).filter(
+                Reminder.id.in_(reminder_ids),
+                Reminder.lease_owner == lease_id,
+            ).update(
+                {'expired': True, 'lease_owner': None, 'leased_until': None},
+                synchronize_session=False,
+            )
+
+    def extend_lease(self, lease_id, reminder_ids):
+        """Keep reminders that are still being sent from being leased by other workers"""
+        with session_scope() as session:
+            session.query(Reminder).filter(
+                Reminder.id.in_(reminder_ids),
+                Reminder.lease_owner == lease_id,
+            ).update(
+                {'leased_until': datetime.now(timezone.utc) + self.lease},
+                synchronize_session=False,
+            )
+
+    def poll(self, context):
+        """Job that runs tick on the dispatcher pool, so the job_queue is not held while a batch
+        is sent. Skipped while the previous tick is still running.
+        """
+        if self._ticking.acquire(blocking=False):
+            context.dispatcher.run_async(self._tick_once)
+
+    def _tick_once(self):
+        try:
+            self.tick()
+        except Exception:
+            logger.exception('Error polling due reminders')
+        finally:
+            self._ticking.release()
+
+    def tick(self, context=None):
+        """Deliver reminders that are due. Returns once the batch was sent, see poll for the job"""
+        lease_id, reminders = self.claim_due(datetime.now(timezone.utc))
+        # Queue the whole batch first so the outbound queue can interleave chats
+        sends = []
+        for reminder in reminders:
+            try:
+                sends.append((reminder, notify(self.bot, reminder.job_context, reminder.id, priority=BULK, block=False)))
+            except Exception:
+                logger.exception(f'Error delivering reminder {reminder.id}')
+
+        delivered = self.drain(lease_id, sends)
+        if delivered:
+            logger.info(f'Delivered {delivered}/{len(reminders)} due reminders')
+        return delivered
+
+    def drain(self, lease_id, sends):
+        """Wait for the sends of a batch and settle the delivered reminders as they go, extending
+        the lease of the rest while they are queued. Returns how many were delivered
+        """
+        delivered = []
+        pending = {}
+        for reminder, sent in sends:
+            if isinstance(sent, Future):
+                pending[sent] = reminder
+            else:
+                # Plain bots send right away
+                delivered.append(reminder)
+        self.settle(lease_id, delivered)
+
+        count = len(delivered)
+        while pending:
+            done, _ = wait(pending, timeout=self.lease.total_seconds() / 2)
+            delivered = []
+            for sent in done:
+                reminder = pending.pop(sent)
+                if sent.exception() is not None:
+                    # Keep the lease. The reminder is retried once it runs out.
+                    logger.error(f'Error delivering reminder {reminder.id}', exc_info=sent.exception())
+                else:
+                    delivered.append(reminder)
+            self.settle(lease_id, delivered)
+            count += len(delivered)
+            if pending:
+                self.extend_lease(lease_id, [reminder.id for reminder in pending.values()])
+        return count
+
+    def settle(self, lease_id, delivered):
+        """Mark delivered reminders as fired, or move the recurring ones to their next occurrence"""
+        fired = [reminder.id for reminder in delivered if not reminder.recurrence]
+        if fired:
+            self.mark_fired(lease_id, fired)
+        for reminder in delivered:
+            if reminder.recurrence:
+                self.advance(lease_id, reminder)
+
+    def advance(self, lease_id, reminder):
+        """Move a delivered recurring reminder to its next occurrence, which releases its lease"""
+        try:
+            next_context, when = next_occurrence_context(reminder.job_context)
+            advance_reminder(reminder.id, reminder_key(next_context), when, next_context, lease_owner=lease_id)
+        except Exception:
+            # Kept leased it would be delivered again every time the lease runs out
+            logger.exception(f'Error scheduling the next occurrence of reminder {reminder.id}. Expiring it')
+            self.mark_fired(lease_id, [reminder.id])
+
+
+def run_worker():
+    scheduler = ReminderScheduler(QueuedBot(os.environ['BOT_KEY']))
+    logger.info(f'Scheduler worker {scheduler.worker_id} polling every {POLL_INTERVAL}s')
+    while True:
+        try:
+            scheduler.tick()
+        except Exception:
+            logger.exception('Error polling due reminders')
+        time.sleep(POLL_INTERVAL)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s [%(funcName)s] %(message)s',
+        level=logging.INFO
+    )
+    run_worker()
@@ -31,13 +31,23 @@ def time_options_keyboard():
     return InlineKeyboardMarkup(buttons)
 
 
+# Callback data of notifications sent before buttons carried the reminder id
 DONE = 'Done'
 REMIND_AGAIN = 'Remind again'
-def done_or_repeat_reminder():
+# Followed by ':<reminder id>'
+DONE_PREFIX = 'done'
+REMIND_AGAIN_PREFIX = 'again'
+
+
+def done_or_repeat_reminder(reminder_id=None):
+    if reminder_id is None:
+        done, remind_again = DONE, REMIND_AGAIN
+    else:
+        done, remind_again = f'{DONE_PREFIX}:{reminder_id}', f'{REMIND_AGAIN_PREFIX}:{reminder_id}'
     buttons = [
         [
-            Button('✅ Done', callback_data=DONE),
-            Button('🔄 Remind again', callback_data=REMIND_AGAIN),
+            Button('✅ Done', callback_data=done),
+            Button('🔄 Remind again', callback_data=remind_again),
         ]
     ]
     return InlineKeyboardMarkup(buttons)
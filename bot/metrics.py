@@ -0,0 +1,318 @@
+"""
+    Metrics in the Prometheus text format, served on METRICS_PORT at /metrics.
+
+    Instrumentation is hooked in from the outside by `instrument`, so handlers, db_ops and
+    persistence don't know about it:
+    - every handler callback, including the ones of each conversation state, is timed
+    - every SQL statement is counted and timed by engine events
+    - each checkpoint of the persistence is timed and sized
+    - JobQueue, outbound queue and db pool figures are read when scraped
+    Delivery lag is observed by `observe_delivery`, once a notification was sent, and
+    compaction runs by `observe_compaction`.
+"""
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import datetime, timezone
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+METRICS_PORT = os.environ.get('METRICS_PORT')
+METRICS_PATH = '/metrics'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LAG_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7)
+# Figures of bot.db.pool_stats and of the lanes of bot.outbound that only ever increase
+POOL_EVENTS = ('connects', 'checkouts', 'checkins', 'invalidated')
+OUTBOUND_RESULTS = ('sent', 'failed', 'retried')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return f'{{{pairs}}}'
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        return lines + list(self.samples())
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._values = defaultdict(float)
+
+    def inc(self, amount=1, **labels):
+        with self._lock:
+            self._values[self._key(labels)] += amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield f'{self.name}{_format_labels(self.labels, key)} {value}'
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        # Per label values: a count per bucket, plus the ones above every bucket, and the sum
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = counts, total + value
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = _format_labels(self.labels + ('le',), key + (bound,))
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.labels, key)
+            yield f'{self.name}_sum{labels} {total}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+
+class CallbackGauge(Metric):
+    """Gauge read when scraped. `read` returns a number, or a dict of label values to numbers"""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, read, labels=()):
+        super().__init__(name, documentation, labels)
+        self.read = read
+
+    def samples(self):
+        try:
+            values = self.read()
+        except Exception:
+            logger.exception(f'Error reading metric {self.name}')
+            return
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in sorted(values.items()):
+            key = key if isinstance(key, tuple) else (key,)
+            yield f'{self.name}{_format_labels(self.labels, key)} {value}'
+
+
+class CallbackCounter(CallbackGauge):
+    """Counter read when scraped, of figures that only ever increase"""
+    kind = 'counter'
+
+
+REGISTRY = []
+
+handler_seconds = Histogram(
+    'bot_handler_seconds', 'Time handlers took to process an update',
+    labels=('conversation', 'state', 'callback'),
+)
+sql_statements = Counter('bot_sql_statements_total', 'SQL statements run', labels=('statement',))
+sql_seconds = Histogram('bot_sql_seconds', 'Time SQL statements took', labels=('statement',))
+delivery_lag = Histogram(
+    'bot_notification_lag_seconds', 'Time from the due time of a reminder to its notification being sent',
+    buckets=LAG_BUCKETS,
+)
+checkpoint_seconds = Histogram('bot_persistence_checkpoint_seconds', 'Time persistence checkpoints took')
+checkpoint_bytes = Histogram(
+    'bot_persistence_checkpoint_bytes', 'Bytes of state written by persistence checkpoints', buckets=SIZE_BUCKETS,
+)
+compaction_rows = Counter(
+    'bot_compaction_rows_total', 'Reminders archived and archived reminders purged by compaction', labels=('action',),
+)
+compaction_seconds = Histogram('bot_compaction_seconds', 'Time compaction runs took', buckets=LAG_BUCKETS)
+
+
+def render():
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+
+def observe_delivery(due):
+    """Record the lag of a notification sent now, of a reminder due at the aware datetime `due`"""
+    delivery_lag.observe(max(0.0, (datetime.now(timezone.utc) - due).total_seconds()))
+
+
+def observe_compaction(stats):
+    compaction_rows.inc(stats['archived'], action='archived')
+    compaction_rows.inc(stats['purged'], action='purged')
+    compaction_seconds.observe(stats['seconds'])
+
+
+def _time_callback(callback, conversation, state):
+    if getattr(callback, 'timed', False):
+        return callback
+    labels = {'conversation': conversation, 'state': state, 'callback': callback.__name__}
+
+    @wraps(callback)
+    def timed_callback(update, context):
+        start = time.perf_counter()
+        try:
+            return callback(update, context)
+        finally:
+            handler_seconds.observe(time.perf_counter() - start, **labels)
+
+    timed_callback.timed = True
+    return timed_callback
+
+
+def instrument_handlers(dispatcher):
+    from bot.utils import wrap_handler_callbacks
+
+    wrap_handler_callbacks(dispatcher, _time_callback)
+
+
+def instrument_sql(engine):
+    from sqlalchemy import event
+
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    def after_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        kind = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''
+        sql_statements.inc(statement=kind)
+        sql_seconds.observe(elapsed, statement=kind)
+
+    event.listen(engine, 'before_cursor_execute', before_execute)
+    event.listen(engine, 'after_cursor_execute', after_execute)
+
+
+def instrument_persistence(persistence):
+    checkpoint = persistence.checkpoint
+
+    @wraps(checkpoint)
+    def timed_checkpoint():
+        written, start = persistence.stats['bytes_written'], time.perf_counter()
+        try:
+            return checkpoint()
+        finally:
+            checkpoint_seconds.observe(time.perf_counter() - start)
+            checkpoint_bytes.observe(persistence.stats['bytes_written'] - written)
+
+    # flush and the checkpointer thread call it through the instance
+    persistence.checkpoint = timed_checkpoint
+    CallbackCounter(
+        'bot_persistence_checkpoints_total', 'Persistence checkpoints by result',
+        lambda: {'ok': persistence.stats['checkpoints'], 'failed': persistence.stats['failed_checkpoints']},
+        labels=('result',),
+    )
+
+
+def instrument(updater):
+    """Instrument the bot built by create_updater and serve metrics on METRICS_PORT"""
+    from bot.db import get_engine, pool_stats
+
+    instrument_handlers(updater.dispatcher)
+    instrument_sql(get_engine())
+    if updater.persistence is not None:
+        instrument_persistence(updater.persistence)
+
+    job_queue = updater.job_queue
+    CallbackGauge('bot_job_queue_depth', 'Jobs waiting on the JobQueue', lambda: job_queue._queue.qsize())
+    instrument_pool(pool_stats)
+    queue = getattr(updater.bot, 'queue', None)
+    if queue is not None:
+        instrument_outbound(queue)
+
+    start_server(int(METRICS_PORT))
+
+
+def instrument_pool(pool_stats):
+    """Figures of bot.db.pool_stats"""
+    CallbackCounter(
+        'bot_db_pool_events_total', 'Connections opened, checked out, checked in and invalidated by the pool',
+        lambda: {event: pool_stats[event] for event in POOL_EVENTS}, labels=('event',),
+    )
+    CallbackCounter(
+        'bot_db_pool_wait_seconds_total', 'Time spent waiting for a pooled connection',
+        lambda: pool_stats['wait_seconds_total'],
+    )
+    CallbackGauge('bot_db_pool_checked_out', 'Connections checked out of the pool', lambda: pool_stats['checked_out'])
+    CallbackGauge(
+        'bot_db_pool_wait_seconds_max', 'Longest wait for a pooled connection', lambda: pool_stats['wait_seconds_max'],
+    )
+
+
+def instrument_outbound(queue):
+    """Figures of the lanes of an OutboundQueue. See bot.outbound"""
+    def lanes():
+        return {lane: stats for lane, stats in queue.stats.items() if isinstance(stats, dict)}
+
+    CallbackGauge('bot_outbound_depth', 'Messages waiting to be sent per lane', queue.depth, labels=('lane',))
+    CallbackCounter(
+        'bot_outbound_messages_total', 'Messages sent, failed and retried per lane',
+        lambda: {(lane, result): stats[result] for lane, stats in lanes().items() for result in OUTBOUND_RESULTS},
+        labels=('lane', 'result'),
+    )
+    CallbackCounter(
+        'bot_outbound_wait_seconds_total', 'Time messages waited to be sent per lane',
+        lambda: {lane: stats['wait_seconds_total'] for lane, stats in lanes().items()}, labels=('lane',),
+    )
+    CallbackGauge(
+        'bot_outbound_wait_seconds_max', 'Longest time a message waited to be sent per lane',
+        lambda: {lane: stats['wait_seconds_max'] for lane, stats in lanes().items()}, labels=('lane',),
+    )
+    CallbackCounter(
+        'bot_outbound_retry_after_total', 'Times Telegram flood control paused sending',
+        lambda: queue.stats['retry_after'],
+    )
+
+
+def start_server(port, address='0.0.0.0'):
+    # Only imported when metrics are served. See benchmarks/startup.py
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != METRICS_PATH:
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f'Serving metrics on {address}:{port}{METRICS_PATH}')
+    return server
@@ -0,0 +1,260 @@
+"""
+    Outbound message queue that keeps the bot under Telegram flood limits.
+
+    Messages go through a global token bucket and a token bucket per chat, on a single sender
+    thread. Interactive replies are sent ahead of bulk notifications, and a chat that is over
+    its limit does not hold back messages to other chats. When Telegram still answers with a
+    RetryAfter, sending pauses for as long as asked and the message is retried.
+"""
+import functools
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+from telegram import Bot
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE, BULK = 0, 1
+LANES = {INTERACTIVE: 'interactive', BULK: 'bulk'}
+
+# https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+GLOBAL_RATE = float(os.environ.get('OUTBOUND_GLOBAL_RATE', 30))
+CHAT_RATE = float(os.environ.get('OUTBOUND_CHAT_RATE', 1))
+CHAT_BURST = int(os.environ.get('OUTBOUND_CHAT_BURST', 3))
+GROUP_RATE = float(os.environ.get('OUTBOUND_GROUP_RATE_PER_MINUTE', 20)) / 60
+MAX_RETRIES = 3
+# Idle chat buckets are dropped once there are more than these
+MAX_TRACKED_CHATS = 10000
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available"""
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Outgoing(object):
+    def __init__(self, send, chat_id, priority, seq, now):
+        self.send = send
+        self.chat_id = chat_id
+        self.priority = priority
+        self.seq = seq
+        self.enqueued_at = now
+        self.attempts = 0
+        self.future = Future()
+
+
+def _is_group(chat_id):
+    try:
+        return int(chat_id) < 0
+    except (TypeError, ValueError):
+        # @channelusername
+        return True
+
+
+class OutboundQueue(object):
+    """Send messages on a background thread without exceeding Telegram limits.
+
+    `submit` returns a Future with the result of the send. `stats` holds counters per lane,
+    and `depth()` the messages waiting on each lane.
+    """
+
+    def __init__(self, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE, chat_burst=CHAT_BURST,
+                 group_rate=GROUP_RATE, clock=time.monotonic):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.clock = clock
+        self._global = TokenBucket(global_rate, global_rate, clock())
+        self._chats = {}
+        self._ready = []
+        self._deferred = []
+        self._paused_until = 0
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._running = True
+        self.stats = {
+            lane: {'sent': 0, 'failed': 0, 'retried': 0, 'wait_seconds_total': 0.0, 'wait_seconds_max': 0.0}
+            for lane in LANES.values()
+        }
+        self.stats['retry_after'] = 0
+        self._thread = threading.Thread(target=self._run, name='outbound-queue', daemon=True)
+        self._thread.start()
+
+    def submit(self, send, chat_id, priority=INTERACTIVE):
+        """Queue a call that sends a message to chat_id"""
+        with self._cond:
+            if not self._running:
+                raise RuntimeError('Outbound queue is stopped')
+            item = _Outgoing(send, chat_id, priority, next(self._seq), self.clock())
+            heapq.heappush(self._ready, (priority, item.seq, item))
+            self._cond.notify()
+        return item.future
+
+    def depth(self):
+        with self._cond:
+            waiting = [item for *_, item in self._ready + self._deferred]
+        return {name: sum(item.priority == lane for item in waiting) for lane, name in LANES.items()}
+
+    def stop(self, timeout=10):
+        """Stop accepting messages and wait up to timeout seconds for queued ones to be sent"""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join(timeout)
+        pending = sum(self.depth().values())
+        if pending:
+            logger.warning(f'Outbound queue stopped with {pending} unsent messages')
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= MAX_TRACKED_CHATS:
+                self._chats = {chat: b for chat, b in self._chats.items() if not b.is_full(now)}
+            if _is_group(chat_id):
+                bucket = TokenBucket(self.group_rate, self.chat_burst, now)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst, now)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _next(self, now):
+        """Pop the next message that can be sent now. Otherwise return how long to wait"""
+        if now < self._paused_until:
+            return None, self._paused_until - now
+
+        while self._deferred and self._deferred[0][0] <= now:
+            _, _, item = heapq.heappop(self._deferred)
+            heapq.heappush(self._ready, (item.priority, item.seq, item))
+
+        while self._ready:
+            global_wait = self._global.wait_time(now)
+            if global_wait:
+                return None, global_wait
+
+            _, _, item = heapq.heappop(self._ready)
+            chat = self._chat_bucket(item.chat_id, now)
+            chat_wait = chat.wait_time(now)
+            if chat_wait:
+                # Let other chats go ahead meanwhile
+                heapq.heappush(self._deferred, (now + chat_wait, item.seq, item))
+                continue
+
+            self._global.take(now)
+            chat.take(now)
+            return item, None
+
+        return None, (self._deferred[0][0] - now if self._deferred else None)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                item, wait = self._next(self.clock())
+                while item is None:
+                    if not self._running and not self._ready and not self._deferred:
+                        return
+                    self._cond.wait(wait)
+                    item, wait = self._next(self.clock())
+            self._send(item)
+
+    def _send(self, item):
+        lane = self.stats[LANES[item.priority]]
+        waited = self.clock() - item.enqueued_at
+        item.attempts += 1
+        try:
+            result = item.send()
+        except RetryAfter as e:
+            with self._cond:
+                self.stats['retry_after'] += 1
+                self._paused_until = max(self._paused_until, self.clock() + e.retry_after)
+                if item.attempts <= MAX_RETRIES:
+                    lane['retried'] += 1
+                    heapq.heappush(self._ready, (item.priority, item.seq, item))
+                    logger.warning(f'Flood limit hit. Pausing outbound messages for {e.retry_after}s')
+                    return
+            lane['failed'] += 1
+            item.future.set_exception(e)
+        except Exception as e:
+            lane['failed'] += 1
+            logger.warning(f'Error sending message to {item.chat_id}: {e!r}')
+            item.future.set_exception(e)
+        else:
+            lane['sent'] += 1
+            lane['wait_seconds_total'] += waited
+            lane['wait_seconds_max'] = max(lane['wait_seconds_max'], waited)
+            item.future.set_result(result)
+
+
+class QueuedBot(Bot):
+    """Bot that sends messages through an OutboundQueue.
+
+    send_message and edit_message_text take two extra keyword arguments. `priority` is the
+    lane of the message, INTERACTIVE by default. With `block=False` they return a Future
+    instead of waiting for the message to be sent.
+    """
+
+    def __init__(self, *args, queue=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.queue = queue or OutboundQueue()
+
+    def _queued(self, send, chat_id, priority, block):
+        sent = self.queue.submit(send, chat_id, priority)
+        return sent.result() if block else sent
+
+    def send_message(self, chat_id, *args, priority=INTERACTIVE, block=True, **kwargs):
+        send = functools.partial(super().send_message, chat_id, *args, **kwargs)
+        return self._queued(send, chat_id, priority, block)
+
+    def edit_message_text(self, *args, priority=INTERACTIVE, block=True, **kwargs):
+        send = functools.partial(super().edit_message_text, *args, **kwargs)
+        return self._queued(send, kwargs.get('chat_id'), priority, block)
+
+
+def send_message(bot, *args, priority=INTERACTIVE, block=True, **kwargs):
+    """bot.send_message with a priority and block, on a QueuedBot. A plain Bot sends right away"""
+    if isinstance(bot, QueuedBot):
+        return bot.send_message(*args, priority=priority, block=block, **kwargs)
+    return bot.send_message(*args, **kwargs)
+
+
+def wait_sent(sent):
+    """Result of a message sent with block=False, on a QueuedBot or on a plain Bot"""
+    return sent.result() if isinstance(sent, Future) else sent
+
+
+def on_sent(sent, callback):
+    """Call callback once a message sent with block=False was delivered, on a QueuedBot or on a plain Bot"""
+    if not isinstance(sent, Future):
+        callback()
+        return
+
+    def delivered(future):
+        if future.exception() is None:
+            callback()
+
+    sent.add_done_callback(delivered)
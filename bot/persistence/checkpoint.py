@@ -0,0 +1,104 @@
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger('checkpoint')
+
+
+class StateJournal(object):
+    """Append-only journal of state changes that were not checkpointed to the db yet.
+
+    Every change is appended as a json line to `path`. When a checkpoint starts the journal
+    is rotated to `path.pending`, so new changes keep landing on a fresh file while the
+    checkpoint is written. Once the checkpoint is committed the pending file is discarded,
+    so recovery only has to replay the changes made after the last successful checkpoint.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pending_path = f'{path}.pending'
+        self.bytes_written = 0
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def append(self, kind, key, blob):
+        """Append the already json encoded `blob` of a changed entity"""
+        line = f'{{"kind": {json.dumps(kind)}, "key": {json.dumps(key)}, "data": {blob}}}\n'
+        self._file.write(line)
+        self._file.flush()
+        self.bytes_written += len(line)
+
+    def rotate(self):
+        """Move current entries to the pending file. A failed previous checkpoint keeps its entries"""
+        self._file.close()
+        if os.path.exists(self.pending_path):
+            with open(self.path, encoding='utf-8') as current, \
+                    open(self.pending_path, 'a', encoding='utf-8') as pending:
+                pending.write(current.read())
+            os.remove(self.path)
+        else:
+            os.replace(self.path, self.pending_path)
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def discard_pending(self):
+        if os.path.exists(self.pending_path):
+            os.remove(self.pending_path)
+
+    def replay(self):
+        """Yield (kind, key, data) of every journaled change, oldest first"""
+        for path in (self.pending_path, self.path):
+            if not os.path.exists(path):
+                continue
+            with open(path, encoding='utf-8') as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A crash in the middle of an append leaves a truncated last line
+                        logger.warning(f'Skipping corrupt journal line in {path}')
+                        continue
+                    yield entry['kind'], entry['key'], entry['data']
+
+    def close(self):
+        self._file.close()
+
+
+class Checkpointer(threading.Thread):
+    """Background thread that checkpoints dirty persistence state.
+
+    A checkpoint runs every `interval` seconds, or as soon as `max_changes` changes
+    were notified since the previous one.
+    """
+
+    def __init__(self, persistence, interval, max_changes):
+        super().__init__(name='state-checkpointer', daemon=True)
+        self.persistence = persistence
+        self.interval = interval
+        self.max_changes = max_changes
+        self._changes = 0
+        self._wake = threading.Event()
+        self._running = True
+
+    def notify_change(self):
+        self._changes += 1
+        if self._changes >= self.max_changes:
+            self._wake.set()
+
+    def run(self):
+        logger.info(f'Checkpointing state every {self.interval}s or {self.max_changes} changes')
+        while self._running:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if not self._running:
+                break
+            self._changes = 0
+            try:
+                self.persistence.checkpoint()
+            except Exception:
+                logger.exception('Unexpected error on state checkpoint')
+
+    def stop(self):
+        self._running = False
+        self._wake.set()
+        if self.is_alive():
+            self.join()
@@ -1,81 +1,160 @@
 import ast
-import copy
 import json
 import logging
+import threading
+import time
 from collections import defaultdict
 
+from sqlalchemy import text
 from telegram.ext import BasePersistence
+from telegram.utils.promise import Promise
 
-from bot.persistence.db import PSQLDatabase as Database
+from bot.db import transaction
+from bot.persistence.checkpoint import Checkpointer, StateJournal
+from bot.persistence.store import EntityStore
+from bot.sharding import SHARD_COUNT, SHARD_INDEX, conversation_owner, owned_by_shard, owns
 
 
 logger = logging.getLogger('psqlpersistence')
 
+UPSERT_USER = text(
+    "INSERT INTO user_state (user_id, data) VALUES (:id, :data) "
+    "ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data"
+)
+UPSERT_CHAT = text(
+    "INSERT INTO chat_state (chat_id, data) VALUES (:id, :data) "
+    "ON CONFLICT (chat_id) DO UPDATE SET data = EXCLUDED.data"
+)
+UPSERT_CONVERSATION = text(
+    "INSERT INTO conversation_state (name, key, user_id, state) VALUES (:name, :key, :user_id, :state) "
+    "ON CONFLICT (name, key) DO UPDATE SET user_id = EXCLUDED.user_id, state = EXCLUDED.state"
+)
+DELETE_CONVERSATION = text("DELETE FROM conversation_state WHERE name = :name AND key = :key")
+ENDED_CONVERSATION = 'null'
+
 
 class PSQLPersistence(BasePersistence):
-    def __init__(self, db_name):
+    """Bot persistence that stores one row per user, chat and conversation key.
+
+    Updates only mark the touched entity as dirty, so a checkpoint upserts just the rows
+    that changed since the previous one instead of rewriting the whole bot state.
+
+    If a `journal_path` is given every change is also appended to a local journal, which is
+    replayed on load to recover the changes a crash prevented from being checkpointed.
+    """
+    def __init__(self, journal_path=None):
         super().__init__()
-        self.db_name = db_name
-        self._state = None
-        self._chat_data = None
-        self._user_data = None
-        self._conv_data = None
+        self._lock = threading.RLock()
+        self._journal = StateJournal(journal_path) if journal_path else None
+        self._checkpointer = None
+        self.stats = {
+            'checkpoints': 0,
+            'failed_checkpoints': 0,
+            'last_checkpoint_seconds': 0.0,
+            'total_checkpoint_seconds': 0.0,
+            'bytes_written': 0,
+        }
+        self._users = EntityStore()
+        self._chats = EntityStore()
+        self._conversations = defaultdict(EntityStore)
         self._loaded_data = False
 
     def _load_state_from_db(self):
-        """Querys the db and load bot state into memory"""
-        logger.info("Loading state from db..")
+        """Querys the db and load bot state into memory.
+
+        Rows are read as text and kept serialized until the dispatcher asks for them.
+        When sharded, only the rows of this shard's users are loaded.
+        """
+        logger.info(f"Loading state of shard {SHARD_INDEX + 1}/{SHARD_COUNT} from db..")
         try:
-            with Database(self.db_name) as db:
-                db.query("SELECT info FROM state")
-                state = db.fetchone()
-                logger.info('State from db: \n%s', state)
-                self._state = state[0] if state else {}
-                self._chat_data = defaultdict(dict, self._remap_chat_keys(self._state.get('chat_data', {})))
-                self._user_data = defaultdict(dict, self._remap_user_keys(self._state.get('user_data', {})))
-                self._conv_data = self._remap_conv_keys(defaultdict(dict, self._state.get('conv_data', {})))
-                self._loaded_data = True
-                db.commit()
+            with transaction() as conn:
+                self._migrate_legacy_state(conn)
+
+                users = conn.execute(text(
+                    f"SELECT user_id, CAST(data AS TEXT) FROM user_state WHERE {owned_by_shard('user_id')}"
+                ))
+                for user_id, blob in users:
+                    self._users.load(user_id, blob)
+
+                chats = conn.execute(text(
+                    f"SELECT chat_id, CAST(data AS TEXT) FROM chat_state WHERE {owned_by_shard('chat_id')}"
+                ))
+                for chat_id, blob in chats:
+                    self._chats.load(chat_id, blob)
+
+                # Rows stored by versions that did not record the user are told apart by key
+                rows = conn.execute(text(
+                    "SELECT name, key, user_id, CAST(state AS TEXT) FROM conversation_state"
+                    f" WHERE {owned_by_shard('user_id')} OR user_id IS NULL"
+                ))
+                for name, key, user_id, blob in rows:
+                    key = ast.literal_eval(key)
+                    if user_id is not None or owns(conversation_owner(key)):
+                        self._conversations[name].load(key, blob)
+
+            logger.info(f'Loaded {len(self._users)} users, {len(self._chats)} chats'
+                        f' and {len(self._conversations)} conversations from db')
+            self._replay_journal()
+            self._loaded_data = True
 
         except Exception:
             logger.error('Error loading state from db', exc_info=True)
-            self._chat_data, self._user_data, self._conv_data = defaultdict(dict), defaultdict(dict), defaultdict(dict)
+            self._users, self._chats, self._conversations = EntityStore(), EntityStore(), defaultdict(EntityStore)
             self._loaded_data = False
 
-    @staticmethod
-    def _remap_chat_keys(chat_data):
-        """Transforms user_data user_id keys to ints as expected by handler.py on line 120"""
-        return PSQLPersistence.key_mapper(int, chat_data)
+    def _replay_journal(self):
+        """Apply changes that were journaled but not checkpointed before the last shutdown"""
+        if self._journal is None:
+            return
 
-    @staticmethod
-    def _remap_user_keys(user_data):
-        """Transforms user_data user_id keys to ints as expected by handler.py on line 120"""
-        return PSQLPersistence.key_mapper(int, user_data)
+        replayed = 0
+        for kind, key, data in self._journal.replay():
+            if kind == 'user':
+                self._users.put(key, data)
+            elif kind == 'chat':
+                self._chats.put(key, data)
+            elif kind == 'conversation':
+                self._conversations[key[0]].put(ast.literal_eval(key[1]), data)
+            replayed += 1
 
-    @staticmethod
-    def _remap_conv_keys(all_conversations):
-        """Restore json key tuples from jsonification.
-            '(1, 2)' -> (1, 2). That is, str -> tuple
-        """
-        return PSQLPersistence.remap_nested_keys(ast.literal_eval, all_conversations)
+        logger.info(f'Replayed {replayed} journaled changes')
 
     @staticmethod
-    def _dump_conv_keys(all_conversations):
-        """Dump conversations tuple keys so they can be stored as json.
-
-        They are then remapped to the original tuples by ast.literal_eval
-        so that (1, 2) -> '(1, 2)'. That is, tuple -> str
+    def _migrate_legacy_state(conn):
+        """Move the legacy single-row json blob in `state` into per-entity rows.
 
+        The blob is removed on the same transaction, so the migration only ever runs once.
         """
-        return PSQLPersistence.remap_nested_keys(str, all_conversations)
+        info = conn.execute(text("SELECT info FROM state")).scalar()
+        if not info:
+            return
+
+        logger.info('Migrating legacy state blob into per-entity rows..')
+        users = PSQLPersistence._remap_user_keys(info.get('user_data', {}))
+        chats = PSQLPersistence._remap_chat_keys(info.get('chat_data', {}))
+        PSQLPersistence._write_rows(conn, (
+            [(user_id, json.dumps(data)) for user_id, data in users.items()],
+            [(chat_id, json.dumps(data)) for chat_id, data in chats.items()],
+            [
+                (name, key, conversation_owner(ast.literal_eval(key)), json.dumps(state))
+                for name, conversations in info.get('conv_data', {}).items()
+                for key, state in conversations.items()
+                if state is not None
+            ],
+            [],
+        ))
+        conn.execute(text("DELETE FROM state"))
+        logger.info(f'Migrated {len(users)} users and {len(chats)} chats from legacy state')
 
     @staticmethod
-    def remap_nested_keys(remap_func, nested_iterable):
-        remapped_iterable = copy.deepcopy(nested_iterable)
-        for conv_name, conversations in nested_iterable.items():
-            remapped_iterable[conv_name] = PSQLPersistence.key_mapper(remap_func, conversations)
+    def _remap_chat_keys(chat_data):
+        """Transforms user_data user_id keys to ints as expected by handler.py on line 120"""
+        return PSQLPersistence.key_mapper(int, chat_data)
 
-        return remapped_iterable
+    @staticmethod
+    def _remap_user_keys(user_data):
+        """Transforms user_data user_id keys to ints as expected by handler.py on line 120"""
+        return PSQLPersistence.key_mapper(int, user_data)
 
     @staticmethod
     def key_mapper(map_func, iterable):
@@ -94,24 +173,23 @@ class PSQLPersistence(BasePersistence):
         if not self._loaded_data:
             self._load_state_from_db()
 
-        logger.info(f'User Data: {self._user_data}')
-        return copy.deepcopy(self._user_data)
+        logger.info(f'Restoring data of {len(self._users)} users')
+        return defaultdict(dict, self._users.materialize())
 
     def get_chat_data(self):
         if not self._loaded_data:
             self._load_state_from_db()
 
-        logger.info(f'Chat Data: {self._chat_data}')
-        return copy.deepcopy(self._chat_data)
+        logger.info(f'Restoring data of {len(self._chats)} chats')
+        return defaultdict(dict, self._chats.materialize())
 
     def get_conversations(self, name):
-        logger.info(f"Getting '{name}' conversation..")
         if not self._loaded_data:
             self._load_state_from_db()
 
-        conversation = self._conv_data.get(name, {})
-        logger.info(f"'{name}' data: {conversation}")
-        return copy.deepcopy(conversation)
+        conversation = self._conversations[name].materialize()
+        logger.info(f"Restoring {len(conversation)} '{name}' conversations")
+        return conversation
 
     def update_conversation(self, name, key, new_state):
         """Will be called when a :attr:`telegram.ext.ConversationHandler.update_state`
@@ -122,10 +200,15 @@ class PSQLPersistence(BasePersistence):
             key (:obj:`tuple`): The key of the conversation to be updated.
             new_state (:obj:`tuple` | :obj:`any`): The new state for the given key.
         """
-        # map ints to strings to allow json dumping
-        if self._conv_data.setdefault(name, {}).get(key) == new_state:
-            return
-        self._conv_data[name][key] = new_state
+        while isinstance(new_state, tuple) and len(new_state) == 2 and isinstance(new_state[1], Promise):
+            # A concurrent handler is still running. Keep the state it started from until
+            # the conversation handler stores the state it returned.
+            # PTB 12 passes (current state, promise) where current state is (old state, promise)
+            new_state = new_state[0]
+        with self._lock:
+            blob = self._conversations[name].put(key, new_state)
+            if blob is not None:
+                self._record_change('conversation', [name, str(key)], blob)
 
     def update_user_data(self, user_id, data):
         """Will be called by the :class:`telegram.ext.Dispatcher` after a handler has
@@ -135,10 +218,10 @@ class PSQLPersistence(BasePersistence):
             user_id (:obj:`int`): The user the data might have been changed for.
             data (:obj:`dict`): The :attr:`telegram.ext.dispatcher.user_data`[user_id].
         """
-        user_id_str = str(user_id)
-        if self._user_data.get(user_id_str) == data:
-            return
-        self._user_data[user_id_str] = data
+        with self._lock:
+            blob = self._users.put(user_id, data)
+            if blob is not None:
+                self._record_change('user', user_id, blob)
 
     def update_chat_data(self, chat_id, data):
         """Will be called by the :class:`telegram.ext.Dispatcher` after a handler has
@@ -148,33 +231,110 @@ class PSQLPersistence(BasePersistence):
             chat_id (:obj:`int`): The chat the data might have been changed for.
             data (:obj:`dict`): The :attr:`telegram.ext.dispatcher.chat_data`[user_id].
         """
-        chat_id_str = str(chat_id)
-        if self._chat_data.get(chat_id_str) == data:
-            return
-        self._chat_data[chat_id_str] = data
+        with self._lock:
+            blob = self._chats.put(chat_id, data)
+            if blob is not None:
+                self._record_change('chat', chat_id, blob)
 
-    def _dump_state_to_json(self):
-        state = {
-            'chat_data': self._chat_data,
-            'user_data': self._user_data,
-            'conv_data': PSQLPersistence._dump_conv_keys(self._conv_data),
-        }
-        logger.info('Dumping %s', state)
+    def _record_change(self, kind, key, blob):
+        if self._journal is not None:
+            self._journal.append(kind, key, blob)
+        if self._checkpointer is not None:
+            self._checkpointer.notify_change()
+
+    def _collect_dirty_rows(self):
+        """Collect every user, chat and conversation that changed since the last checkpoint.
 
-        return json.dumps(state)
+        Conversations that ended are collected apart to be deleted instead of stored.
+        """
+        users = self._users.take_dirty()
+        chats = self._chats.take_dirty()
+        ended, ongoing = [], []
+        for name, store in self._conversations.items():
+            for key, blob in store.take_dirty():
+                if blob == ENDED_CONVERSATION:
+                    ended.append((name, str(key)))
+                else:
+                    ongoing.append((name, str(key), conversation_owner(key), blob))
+
+        return users, chats, ongoing, ended
+
+    def _restore_dirty_rows(self, rows):
+        users, chats, ongoing, ended = rows
+        self._users.mark_dirty(user_id for user_id, _ in users)
+        self._chats.mark_dirty(chat_id for chat_id, _ in chats)
+        for name, key, *_ in ongoing + ended:
+            self._conversations[name].mark_dirty([ast.literal_eval(key)])
+
+    @staticmethod
+    def _write_rows(conn, rows):
+        users, chats, ongoing, ended = rows
+        # Empty parameter lists would run the statement once without parameters
+        if users:
+            conn.execute(UPSERT_USER, [{'id': user_id, 'data': blob} for user_id, blob in users])
+        if chats:
+            conn.execute(UPSERT_CHAT, [{'id': chat_id, 'data': blob} for chat_id, blob in chats])
+        if ongoing:
+            conn.execute(UPSERT_CONVERSATION, [
+                {'name': name, 'key': key, 'user_id': user_id, 'state': blob} for name, key, user_id, blob in ongoing
+            ])
+        if ended:
+            conn.execute(DELETE_CONVERSATION, [{'name': name, 'key': key} for name, key in ended])
+
+    def checkpoint(self):
+        """Write dirty state to the db. Returns whether the state is safely stored.
+
+        Rows are collected under the lock but written outside it, so handlers are not blocked
+        on the db. If the write fails the rows are marked dirty again and the journal is kept.
+        """
+        with self._lock:
+            rows = self._collect_dirty_rows()
+            if self._journal is not None:
+                self._journal.rotate()
+
+        users, chats, ongoing, ended = rows
+        if not any(rows):
+            if self._journal is not None:
+                self._journal.discard_pending()
+            return True
+
+        start = time.perf_counter()
+        try:
+            with transaction() as conn:
+                self._write_rows(conn, rows)
+        except Exception:
+            logger.exception("Error saving bot state. Will retry on next checkpoint")
+            with self._lock:
+                self._restore_dirty_rows(rows)
+            self.stats['failed_checkpoints'] += 1
+            return False
+
+        elapsed = time.perf_counter() - start
+        if self._journal is not None:
+            self._journal.discard_pending()
+        self.stats['checkpoints'] += 1
+        self.stats['last_checkpoint_seconds'] = elapsed
+        self.stats['total_checkpoint_seconds'] += elapsed
+        self.stats['bytes_written'] += sum(len(row[-1]) for row in users + chats + ongoing)
+        logger.info(f'Checkpointed {len(users)} users, {len(chats)} chats, {len(ongoing)} conversations'
+                    f' and deleted {len(ended)} ended conversations in {elapsed:.3f}s')
+        return True
+
+    def start_checkpointing(self, interval, max_changes):
+        """Periodically checkpoint dirty state on a background thread"""
+        self._checkpointer = Checkpointer(self, interval, max_changes)
+        self._checkpointer.start()
 
     def flush(self):
         """Be sure to dump latest data before bot shutdown"""
         logger.info('Saving bot state before shutdown..')
-        with Database(self.db_name) as db:
-            try:
-                db.query("DELETE FROM state")
-                db.query("INSERT INTO state (info) VALUES ('%s')" % self._dump_state_to_json())
-                db.commit()
-            except Exception:
-                logger.exception("Error saving bot state. Bot will not remember latest interactions")
-            else:
-                logger.info('SUCCESS. Bot state saved into db')
-
-
-        logger.info('Closing database..')
+        if self._checkpointer is not None:
+            self._checkpointer.stop()
+
+        if self.checkpoint():
+            logger.info('SUCCESS. Bot state saved into db')
+        else:
+            logger.error('Bot will not remember latest interactions until journal is replayed')
+
+        if self._journal is not None:
+            self._journal.close()
@@ -0,0 +1,43 @@
+import json
+
+
+class EntityStore(object):
+    """Copy-on-write store of user, chat or conversation state.
+
+    Entities are kept as their json serialization, which is what ends up in the db anyway.
+    Strings are immutable, so the store never shares mutable state with the dispatcher and
+    nothing has to be deep copied: readers get freshly decoded objects and writers replace
+    the blob of a single entity only when its serialization changed.
+    """
+
+    def __init__(self):
+        self._blobs = {}
+        self._dirty = set()
+
+    def __len__(self):
+        return len(self._blobs)
+
+    def load(self, key, blob):
+        """Store a blob as read from the db, without marking it dirty"""
+        self._blobs[key] = blob
+
+    def put(self, key, data):
+        """Store `data` under `key`. Returns the new blob, or None if nothing changed"""
+        blob = json.dumps(data)
+        if self._blobs.get(key) == blob:
+            return None
+        self._blobs[key] = blob
+        self._dirty.add(key)
+        return blob
+
+    def materialize(self):
+        return {key: json.loads(blob) for key, blob in self._blobs.items()}
+
+    def take_dirty(self):
+        """Return (key, blob) of entities changed since the last call and clear them"""
+        dirty = [(key, self._blobs[key]) for key in self._dirty]
+        self._dirty.clear()
+        return dirty
+
+    def mark_dirty(self, keys):
+        self._dirty.update(keys)
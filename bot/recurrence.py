@@ -0,0 +1,158 @@
+"""
+    Recurrence rules of repeating reminders.
+
+    A recurring reminder is a single row whose remind_time is its next occurrence. When it
+    fires, the occurrence after it is computed from the rule and the row moves forward.
+
+    Rules are stored as
+        'every <seconds>'              a fixed interval
+        'cron <m> <h> <dom> <mon> <dow>'  a cron expression, on the user's local time
+"""
+import re
+from datetime import datetime, timedelta, timezone
+
+EVERY, CRON = 'every', 'cron'
+# Far enough for rules like the 29th of February
+MAX_CRON_DAYS = 8 * 366
+
+UNITS = {'m': 60, 'min': 60, 'h': 3600, 'd': 24 * 3600}
+CRON_FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+DAYS = {
+    'day': '*', 'daily': '*', 'weekdays': '1-5', 'weekends': '0,6',
+    'sunday': '0', 'monday': '1', 'tuesday': '2', 'wednesday': '3',
+    'thursday': '4', 'friday': '5', 'saturday': '6',
+}
+DAY_NAMES = {'*': 'day', '1-5': 'weekday', '0,6': 'weekend day', **{
+    dow: name for name, dow in DAYS.items() if name not in ('day', 'daily', 'weekdays', 'weekends')
+}}
+
+
+class InvalidRule(ValueError):
+    pass
+
+
+def parse_rule(text):
+    """Turn what users write into a stored rule.
+
+    Understands `2h`, `30m`, `3d`, `day 9:00`, `weekdays 8:30`, `monday 10:00` and
+    `cron 0 9 * * 1`. Stored rules, like the ones of exported reminders, are taken as they are.
+    """
+    text = ' '.join(text.lower().split())
+    interval = re.fullmatch(r'(\d+) ?(m|min|h|d)', text)
+    stored_interval = re.fullmatch(rf'{EVERY} (\d+)', text)
+    if interval or stored_interval:
+        seconds = int(interval.group(1)) * UNITS[interval.group(2)] if interval else int(stored_interval.group(1))
+        if seconds < 60:
+            raise InvalidRule('Reminders can repeat at most every minute')
+        return f'{EVERY} {seconds}'
+
+    if text.startswith(f'{CRON} '):
+        rule = f'{CRON} {text[len(CRON) + 1:]}'
+        # Rejects valid fields that never happen together, like the 31st of February
+        _next_cron(rule, datetime.utcnow())
+        return rule
+
+    days, _, at = text.rpartition(' ')
+    time_match = re.fullmatch(r'(\d{1,2})[:.](\d{2})', at)
+    dow = DAYS.get(days)
+    if time_match is None or dow is None:
+        raise InvalidRule(f'Unknown repetition {text!r}')
+    hour, minute = int(time_match.group(1)), int(time_match.group(2))
+    if hour > 23 or minute > 59:
+        raise InvalidRule(f'Invalid time {at!r}')
+    return f'{CRON} {minute} {hour} * * {dow}'
+
+
+def _cron_field(field, low, high):
+    values = set()
+    for part in field.split(','):
+        value_range, _, step = part.partition('/')
+        if value_range == '*':
+            start, end = low, high
+        elif '-' in value_range:
+            start, end = map(int, value_range.split('-'))
+        else:
+            start = end = int(value_range)
+        if step and value_range != '*' and '-' not in value_range:
+            end = high
+        if not low <= start <= end <= high:
+            raise InvalidRule(f'{part!r} out of range {low}-{high}')
+        values.update(range(start, end + 1, int(step) if step else 1))
+    return values
+
+
+def _cron_sets(rule):
+    fields = rule.split()[1:]
+    if len(fields) != 5:
+        raise InvalidRule('Cron rules have 5 fields: minute hour day-of-month month day-of-week')
+    try:
+        sets = [_cron_field(field, low, high) for field, (low, high) in zip(fields, CRON_FIELDS)]
+    except ValueError as e:
+        raise InvalidRule(f'Invalid cron rule {rule!r}') from e
+    # Sunday is both 0 and 7
+    weekdays = sets[4]
+    if 7 in weekdays:
+        weekdays.discard(7)
+        weekdays.add(0)
+    return sets
+
+
+def _next_cron(rule, after):
+    """First minute after `after` matching the cron rule. Times are naive local times"""
+    minutes, hours, days, months, weekdays = _cron_sets(rule)
+    dom_restricted, dow_restricted = rule.split()[3] != '*', rule.split()[5] != '*'
+
+    day = after.replace(hour=0, minute=0, second=0, microsecond=0)
+    for _ in range(MAX_CRON_DAYS):
+        if day.month in months:
+            dom_match, dow_match = day.day in days, (day.weekday() + 1) % 7 in weekdays
+            if dom_restricted and dow_restricted:
+                # Like cron, a day matches either restriction when both are given
+                day_matches = dom_match or dow_match
+            else:
+                day_matches = dom_match and dow_match
+            if day_matches:
+                for hour in sorted(hours):
+                    for minute in sorted(minutes):
+                        candidate = day.replace(hour=hour, minute=minute)
+                        if candidate > after:
+                            return candidate
+        day += timedelta(days=1)
+    raise InvalidRule(f'{rule!r} never happens')
+
+
+def next_occurrence(rule, previous, offset, now=None):
+    """Next occurrence of rule after both the previous one and now, as an aware utc datetime.
+
+    `offset` is the user's utc offset in seconds. Occurrences missed while the bot was down
+    are skipped.
+    """
+    now = now or datetime.now(timezone.utc)
+    if previous.tzinfo is None:
+        previous = previous.replace(tzinfo=timezone.utc)
+
+    kind, _, spec = rule.partition(' ')
+    if kind == EVERY:
+        interval = timedelta(seconds=int(spec))
+        missed = max(0, (now - previous) // interval)
+        return previous + (missed + 1) * interval
+
+    local_after = (max(previous, now) + timedelta(seconds=offset)).replace(tzinfo=None)
+    local = _next_cron(rule, local_after)
+    return (local - timedelta(seconds=offset)).replace(tzinfo=timezone.utc)
+
+
+def describe(rule):
+    kind, _, spec = rule.partition(' ')
+    if kind == EVERY:
+        seconds = int(spec)
+        for unit, size in (('d', 86400), ('h', 3600)):
+            if seconds % size == 0:
+                return f'every {seconds // size}{unit}'
+        return f'every {seconds // 60}m'
+
+    minute, hour, dom, month, dow = spec.split()
+    if dom == month == '*' and dow in DAY_NAMES and minute.isdigit() and hour.isdigit():
+        # Rules written as `weekdays 8:30`
+        return f'every {DAY_NAMES[dow]} at {int(hour)}:{int(minute):02}'
+    return rule
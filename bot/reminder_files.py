@@ -0,0 +1,275 @@
+"""
+    Reminders as .ics and .csv files.
+
+    Files are read as a stream of lines and yield one Entry per reminder, so however big a
+    file is only the entry being read is held in memory. Entries carry the date as written:
+    aware if the file says its timezone, naive if it is in the user's time.
+
+    CSV files have a text and a date column, and optionally a recurrence one with a /every
+    rule. A header row naming them is optional. Dates are isoformat, like 2024-05-01 09:30,
+    or dd/mm/yyyy hh:mm. Of iCalendar files the SUMMARY and DTSTART of every VEVENT are read.
+    Repeating events are read as their first occurrence.
+
+    Exports are written the other way around, as chunks of text of a few hundred reminders.
+    Exported csv files can be imported back.
+"""
+import csv
+import io
+import re
+from collections import namedtuple
+from datetime import datetime, timezone
+from functools import lru_cache
+
+from bot.recurrence import InvalidRule, describe, parse_rule
+from bot.utils import user_time_from_utc
+
+# Entries with an error are not valid reminders. The error says why, to the user
+Entry = namedtuple('Entry', 'line text when recurrence error')
+
+CSV, ICS = 'csv', 'ics'
+CSV_COLUMNS = ('text', 'date', 'recurrence')
+CSV_DATE_FORMATS = ('%d/%m/%Y %H:%M', '%d/%m/%Y')
+CSV_EXPORT_COLUMNS = ('text', 'date', 'recurrence', 'status')
+# Reminders written per chunk of an export
+CHUNK_ROWS = 500
+# Time of the day reminders of date-only rows and all-day events are set at
+ALL_DAY_HOUR = 9
+ICS_ESCAPE = re.compile(r'\\(.)')
+ICS_SPECIALS = re.compile(r'([\\;,])')
+# Octets of an iCalendar line before it is folded
+ICS_LINE_LENGTH = 75
+# 20240501 or 20240501T093000, optionally followed by Z for utc
+ICS_DATETIME = re.compile(r'(\d{4})(\d{2})(\d{2})(?:T(\d{2})(\d{2})(\d{2})(Z)?)?')
+
+
+def file_kind(file_name):
+    """CSV or ICS by the extension of file_name. None for any other file"""
+    extension = (file_name or '').rpartition('.')[2].lower()
+    return {'csv': CSV, 'ics': ICS, 'ical': ICS}.get(extension)
+
+
+def read_entries(kind, lines):
+    return read_csv(lines) if kind == CSV else read_ics(lines)
+
+
+def parse_date(text):
+    """Datetime of a csv date. Raises ValueError if it is not in a known format"""
+    text = text.strip()
+    try:
+        # fromisoformat only takes a Z suffix from python 3.11
+        date = datetime.fromisoformat(re.sub('Z$', '+00:00', text))
+        return date.replace(hour=ALL_DAY_HOUR) if len(text) == len('2024-05-01') else date
+    except ValueError:
+        pass
+    for date_format in CSV_DATE_FORMATS:
+        try:
+            date = datetime.strptime(text, date_format)
+        except ValueError:
+            continue
+        return date if ' ' in text else date.replace(hour=ALL_DAY_HOUR)
+    raise ValueError(text)
+
+
+def read_csv(lines):
+    reader = csv.reader(lines)
+    columns = dict(zip(CSV_COLUMNS, range(len(CSV_COLUMNS))))
+    for row in reader:
+        if not any(cell.strip() for cell in row):
+            continue
+        header = [cell.strip().lower() for cell in row]
+        if reader.line_num == 1 and 'text' in header and 'date' in header:
+            columns = {column: header.index(column) for column in CSV_COLUMNS if column in header}
+            continue
+        yield _csv_entry(reader.line_num, row, columns)
+
+
+def _csv_entry(line, row, columns):
+    def cell(column):
+        index = columns.get(column)
+        return row[index].strip() if index is not None and index < len(row) else ''
+
+    text, recurrence = cell('text'), cell('recurrence') or None
+    if not text:
+        return Entry(line, text, None, None, 'Missing text')
+    try:
+        when = parse_date(cell('date'))
+    except ValueError:
+        return Entry(line, text, None, None, f'Unknown date {cell("date")!r}')
+    if recurrence:
+        try:
+            recurrence = parse_rule(recurrence)
+        except InvalidRule as e:
+            return Entry(line, text, None, None, str(e))
+    return Entry(line, text, when, recurrence, None)
+
+
+def read_ics(lines):
+    event, depth = None, 0
+    for line, content in _unfold(lines):
+        name, params, value = _content_line(content)
+        if name == 'BEGIN' and value.upper() == 'VEVENT':
+            event, depth, start = {}, 0, line
+        elif event is None:
+            continue
+        elif name == 'BEGIN':
+            # Alarms and other components nested in the event have their own properties
+            depth += 1
+        elif name == 'END' and depth:
+            depth -= 1
+        elif name == 'END' and value.upper() == 'VEVENT':
+            yield _event_entry(start, event)
+            event = None
+        elif not depth and name in ('SUMMARY', 'DTSTART'):
+            event[name] = params, value
+
+
+def _unfold(lines):
+    """Yield (line number, content line). Lines starting with a space continue the previous one"""
+    content, number = None, 0
+    for index, line in enumerate(lines, 1):
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and content is not None:
+            content += line[1:]
+            continue
+        if content:
+            yield number, content
+        content, number = line, index
+    if content:
+        yield number, content
+
+
+def _content_line(content):
+    """NAME;PARAM=value:VALUE into (name, params, value). Quoted params may have colons"""
+    head, _, value = content.partition(':')
+    if '"' in head:
+        head, value = _split_quoted(content)
+    if ';' not in head:
+        return head.upper(), {}, value
+
+    name, *params = head.split(';')
+    params = (param.partition('=') for param in params)
+    return name.upper(), {key.upper(): param.strip('"') for key, _, param in params}, value
+
+
+def _split_quoted(content):
+    quoted = False
+    for index, char in enumerate(content):
+        if char == '"':
+            quoted = not quoted
+        elif char == ':' and not quoted:
+            return content[:index], content[index + 1:]
+    return content, ''
+
+
+def _event_entry(line, event):
+    params, summary = event.get('SUMMARY', ({}, ''))
+    text = ICS_ESCAPE.sub(lambda m: '\n' if m.group(1) in 'nN' else m.group(1), summary).strip()
+    if not text:
+        return Entry(line, text, None, None, 'Event without summary')
+    if 'DTSTART' not in event:
+        return Entry(line, text, None, None, 'Event without start')
+    params, value = event['DTSTART']
+    try:
+        when = _ics_datetime(params, value.strip())
+    except ValueError:
+        return Entry(line, text, None, None, f'Unknown start {value!r}')
+    return Entry(line, text, when, None, None)
+
+
+def _ics_datetime(params, value):
+    match = ICS_DATETIME.fullmatch(value)
+    if match is None:
+        raise ValueError(value)
+    # Cheaper than strptime, which takes most of the time of reading big calendars
+    date = datetime(*(int(field) for field in match.groups(0)[:6]))
+    if match.group(4) is None:
+        return date.replace(hour=ALL_DAY_HOUR)
+    if match.group(7):
+        return date.replace(tzinfo=timezone.utc)
+    # Floating times, and times in a zone we don't know, are taken as the user's time
+    zone = _zone(params.get('TZID'))
+    return date.replace(tzinfo=zone) if zone is not None else date
+
+
+@lru_cache(maxsize=64)
+def _zone(name):
+    from zoneinfo import ZoneInfo
+
+    if not name:
+        return None
+    try:
+        return ZoneInfo(name.lstrip('/'))
+    except (ValueError, LookupError, OSError):
+        return None
+
+
+def _chunks(lines, chunk_rows):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= chunk_rows:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+def write_csv(reminders, offset, chunk_rows=CHUNK_ROWS):
+    """Yield the csv of reminders in chunks. Dates are in the user's time, as on /myreminders"""
+    def lines():
+        line = io.StringIO()
+        writer = csv.writer(line)
+        writer.writerow(CSV_EXPORT_COLUMNS)
+        for reminder in reminders:
+            writer.writerow([
+                reminder.text,
+                f'{user_time_from_utc(reminder.remind_time, offset):%Y-%m-%d %H:%M}',
+                reminder.recurrence or '',
+                'done' if reminder.expired else 'pending',
+            ])
+            yield line.getvalue()
+            line.seek(0)
+            line.truncate()
+
+    return _chunks(lines(), chunk_rows)
+
+
+def write_ics(reminders, now, chunk_rows=CHUNK_ROWS):
+    """Yield the iCalendar of reminders in chunks. Times are utc, so any calendar shows them right"""
+    stamp = f'{now:%Y%m%dT%H%M%SZ}'
+
+    def lines():
+        yield 'BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//RemindersBot//Export//EN\r\n'
+        for reminder in reminders:
+            properties = [
+                'BEGIN:VEVENT',
+                f'UID:reminder-{reminder.id}@remindersbot',
+                f'DTSTAMP:{stamp}',
+                f'DTSTART:{reminder.remind_time:%Y%m%dT%H%M%SZ}',
+                f'SUMMARY:{_ics_escape(reminder.text)}',
+            ]
+            if reminder.recurrence:
+                properties.append(f'DESCRIPTION:{_ics_escape(describe(reminder.recurrence).capitalize())}')
+            properties.append('END:VEVENT')
+            yield ''.join(f'{_fold(line)}\r\n' for line in properties)
+        yield 'END:VCALENDAR\r\n'
+
+    return _chunks(lines(), chunk_rows)
+
+
+def _ics_escape(text):
+    return ICS_SPECIALS.sub(r'\\\1', text).replace('\n', '\\n')
+
+
+def _fold(line):
+    """Split lines longer than 75 octets. Continuations start with a space"""
+    if len(line.encode()) <= ICS_LINE_LENGTH:
+        return line
+    parts, part = [], ''
+    for char in line:
+        if len((part + char).encode()) > ICS_LINE_LENGTH - (1 if parts else 0):
+            parts.append(part)
+            part = ''
+        part += char
+    parts.append(part)
+    return '\r\n '.join(parts)
@@ -0,0 +1,80 @@
+"""
+    Router of a sharded deployment. It owns Telegram's webhook and forwards every update to
+    the shard of the user it comes from. See bot.sharding
+
+    SHARD_URLS lists the base url of every shard, in SHARD_INDEX order. Shards and router
+    share WEBHOOK_SECRET. Run with `python -m bot.router`
+"""
+import hmac
+import json
+import logging
+import os
+
+import tornado.web
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.ioloop import IOLoop
+
+from bot.sharding import routing_key, shard_of
+from bot.webhook import HEALTH_PATH, SECRET_HEADER, WEBHOOK_PATH, HealthHandler, set_webhook
+
+logger = logging.getLogger(__name__)
+
+FORWARD_TIMEOUT = 10
+
+
+class RouterHandler(tornado.web.RequestHandler):
+    def initialize(self, shard_urls, secret_token, stats):
+        self.shard_urls = shard_urls
+        self.secret_token = secret_token
+        self.stats = stats
+
+    async def post(self):
+        if not hmac.compare_digest(self.request.headers.get(SECRET_HEADER, ''), self.secret_token):
+            raise tornado.web.HTTPError(403)
+
+        update = json.loads(self.request.body)
+        shard = shard_of(routing_key(update), len(self.shard_urls))
+        try:
+            await AsyncHTTPClient().fetch(
+                f'{self.shard_urls[shard]}{WEBHOOK_PATH}',
+                method='POST',
+                body=self.request.body,
+                headers={'Content-Type': 'application/json', SECRET_HEADER: self.secret_token},
+                request_timeout=FORWARD_TIMEOUT,
+            )
+        except (HTTPClientError, OSError) as e:
+            logger.error(f'Error forwarding update {update.get("update_id")} to shard {shard}: {e!r}')
+            self.stats['failed'][shard] += 1
+            # Telegram delivers the update again later
+            raise tornado.web.HTTPError(502)
+        self.stats['forwarded'][shard] += 1
+
+
+def make_app(shard_urls, secret_token):
+    stats = {'forwarded': [0] * len(shard_urls), 'failed': [0] * len(shard_urls)}
+    return tornado.web.Application([
+        (rf'{WEBHOOK_PATH}/?', RouterHandler,
+         {'shard_urls': shard_urls, 'secret_token': secret_token, 'stats': stats}),
+        (HEALTH_PATH, HealthHandler),
+    ])
+
+
+def main():
+    from telegram import Bot
+
+    shard_urls = [url.rstrip('/') for url in os.environ['SHARD_URLS'].split(',')]
+    secret_token = os.environ['WEBHOOK_SECRET']
+    set_webhook(Bot(os.environ['BOT_KEY']), os.environ['WEBHOOK_URL'], secret_token)
+
+    port = int(os.environ.get('PORT', 8080))
+    make_app(shard_urls, secret_token).listen(port)
+    logger.info(f'Routing updates on port {port} to {len(shard_urls)} shards')
+    IOLoop.current().start()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s [%(funcName)s] %(message)s',
+        level=logging.INFO
+    )
+    main()
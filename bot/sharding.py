@@ -0,0 +1,62 @@
+"""
+    User sharding. With SHARD_COUNT > 1 every bot process owns the users whose id modulo
+    SHARD_COUNT is its SHARD_INDEX. It only loads and stores their state and reminders, and
+    bot.router sends it only their updates.
+
+    Updates are routed by the user they come from, so user_data and conversations always
+    live on one shard. State that handlers keep per chat is kept in user_data too, like
+    reminder drafts, as a group's chat_data would be written by the shards of all its users.
+    chat_data is loaded by chat id, which in private chats is the user id.
+"""
+import logging
+import os
+
+from telegram import Update
+from telegram.ext import DispatcherHandlerStop, TypeHandler
+
+logger = logging.getLogger(__name__)
+
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', 1))
+SHARD_INDEX = int(os.environ.get('SHARD_INDEX', 0))
+
+
+def shard_of(entity_id, shard_count=None):
+    return int(entity_id) % (shard_count or SHARD_COUNT)
+
+
+def owns(entity_id):
+    return shard_of(entity_id) == SHARD_INDEX
+
+
+def owned_by_shard(column):
+    """SQL condition matching rows of this shard. Keeps python's sign of modulo for negative ids"""
+    return f'(({column} % {SHARD_COUNT}) + {SHARD_COUNT}) % {SHARD_COUNT} = {SHARD_INDEX}'
+
+
+def routing_key(update):
+    """Id of the user a raw json update comes from. Or of its chat, for channel posts"""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        if 'from' in value:
+            return value['from']['id']
+        chat = value.get('chat') or value.get('message', {}).get('chat')
+        if chat:
+            return chat['id']
+    return update['update_id']
+
+
+def conversation_owner(key):
+    """User of a (chat_id, user_id[, message_id]) conversation key"""
+    return key[1] if len(key) > 1 else key[0]
+
+
+def drop_foreign_update(update, context):
+    user_or_chat = update.effective_user or update.effective_chat
+    if user_or_chat is not None and not owns(user_or_chat.id):
+        logger.error(f'Dropping update {update.update_id} of shard {shard_of(user_or_chat.id)}')
+        raise DispatcherHandlerStop()
+
+
+# Runs before every other handler. Updates only reach the wrong shard if routing is misconfigured
+shard_guard = TypeHandler(Update, drop_foreign_update)
@@ -0,0 +1,46 @@
+"""
+    Timestamp codec.
+
+    Timestamps the bot stores itself are `datetime.isoformat()` strings, so they are decoded
+    with the strict and cheap `datetime.fromisoformat`. The slow `dateparser` is only used
+    for free-form dates written by users, and only imported then as loading its language
+    data delays the bot startup.
+"""
+import logging
+from datetime import datetime, timezone
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+
+def encode(date):
+    return date.isoformat()
+
+
+def decode(iso_string):
+    """Decode a stored isoformat timestamp. Falls back to dateparser for legacy formats"""
+    try:
+        return datetime.fromisoformat(iso_string)
+    except ValueError:
+        return _decode_legacy(iso_string)
+
+
+# fromisoformat is cheaper than a cache lookup, so only the dateparser fallback is memoized
+@lru_cache(maxsize=1024)
+def _decode_legacy(date_string):
+    import dateparser
+
+    logger.warning(f'Timestamp {date_string!r} is not in isoformat. Parsing it with dateparser')
+    return dateparser.parse(date_string)
+
+
+def decode_utc(iso_string):
+    """Decode a stored naive utc timestamp into a timezone aware datetime"""
+    return decode(iso_string).replace(tzinfo=timezone.utc)
+
+
+def parse_user_date(text, settings=None):
+    """Parse a date written by a user, like 'tomorrow at 13:00'. Returns None if not understood"""
+    import dateparser
+
+    return dateparser.parse(text, settings=settings)
@@ -0,0 +1,171 @@
+"""
+    Sentry tracing. Handler callbacks and jobs run in a transaction when a sampling policy
+    picks them, which happens before they start, so the ones not picked cost no more than
+    timing them.
+
+    They are picked at the rate of their kind and only while the token budget lasts.
+    Kinds are `handler` or `job`, optionally followed by the transaction name. That is the
+    callback name, after the conversation and state for conversation callbacks:
+
+        SENTRY_TRACES_RATES='handler=0.05,job=0.01,job:send_notification=0'
+        SENTRY_PROFILES_RATES='handler:quicky=0.1,handler:Set Reminders/entry/remind=0.1'
+
+    The most specific rate wins. Callbacks that were not picked and take longer than
+    SENTRY_SLOW_SECONDS are reported as a warning with their duration, within the same
+    budget. Errors are sent as error events whether they were picked or not.
+"""
+import logging
+import os
+import random
+import threading
+import time
+from functools import wraps
+
+import sentry_sdk
+
+from bot.outbound import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+HANDLER, JOB = 'handler', 'job'
+DEFAULT_TRACES_RATES = 'handler=0.05,job=0.01'
+DEFAULT_PROFILES_RATES = 'handler=0.01'
+
+
+def parse_rates(spec):
+    """'handler=0.05,job:send_notification=0' into {'handler': 0.05, 'job:send_notification': 0.0}"""
+    rates = {}
+    for rule in filter(None, (part.strip() for part in spec.split(','))):
+        kind, _, rate = rule.partition('=')
+        rates[kind.strip()] = float(rate)
+    return rates
+
+
+def rate_of(rates, op, name):
+    return rates.get(f'{op}:{name}', rates.get(op, rates.get('default', 0.0)))
+
+
+class SamplingPolicy(object):
+    def __init__(self, traces_rates, profiles_rates, slow_seconds, per_minute, clock=time.monotonic):
+        self.traces_rates = traces_rates
+        self.profiles_rates = profiles_rates
+        # 0 disables reporting slow callbacks
+        self.slow_seconds = slow_seconds
+        self.clock = clock
+        # No budget samples nothing
+        self.budget = TokenBucket(per_minute / 60, per_minute, clock()) if per_minute > 0 else None
+        self._lock = threading.Lock()
+        self.stats = {'sampled': 0, 'slow': 0, 'dropped': 0, 'over_budget': 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            traces_rates=parse_rates(os.environ.get('SENTRY_TRACES_RATES', DEFAULT_TRACES_RATES)),
+            profiles_rates=parse_rates(os.environ.get('SENTRY_PROFILES_RATES', DEFAULT_PROFILES_RATES)),
+            slow_seconds=float(os.environ.get('SENTRY_SLOW_SECONDS', 2)),
+            per_minute=int(os.environ.get('SENTRY_TRACES_PER_MINUTE', 30)),
+        )
+
+    def traces_sampler(self, sampling_context):
+        """Rate of transactions not started by traced, like the ones of sentry integrations"""
+        context = sampling_context['transaction_context']
+        return rate_of(self.traces_rates, context['op'], context['name'])
+
+    def profiles_sampler(self, sampling_context):
+        context = sampling_context['transaction_context']
+        return rate_of(self.profiles_rates, context['op'], context['name'])
+
+    def sample(self, op, name):
+        """Whether to record a transaction of op and name. Picked ones take from the budget"""
+        if random.random() >= rate_of(self.traces_rates, op, name):
+            return self._count('dropped')
+        return self._take('sampled')
+
+    def observe(self, op, name, seconds):
+        """Report a callback that was not sampled if it was slow"""
+        if not self.slow_seconds or seconds < self.slow_seconds:
+            return
+        if self._take('slow'):
+            sentry_sdk.capture_message(f'Slow {op} {name} took {seconds:.1f}s', level='warning')
+
+    def _take(self, reason):
+        with self._lock:
+            if self.budget is None or self.budget.wait_time(self.clock()) > 0:
+                return self._count('over_budget')
+            self.budget.take(self.clock())
+        self.stats[reason] += 1
+        return True
+
+    def _count(self, reason):
+        self.stats[reason] += 1
+        return False
+
+
+def traced(callback, op, name, policy=None):
+    """Run callback in a transaction if policy samples it, or always without a policy.
+    Errors raised by it mark the transaction as errored
+    """
+    if getattr(callback, 'traced', False):
+        return callback
+
+    @wraps(callback)
+    def traced_callback(*args, **kwargs):
+        if policy is None or policy.sample(op, name):
+            with sentry_sdk.start_transaction(op=op, name=name, sampled=True if policy else None):
+                return callback(*args, **kwargs)
+
+        start = time.perf_counter()
+        try:
+            return callback(*args, **kwargs)
+        finally:
+            policy.observe(op, name, time.perf_counter() - start)
+
+    traced_callback.traced = True
+    return traced_callback
+
+
+def _job_name(callback):
+    return getattr(callback, '__qualname__', getattr(callback, '__name__', repr(callback)))
+
+
+def trace_jobs(job_queue, policy=None):
+    """Trace the jobs already on job_queue and the ones added to it from now on"""
+    for job in job_queue.jobs():
+        job.callback = traced(job.callback, JOB, _job_name(job.callback), policy)
+
+    def traced_scheduler(schedule):
+        @wraps(schedule)
+        def schedule_traced(callback, *args, **kwargs):
+            return schedule(traced(callback, JOB, _job_name(callback), policy), *args, **kwargs)
+        return schedule_traced
+
+    for method in ('run_once', 'run_repeating', 'run_daily'):
+        setattr(job_queue, method, traced_scheduler(getattr(job_queue, method)))
+
+
+def trace_handlers(dispatcher, policy=None):
+    from bot.utils import wrap_handler_callbacks
+
+    def trace_callback(callback, conversation, state):
+        name = '/'.join(filter(None, (conversation, state, callback.__name__)))
+        return traced(callback, HANDLER, name, policy)
+
+    wrap_handler_callbacks(dispatcher, trace_callback)
+
+
+def init(policy=None, **options):
+    """Set up sentry with the sampling policy. Errors are always sent"""
+    policy = policy or SamplingPolicy.from_env()
+    sentry_sdk.init(
+        dsn=os.environ.get('SENTRY_DSN'),
+        traces_sampler=policy.traces_sampler,
+        profiles_sampler=policy.profiles_sampler,
+        **options
+    )
+    return policy
+
+
+def trace(updater, policy=None):
+    """Run the handlers and jobs of updater in transactions, the ones policy samples if given"""
+    trace_handlers(updater.dispatcher, policy)
+    trace_jobs(updater.job_queue, policy)
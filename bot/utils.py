@@ -3,15 +3,85 @@ import logging
 import os
 import random
 from datetime import datetime, timedelta
+from functools import wraps
 
-import dateparser
+from telegram.ext import Dispatcher
 
 from bot.keyboard import done_or_repeat_reminder, time_options_keyboard
-from bot.jobs.db_ops import add_reminder, expire_reminder
+from bot.jobs.db_ops import add_reminder, advance_reminder, expire_reminders
+from bot.jobs.expiry import expiry_buffer
 from bot.jobs.models import Reminder
+from bot.metrics import observe_delivery
+from bot.outbound import BULK, on_sent, send_message
+from bot.recurrence import describe, next_occurrence
+from bot.timestamps import decode, decode_utc
 
 logger = logging.getLogger(__name__)
 
+# Only reminders due within the horizon are kept on the job_queue. See job_loader.top_up_reminders
+REMINDER_HORIZON = timedelta(hours=float(os.environ.get('REMINDER_HORIZON_HOURS', 24)))
+# 'jobqueue' keeps due reminders on this process' job_queue.
+# 'db' leaves them on the db for bot.jobs.scheduler workers to deliver.
+SCHEDULER = os.environ.get('SCHEDULER', 'jobqueue')
+# Run db bound handlers on the dispatcher worker pool. See `concurrent`
+CONCURRENT_HANDLERS = os.environ.get('CONCURRENT_HANDLERS', '1') == '1'
+
+
+def concurrent(handler):
+    """Run handler on the dispatcher worker pool instead of the dispatcher thread.
+
+    Handlers run one at a time on the dispatcher thread, so one waiting on the db holds
+    every other update. Errors still reach the error handlers, unlike with plain run_async.
+    """
+    if not CONCURRENT_HANDLERS:
+        return handler
+
+    def run_handler(update, context):
+        try:
+            return queue_handler.handler(update, context)
+        except Exception as e:
+            Dispatcher.get_instance().dispatch_error(update, e)
+
+    @wraps(handler)
+    def queue_handler(update, context):
+        return Dispatcher.get_instance().run_async(run_handler, update, context)
+
+    # What runs on the pool. Hooks like bot.metrics wrap it
+    queue_handler.handler = handler
+    return queue_handler
+
+
+def wrap_handler_callbacks(dispatcher, wrap):
+    """Replace every handler callback with wrap(callback, conversation, state).
+
+    Conversation callbacks are wrapped with the name of their conversation and state, or
+    'entry' and 'fallback'. Concurrent handlers get the handler that runs on the pool wrapped.
+    """
+    from telegram.ext import ConversationHandler
+
+    from bot import constants
+
+    def wrap_callback(handler, conversation='', state=''):
+        callback = handler.callback
+        if hasattr(callback, 'handler'):
+            callback.handler = wrap(callback.handler, conversation, state)
+        else:
+            handler.callback = wrap(callback, conversation, state)
+
+    state_names = {value: name for name, value in vars(constants).items() if name.startswith('READ_')}
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            if not isinstance(handler, ConversationHandler):
+                wrap_callback(handler)
+                continue
+            steps = [('entry', handler.entry_points), ('fallback', handler.fallbacks)] + [
+                (state_names.get(state, str(state)), state_handlers)
+                for state, state_handlers in handler.states.items()
+            ]
+            for state, state_handlers in steps:
+                for step in state_handlers:
+                    wrap_callback(step, handler.name, state)
+
 
 def _tag_user(user):
     if user.username:
@@ -32,8 +102,18 @@ def init_reminder_context(to_remind, user, chat_id, offset, **extra_args):
     }
 
 
+def reminder_draft(context, chat_id):
+    """The reminder the user is setting up in chat_id.
+
+    Kept in user_data rather than chat_data, so it lives on the shard of the user like the
+    conversation it belongs to, and users setting up reminders in the same group don't mix them up.
+    """
+    # user_data is stored as json, which has string keys only
+    return context.user_data.setdefault('drafts', {}).setdefault(str(chat_id), {})
+
+
 def msg_admin(bot, message, **kwargs):
-    bot.send_message(chat_id=os.environ['ADMIN_ID'], text=message, **kwargs)
+    send_message(bot, chat_id=os.environ['ADMIN_ID'], text=message, priority=BULK, block=False, **kwargs)
 
 
 def datetime_from_answer(time_delay):
@@ -44,10 +124,15 @@ def datetime_from_answer(time_delay):
 
 def add_reminder_job(update, job_queue, job_context, when):
     logger.info(f"Adding job to db..")
-    added = add_job_to_db(job_context)
-    if added:
-        job_queue.run_once(send_notification, when, context=job_context)
+    reminder = add_job_to_db(job_context)
+    added = reminder is not None
+    if added and SCHEDULER == 'jobqueue' and when <= datetime.utcnow() + REMINDER_HORIZON:
+        job_queue.run_once(
+            send_notification, when, context={**job_context, 'reminder_id': reminder.id}, name=reminder.key
+        )
         logger.info(f"Job added to job queue and db.")
+    elif added:
+        logger.info("Job added to db. It will be scheduled when it is close to its due time")
     else:
         logger.error('Could not save reminder job')
         update.effective_message.reply_text('Something went wrong')
@@ -55,27 +140,33 @@ def add_reminder_job(update, job_queue, job_context, when):
     return added
 
 
-def add_job_to_db(job_context: dict) -> bool:
-    """Saves a reminder in db based on the job_context"""
+def add_job_to_db(job_context: dict) -> Reminder:
+    """Saves a reminder in db based on the job_context. Returns it, or None if it couldn't be saved"""
     try:
-        reminder = Reminder(
-            text=job_context['thing_to_remind'],
-            user_id=job_context['user_id'],
-            user_tag=job_context['user_tag'],
-            remind_time=job_context['remind_date_iso'],
-            chat_id=job_context['chat_id'],
-            offset=job_context['offset'],
-            job_context=job_context,
-            key=reminder_key(job_context)
-        )
+        reminder = Reminder(**reminder_columns(job_context))
         add_reminder(reminder)
-        return True
+        return reminder
     except KeyError:
         logger.exception('Job context keys not properly initialized.')
-        return False
+        return None
     except Exception:
         logger.exception("Error saving reminder to db.")
-        return False
+        return None
+
+
+def reminder_columns(job_context):
+    """Column values of the reminder row described by job_context"""
+    return {
+        'text': job_context['thing_to_remind'],
+        'user_id': job_context['user_id'],
+        'user_tag': job_context['user_tag'],
+        'remind_time': decode_utc(job_context['remind_date_iso']),
+        'chat_id': job_context['chat_id'],
+        'offset': job_context['offset'],
+        'job_context': job_context,
+        'key': reminder_key(job_context),
+        'recurrence': job_context.get('recurrence'),
+    }
 
 
 def reminder_key(job_ctx):
@@ -84,20 +175,94 @@ def reminder_key(job_ctx):
     )
 
 
-def send_notification(context):
+def notify(bot, job_context, reminder_id=None, **send_options):
+    """Send the reminder described by job_context to its chat. Returns what send_message returned"""
     TIME_ICONS = ['⏰', '🔊', '🔈', '🔉', '📣', '📢', '❕', '🎉', '🎊', '⏱']
     random_time_emoji = random.choice(TIME_ICONS)
+    to_remind = job_context['thing_to_remind']
+
+    sent = send_message(
+        bot,
+        chat_id=job_context['chat_id'],
+        text=f"{job_context['user_tag']} {to_remind} {random_time_emoji} ",
+        reply_markup=done_or_repeat_reminder(reminder_id),
+        **send_options
+    )
+    logger.info(f"Reminded {job_context['user_tag']} of {to_remind}")
+    due = decode_utc(job_context['remind_date_iso'])
+    on_sent(sent, lambda: observe_delivery(due))
+    return sent
+
+
+# Name of the jobs that notifications schedule once delivered
+FOLLOW_UP = 'notification follow-up'
+
+
+def send_notification(context):
     job = context.job
-    to_remind = context.job.context['thing_to_remind']
+    key = reminder_key(job.context)
+    # Notifications wait behind interactive replies. Don't hold the job_queue meanwhile.
+    sent = notify(context.bot, job.context, job.context.get('reminder_id'), priority=BULK, block=False)
 
-    context.bot.send_message(
-        chat_id=job.context['chat_id'],
-        text=f"{job.context['user_tag']} {to_remind} {random_time_emoji} ",
-        reply_markup=done_or_repeat_reminder()
-    )
-    logger.info(f"Reminded {job.context['user_tag']} of {to_remind}")
+    # Delivery callbacks run on the outbound sender thread, so db writes go to the job_queue
+    def advance():
+        context.job_queue.run_once(advance_recurring, datetime.utcnow(), context=job.context, name=FOLLOW_UP)
+
+    def expire():
+        full = expiry_buffer.add(key)
+        if full:
+            context.job_queue.run_once(expiry_buffer.flush, datetime.utcnow(), name=FOLLOW_UP)
+
+    on_sent(sent, advance if job.context.get('recurrence') else expire)
+
+
+def advance_recurring(context):
+    """Job that moves a delivered recurring reminder to its next occurrence"""
+    schedule_next_occurrence(context.job_queue, context.job.context)
+
+
+def run_follow_ups(job_queue, dispatcher):
+    """Run the follow-ups of delivered notifications left on a stopped job_queue.
+
+    Messages still queued on shutdown are sent after the job_queue stopped, so the jobs
+    their delivery scheduled, like moving recurring reminders forward, are run here.
+    """
+    for job in job_queue.jobs():
+        if job.name == FOLLOW_UP and not job.removed:
+            job.run(dispatcher)
+            job.schedule_removal()
 
-    expire_reminder(reminder_key(job.context))
+
+def next_occurrence_context(job_context):
+    """Job context of the occurrence of a recurring reminder after the one in job_context"""
+    when = next_occurrence(job_context['recurrence'], decode_utc(job_context['remind_date_iso']), job_context['offset'])
+    next_context = {name: value for name, value in job_context.items() if name != 'reminder_id'}
+    next_context['remind_date_iso'] = when.replace(tzinfo=None).isoformat()
+    return next_context, when
+
+
+def schedule_next_occurrence(job_queue, job_context):
+    """Move a recurring reminder that just fired to its next occurrence.
+
+    Only the next occurrence is ever stored. It is put on the job_queue if it is due within
+    the horizon, or left for top_up_reminders otherwise.
+    """
+    reminder_id = job_context['reminder_id']
+    try:
+        next_context, when = next_occurrence_context(job_context)
+        advance_reminder(reminder_id, reminder_key(next_context), when, next_context)
+    except Exception:
+        # Expired rather than delivered again on every restart
+        logger.exception(f'Error scheduling the next occurrence of reminder {reminder_id}. Expiring it')
+        expire_reminders([reminder_key(job_context)])
+        return
+
+    when = when.replace(tzinfo=None)
+    if SCHEDULER == 'jobqueue' and when <= datetime.utcnow() + REMINDER_HORIZON:
+        job_queue.run_once(
+            send_notification, when, context={**next_context, 'reminder_id': reminder_id},
+            name=reminder_key(next_context),
+        )
 
 
 def _show_time_options(update, from_remind_again=False):
@@ -117,12 +282,14 @@ def _show_time_options(update, from_remind_again=False):
 
 
 def reply_reminder_details(update, job_context, from_callback=False):
-    utc_date = dateparser.parse(job_context['remind_date_iso'])
+    utc_date = decode(job_context['remind_date_iso'])
     user_date = utc_date + timedelta(seconds=job_context.get('offset', 0))
     logger.info(f"Transformed UTC {utc_date} into {user_date} to inform user in his/her local time")
 
     text = (f"✅ Done. I will remind you of `{job_context['thing_to_remind']}`"
             f" on {user_date.strftime('%d/%m')} at {user_date.strftime('%H:%M')} 🔔")
+    if job_context.get('recurrence'):
+        text += f"\nThen {describe(job_context['recurrence'])} 🔁"
 
     if from_callback:
         update.callback_query.message.edit_text(
@@ -134,10 +301,6 @@ def reply_reminder_details(update, job_context, from_callback=False):
         update.message.reply_text(text, parse_mode='markdown')
 
 
-def isoformat_to_datetime(date_string):
-    return dateparser.parse(date_string)
-
-
 def _setup_reminder_and_reply(update, job_queue, job_context, when, from_callback=False):
     """Setup a new reminder in the job_queue and reply with details or error notice.
 
@@ -172,6 +335,11 @@ def utc_time_from_user_date(user_date, offset):
     utc_date = user_date - timedelta(seconds=offset)
     return utc_date
 
+def user_time_from_utc(utc_date, offset):
+    """Inverse of utc_time_from_user_date. The time a user reads on their clock at utc_date"""
+    return utc_date + timedelta(seconds=offset)
+
+
 def user_current_time(user_offset):
     """Return user datetime.now()"""
     return datetime.utcnow() + timedelta(seconds=user_offset)
@@ -0,0 +1,80 @@
+"""
+    Webhook mode. Telegram pushes updates to an http endpoint of the bot instead of the bot
+    long polling for them.
+
+    Requests must carry the secret token the webhook was registered with. TLS is expected to
+    be terminated by a proxy in front of the bot, like Fly's.
+"""
+import hmac
+import logging
+import os
+import secrets
+
+import tornado.web
+from telegram.ext import Updater
+from telegram.utils.webhookhandler import WebhookHandler, WebhookServer
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+WEBHOOK_PATH = '/telegram'
+HEALTH_PATH = '/health'
+
+
+class SecretWebhookHandler(WebhookHandler):
+    """Queue updates posted by Telegram. Requests without the secret token are rejected"""
+
+    def initialize(self, bot, update_queue, secret_token):
+        super().initialize(bot, update_queue)
+        self.secret_token = secret_token
+
+    def _validate_post(self):
+        received = self.request.headers.get(SECRET_HEADER, '')
+        if not hmac.compare_digest(received, self.secret_token):
+            raise tornado.web.HTTPError(403)
+        super()._validate_post()
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write('ok')
+
+
+class WebhookUpdater(Updater):
+    """Updater whose webhook server checks Telegram's secret token and answers health checks"""
+    secret_token = None
+
+    def _start_webhook(self, listen, port, url_path, cert, key, bootstrap_retries, clean,
+                       webhook_url, allowed_updates):
+        app = tornado.web.Application([
+            (rf'{url_path}/?', SecretWebhookHandler,
+             {'bot': self.bot, 'update_queue': self.update_queue, 'secret_token': self.secret_token}),
+            (HEALTH_PATH, HealthHandler),
+        ])
+        self.httpd = WebhookServer(listen, port, app, None)
+        self.httpd.serve_forever()
+
+
+def set_webhook(bot, webhook_url, secret_token):
+    bot.set_webhook(
+        url=f'{webhook_url.rstrip("/")}{WEBHOOK_PATH}',
+        secret_token=secret_token,
+        max_connections=int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', 40)),
+    )
+
+
+def start_webhook(updater, port, webhook_url=None, listen='0.0.0.0'):
+    """Serve the webhook. If a webhook_url is given, register it on Telegram first.
+
+    Without it updates come from bot.router, which shares WEBHOOK_SECRET with the bot.
+    """
+    secret_token = os.environ.get('WEBHOOK_SECRET')
+    if webhook_url is not None:
+        secret_token = secret_token or secrets.token_hex(32)
+        set_webhook(updater.bot, webhook_url, secret_token)
+    elif not secret_token:
+        raise ValueError('WEBHOOK_SECRET must be set to receive updates from the router')
+
+    updater.secret_token = secret_token
+    updater.start_webhook(listen=listen, port=port, url_path=WEBHOOK_PATH)
+    logger.info(f'Webhook listening on {listen}:{port}{WEBHOOK_PATH}')
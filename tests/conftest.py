@@ -0,0 +1,31 @@
+"""
+    Tests run on the db of TEST_DATABASE_URL, or else on a sqlite file db of their own.
+    Every table is emptied after each test that uses the db.
+"""
+import os
+import tempfile
+
+import pytest
+
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL', '')
+# Before bot.db creates its engine
+os.environ['DATABASE_URL'] = TEST_DATABASE_URL or f'sqlite:///{tempfile.mkdtemp()}/test.db'
+
+
+@pytest.fixture
+def db():
+    from bot.db import transaction
+    from bot.jobs.models import Base, create_tables
+
+    create_tables()
+    yield
+    with transaction() as conn:
+        for table in reversed(Base.metadata.sorted_tables):
+            conn.execute(table.delete())
+
+
+def job_context(user_id, text, when, **extra):
+    return {
+        'thing_to_remind': text, 'user_id': user_id, 'user_tag': f'@user{user_id}', 'chat_id': user_id,
+        'offset': -10800, 'remind_date_iso': when.isoformat(), **extra,
+    }
@@ -0,0 +1,41 @@
+"""
+    Tests of the postgres only branches of bot.jobs.db_ops.
+
+    They need a postgres db to run on: TEST_DATABASE_URL=postgresql://... python -m pytest tests
+"""
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+from tests.conftest import TEST_DATABASE_URL, job_context
+
+pytestmark = pytest.mark.skipif(
+    not TEST_DATABASE_URL.startswith('postgres'), reason='TEST_DATABASE_URL is not a postgres db',
+)
+
+
+def test_add_reminders_copies_rows_and_skips_taken_keys(db):
+    from bot.jobs.db_ops import add_reminders, delete_reminder, get_reminder
+    from bot.utils import reminder_columns
+
+    user_id = uuid.uuid4().int % 10 ** 12
+    when = datetime.utcnow() + timedelta(days=1)
+    contexts = [job_context(user_id, f'reminder, "{i}"\nline', when + timedelta(minutes=i)) for i in range(3)]
+    saved = {}
+    try:
+        saved = add_reminders([reminder_columns(context) for context in contexts])
+        assert len(saved) == 3
+
+        reminder = get_reminder(saved[reminder_columns(contexts[0])['key']], user_id)
+        assert reminder.text == 'reminder, "0"\nline'
+        assert reminder.job_context == contexts[0]
+        assert reminder.expired is False
+        assert reminder.recurrence is None
+
+        again = add_reminders([reminder_columns(context) for context in contexts + [job_context(user_id, 'new', when)]])
+        assert list(again) == [reminder_columns(job_context(user_id, 'new', when))['key']]
+        saved.update(again)
+    finally:
+        for reminder_id in saved.values():
+            delete_reminder(reminder_id, user_id)
@@ -0,0 +1,30 @@
+"""
+    Tests of which messages the file import handler takes
+"""
+import pytest
+from telegram import Update
+
+
+def document_update(file_name, chat_type='private'):
+    user = {'id': 7, 'is_bot': False, 'first_name': 'user'}
+    chat = {'id': 7 if chat_type == 'private' else -100, 'type': chat_type}
+    message = {'message_id': 1, 'date': 0, 'from': user, 'chat': chat}
+    if file_name is not None:
+        message['document'] = {'file_id': '1', 'file_unique_id': '1', 'file_name': file_name}
+    else:
+        message['text'] = 'reminders.csv'
+    return Update.de_json({'update_id': 1, 'message': message}, None)
+
+
+@pytest.mark.parametrize('file_name, chat_type, handled', [
+    ('reminders.csv', 'private', True),
+    ('Calendar.ICS', 'private', True),
+    ('reminders.csv', 'group', False),
+    ('calendar.ics', 'supergroup', False),
+    ('report.pdf', 'private', False),
+    (None, 'private', False),
+])
+def test_only_calendars_and_csv_files_sent_in_private_are_imported(file_name, chat_type, handled):
+    from bot.handlers.imports import import_document
+
+    assert bool(import_document.check_update(document_update(file_name, chat_type))) == handled
@@ -0,0 +1,20 @@
+"""
+    Tests of how often reminders entering the horizon are queued
+"""
+from datetime import timedelta
+
+import pytest
+
+from bot.constants import HOUR, TOP_UP_INTERVAL
+from bot.jobs.job_loader import top_up_interval
+
+
+@pytest.mark.parametrize('hours, interval', [(24, TOP_UP_INTERVAL), (2, HOUR), (1, HOUR / 2), (0.25, HOUR / 8)])
+def test_top_ups_run_at_least_twice_per_horizon(hours, interval):
+    assert top_up_interval(timedelta(hours=hours)) == interval
+
+
+@pytest.mark.parametrize('hours', [0, -1])
+def test_horizons_must_be_positive(hours):
+    with pytest.raises(ValueError):
+        top_up_interval(timedelta(hours=hours))
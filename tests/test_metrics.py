@@ -0,0 +1,53 @@
+"""
+    Tests of the figures of the db pool and the outbound queue as Prometheus metrics
+"""
+from types import SimpleNamespace
+
+from bot import metrics
+
+
+def rendered(name):
+    """TYPE line and samples of the metric called name"""
+    return [line for line in metrics.render().splitlines()
+            if line.startswith(f'# TYPE {name} ') or line.split('{')[0].split(' ')[0] == name]
+
+
+def test_pool_counts_are_counters():
+    pool_stats = {
+        'connects': 2, 'checkouts': 10, 'checkins': 9, 'invalidated': 1,
+        'checked_out': 1, 'wait_seconds_total': 0.5, 'wait_seconds_max': 0.25,
+    }
+    metrics.instrument_pool(pool_stats)
+    pool_stats['checkouts'] += 1
+
+    assert rendered('bot_db_pool_events_total') == [
+        '# TYPE bot_db_pool_events_total counter',
+        'bot_db_pool_events_total{event="checkins"} 9',
+        'bot_db_pool_events_total{event="checkouts"} 11',
+        'bot_db_pool_events_total{event="connects"} 2',
+        'bot_db_pool_events_total{event="invalidated"} 1',
+    ]
+    assert rendered('bot_db_pool_wait_seconds_total') == [
+        '# TYPE bot_db_pool_wait_seconds_total counter', 'bot_db_pool_wait_seconds_total 0.5',
+    ]
+    assert rendered('bot_db_pool_checked_out') == ['# TYPE bot_db_pool_checked_out gauge', 'bot_db_pool_checked_out 1']
+
+
+def test_outbound_totals_are_counters():
+    lane = {'sent': 5, 'failed': 1, 'retried': 2, 'wait_seconds_total': 3.0, 'wait_seconds_max': 1.5}
+    queue = SimpleNamespace(stats={'bulk': lane, 'retry_after': 4}, depth=lambda: {'bulk': 7})
+    metrics.instrument_outbound(queue)
+
+    assert rendered('bot_outbound_messages_total') == [
+        '# TYPE bot_outbound_messages_total counter',
+        'bot_outbound_messages_total{lane="bulk",result="failed"} 1',
+        'bot_outbound_messages_total{lane="bulk",result="retried"} 2',
+        'bot_outbound_messages_total{lane="bulk",result="sent"} 5',
+    ]
+    assert rendered('bot_outbound_retry_after_total') == [
+        '# TYPE bot_outbound_retry_after_total counter', 'bot_outbound_retry_after_total 4',
+    ]
+    assert rendered('bot_outbound_wait_seconds_max') == [
+        '# TYPE bot_outbound_wait_seconds_max gauge', 'bot_outbound_wait_seconds_max{lane="bulk"} 1.5',
+    ]
+    assert rendered('bot_outbound_depth') == ['# TYPE bot_outbound_depth gauge', 'bot_outbound_depth{lane="bulk"} 7']
@@ -0,0 +1,166 @@
+"""
+    Tests of the outbound queue and of sending through it
+"""
+from concurrent.futures import Future
+from datetime import datetime
+
+import pytest
+from telegram.error import RetryAfter
+
+from benchmarks.fakes import FakeBot, FakeQueuedBot
+from bot.outbound import BULK, INTERACTIVE, MAX_RETRIES, OutboundQueue, TokenBucket, on_sent, wait_sent
+from tests.conftest import job_context
+
+
+class StrictBot(FakeBot):
+    """Plain Bot that records the keyword arguments of send_message"""
+    def __init__(self):
+        super().__init__()
+        self.send_kwargs = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.send_kwargs.append(kwargs)
+        return super().send_message(chat_id, text, **kwargs)
+
+
+def test_plain_bots_send_right_away(monkeypatch):
+    from bot.utils import msg_admin, notify
+
+    monkeypatch.setenv('ADMIN_ID', '99')
+    bot = StrictBot()
+    delivered = []
+    sent = notify(bot, job_context(1, 'water', datetime.utcnow()), 7, priority=BULK, block=False)
+    on_sent(sent, lambda: delivered.append(wait_sent(sent).message_id))
+    msg_admin(bot, 'Restarted')
+
+    assert delivered == [1]
+    assert [data['chat_id'] for _, _, data in bot.sent] == [1, '99']
+    # Options of the outbound queue are not passed on to plain bots
+    assert not any({'priority', 'block'} & set(kwargs) for kwargs in bot.send_kwargs)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def stepped_queue(clock, **limits):
+    """OutboundQueue whose sender thread is stopped, so the test pops and sends messages itself"""
+    queue = OutboundQueue(clock=clock, **limits)
+    queue.stop()
+    queue._running = True
+    return queue
+
+
+def sent_to(chat_id, result=None):
+    return lambda: result or chat_id
+
+
+def test_token_bucket_bursts_then_refills():
+    bucket = TokenBucket(rate=2, capacity=3, now=0)
+    for _ in range(3):
+        assert bucket.wait_time(0) == 0
+        bucket.take(0)
+    assert bucket.wait_time(0) == 0.5
+    assert bucket.wait_time(0.25) == 0.25
+    assert bucket.wait_time(0.5) == 0
+    assert not bucket.is_full(0.5)
+    assert bucket.is_full(10)
+
+
+def test_global_rate():
+    clock = FakeClock()
+    queue = stepped_queue(clock, global_rate=2, chat_burst=10)
+    for chat_id in (1, 2, 3):
+        queue.submit(sent_to(chat_id), chat_id)
+
+    assert queue._next(clock())[0].chat_id == 1
+    assert queue._next(clock())[0].chat_id == 2
+    assert queue._next(clock()) == (None, 0.5)
+    clock.now += 0.5
+    assert queue._next(clock())[0].chat_id == 3
+
+
+def test_chats_over_their_limit_dont_hold_back_others():
+    clock = FakeClock()
+    queue = stepped_queue(clock, global_rate=30, chat_rate=1, chat_burst=1, group_rate=0.5)
+    for chat_id in (1, 1, -5, -5, 2):
+        queue.submit(sent_to(chat_id), chat_id)
+
+    assert [queue._next(clock())[0].chat_id for _ in range(3)] == [1, -5, 2]
+    assert queue._next(clock()) == (None, 1)
+    assert queue.depth() == {'interactive': 2, 'bulk': 0}
+
+    clock.now += 1
+    assert queue._next(clock())[0].chat_id == 1
+    # Groups refill at their own rate
+    assert queue._next(clock()) == (None, 1)
+    clock.now += 1
+    assert queue._next(clock())[0].chat_id == -5
+
+
+def test_interactive_messages_go_ahead_of_bulk_ones():
+    clock = FakeClock()
+    queue = stepped_queue(clock, chat_burst=10)
+    queue.submit(sent_to(1), 1, BULK)
+    queue.submit(sent_to(2), 2, BULK)
+    queue.submit(sent_to(3), 3, INTERACTIVE)
+
+    assert [queue._next(clock())[0].chat_id for _ in range(3)] == [3, 1, 2]
+
+
+def test_retry_after_pauses_sending_and_retries():
+    clock = FakeClock()
+    queue = stepped_queue(clock, chat_burst=10)
+    answers = [RetryAfter(5), 'sent']
+
+    def send():
+        answer = answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    sent = queue.submit(send, 1)
+    queue.submit(sent_to(2), 2)
+    queue._send(queue._next(clock())[0])
+    assert not sent.done()
+    assert queue._next(clock()) == (None, 5)
+
+    clock.now += 5
+    item, _ = queue._next(clock())
+    queue._send(item)
+    assert sent.result(0) == 'sent'
+    assert queue.stats['retry_after'] == 1
+    assert queue.stats['interactive']['retried'] == 1
+
+
+def test_messages_fail_after_the_last_retry():
+    clock = FakeClock()
+    queue = stepped_queue(clock, chat_burst=10)
+
+    def send():
+        raise RetryAfter(1)
+
+    sent = queue.submit(send, 1)
+    for _ in range(MAX_RETRIES + 1):
+        clock.now += 1
+        queue._send(queue._next(clock())[0])
+    assert isinstance(sent.exception(0), RetryAfter)
+    assert queue.stats['interactive']['failed'] == 1
+
+
+def test_queued_bots_return_futures_unless_blocking():
+    bot = FakeQueuedBot()
+    try:
+        sent = bot.send_message(chat_id=1, text='later', priority=BULK, block=False)
+        assert isinstance(sent, Future)
+        assert sent.result(5).text == 'later'
+        assert bot.send_message(chat_id=1, text='now').text == 'now'
+    finally:
+        bot.queue.stop()
+    assert bot.queue.stats['bulk']['sent'] == bot.queue.stats['interactive']['sent'] == 1
+    with pytest.raises(RuntimeError):
+        bot.send_message(chat_id=1, text='stopped')
@@ -0,0 +1,96 @@
+"""
+    Tests of the keyset pages of /myreminders
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+from tests.conftest import job_context
+
+USER_ID = 1
+
+
+@pytest.fixture
+def reminder_ids(db):
+    """Ids of 25 pending reminders of the user, by due time. Every three in a row are due at once"""
+    from bot.jobs.db_ops import add_reminders, expire_reminders
+    from bot.utils import reminder_columns
+
+    start = datetime.utcnow() + timedelta(days=1)
+    contexts = [job_context(USER_ID, f'reminder {i}', start + timedelta(minutes=i // 3)) for i in range(25)]
+    ids = add_reminders([reminder_columns(context) for context in contexts])
+    others = add_reminders([
+        reminder_columns(job_context(USER_ID, 'expired', start)),
+        reminder_columns(job_context(2, 'of another user', start)),
+    ])
+    expire_reminders([key for key in others if 'expired' in key])
+    return sorted(ids.values())
+
+
+def page(after=None, before=None):
+    from bot.jobs.db_ops import get_reminders_page
+
+    reminders, more = get_reminders_page(USER_ID, 10, after=after, before=before)
+    return [reminder.id for reminder in reminders], more
+
+
+def position(reminder_id):
+    from bot.db import session_scope
+    from bot.jobs.models import Reminder
+
+    with session_scope() as session:
+        reminder = session.query(Reminder).get(reminder_id)
+        return reminder.remind_time, reminder.id
+
+
+def test_pages_go_through_pending_reminders_in_order(reminder_ids):
+    first, more = page()
+    assert (first, more) == (reminder_ids[:10], True)
+
+    second, more = page(after=position(first[-1]))
+    assert (second, more) == (reminder_ids[10:20], True)
+
+    last, more = page(after=position(second[-1]))
+    assert (last, more) == (reminder_ids[20:], False)
+
+    assert page(before=position(last[0])) == (second, True)
+    assert page(before=position(second[0])) == (first, False)
+
+
+def test_ties_on_due_time_are_broken_by_id(reminder_ids):
+    # The 10th and 11th reminders are due at the same time
+    assert position(reminder_ids[9])[0] == position(reminder_ids[10])[0]
+    assert page(after=position(reminder_ids[9]))[0][0] == reminder_ids[10]
+    assert page(before=position(reminder_ids[10]))[0][-1] == reminder_ids[9]
+
+
+def test_no_reminders(db):
+    assert page() == ([], False)
+
+
+def test_page_buttons_turn_pages(reminder_ids):
+    from bot.handlers.myreminders import NEXT, PREVIOUS, render_page, _decode_position
+
+    def turn(buttons, direction):
+        for button in buttons.inline_keyboard[0]:
+            _, button_direction, user_id, button_position = button.callback_data.split('|')
+            if button_direction == direction:
+                assert int(user_id) == USER_ID
+                return render_page(USER_ID, 0, direction, _decode_position(button_position))
+        raise AssertionError(f'No {direction} button')
+
+    def shown(text):
+        return [line.split(' | ')[0].strip() for line in text.splitlines()]
+
+    text, buttons = render_page(USER_ID, 0)
+    assert shown(text) == [f'reminder {i}' for i in range(10)]
+    assert [button.text for button in buttons.inline_keyboard[0]] == ['Next ➡️']
+
+    text, buttons = turn(buttons, NEXT)
+    assert shown(text) == [f'reminder {i}' for i in range(10, 20)]
+    text, buttons = turn(buttons, NEXT)
+    assert shown(text) == [f'reminder {i}' for i in range(20, 25)]
+    assert [button.text for button in buttons.inline_keyboard[0]] == ['⬅️ Previous']
+
+    text, buttons = turn(buttons, PREVIOUS)
+    assert shown(text) == [f'reminder {i}' for i in range(10, 20)]
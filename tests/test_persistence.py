@@ -0,0 +1,94 @@
+"""
+    Tests of PSQLPersistence checkpoints and of recovering from its journal after a crash
+"""
+import pytest
+
+
+@pytest.fixture
+def journal_path(db, tmp_path):
+    return str(tmp_path / 'state.journal')
+
+
+def persistence(journal_path=None):
+    from bot.persistence.psqlpersistence import PSQLPersistence
+
+    return PSQLPersistence(journal_path=journal_path)
+
+
+def restored(journal_path):
+    restarted = persistence(journal_path)
+    return restarted.get_user_data(), restarted.get_chat_data(), restarted.get_conversations('remind')
+
+
+def test_changes_not_checkpointed_are_replayed_from_the_journal(journal_path):
+    crashed = persistence(journal_path)
+    crashed.get_user_data()
+    crashed.update_user_data(1, {'offset': -10800})
+    crashed.update_chat_data(-5, {'thing_to_remind': 'water'})
+    crashed.update_conversation('remind', (-5, 1), 2)
+    crashed.update_user_data(1, {'offset': 3600})
+
+    users, chats, conversations = restored(journal_path)
+    assert users == {1: {'offset': 3600}}
+    assert chats == {-5: {'thing_to_remind': 'water'}}
+    assert conversations == {(-5, 1): 2}
+
+
+def test_checkpoints_store_only_changed_rows_and_discard_the_journal(journal_path):
+    first = persistence(journal_path)
+    first.get_user_data()
+    first.update_user_data(1, {'offset': 0})
+    first.update_user_data(2, {'offset': 3600})
+    assert first.checkpoint()
+    assert first.stats['checkpoints'] == 1
+
+    first.update_user_data(2, {'offset': 3600})
+    assert first._collect_dirty_rows() == ([], [], [], [])
+
+    users, _, _ = restored(journal_path)
+    assert users == {1: {'offset': 0}, 2: {'offset': 3600}}
+    assert list(first._journal.replay()) == []
+
+
+def test_failed_checkpoints_keep_the_journal_and_dirty_rows(journal_path, monkeypatch):
+    from bot.persistence.psqlpersistence import PSQLPersistence
+
+    crashed = persistence(journal_path)
+    crashed.get_user_data()
+    crashed.update_user_data(1, {'offset': 0})
+
+    def fail(conn, rows):
+        raise RuntimeError('db is down')
+
+    monkeypatch.setattr(PSQLPersistence, '_write_rows', staticmethod(fail))
+    assert not crashed.checkpoint()
+    crashed.update_user_data(2, {'offset': 3600})
+    monkeypatch.undo()
+
+    # Both the rotated changes of the failed checkpoint and the newer ones are replayed
+    users, _, _ = restored(journal_path)
+    assert users == {1: {'offset': 0}, 2: {'offset': 3600}}
+    assert crashed.checkpoint()
+    assert persistence().get_user_data() == {1: {'offset': 0}, 2: {'offset': 3600}}
+
+
+def test_ended_conversations_are_deleted(journal_path):
+    first = persistence(journal_path)
+    first.get_conversations('remind')
+    first.update_conversation('remind', (1, 1), 1)
+    assert first.checkpoint()
+    first.update_conversation('remind', (1, 1), None)
+    assert first.checkpoint()
+
+    assert persistence().get_conversations('remind') == {}
+
+
+def test_truncated_journal_lines_are_skipped(journal_path):
+    crashed = persistence(journal_path)
+    crashed.get_user_data()
+    crashed.update_user_data(1, {'offset': 0})
+    with open(journal_path, 'a') as journal:
+        journal.write('{"kind": "user", "key": 2, "da')
+
+    users, _, _ = restored(journal_path)
+    assert users == {1: {'offset': 0}}
@@ -0,0 +1,116 @@
+"""
+    Tests of recurrence rules and of moving recurring reminders to their next occurrence
+"""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from bot.recurrence import InvalidRule, _cron_sets, describe, next_occurrence, parse_rule
+from tests.conftest import job_context
+
+
+@pytest.mark.parametrize('text, rule', [
+    ('2h', 'every 7200'),
+    ('30 min', 'every 1800'),
+    ('every 86400', 'every 86400'),
+    ('day 9:00', 'cron 0 9 * * *'),
+    ('Weekdays  8.30', 'cron 30 8 * * 1-5'),
+    ('monday 10:00', 'cron 0 10 * * 1'),
+    ('cron 0 9 29 2 *', 'cron 0 9 29 2 *'),
+])
+def test_parse_rule(text, rule):
+    assert parse_rule(text) == rule
+
+
+@pytest.mark.parametrize('text', [
+    '30s', 'every 10', 'someday 9:00', 'day 25:00', 'cron 0 9 * *', 'cron 0 9 * * 8', 'cron 0 9 31 2 *',
+])
+def test_invalid_rules_are_rejected(text):
+    with pytest.raises(InvalidRule):
+        parse_rule(text)
+
+
+@pytest.mark.parametrize('dow, weekdays', [
+    ('7', {0}),
+    ('5-7', {0, 5, 6}),
+    ('1,7', {0, 1}),
+    ('0-7', set(range(7))),
+    ('*', set(range(7))),
+    ('*/2', {0, 2, 4, 6}),
+])
+def test_sunday_is_both_0_and_7(dow, weekdays):
+    assert _cron_sets(f'cron 0 9 * * {dow}')[4] == weekdays
+
+
+def test_intervals_skip_occurrences_missed_while_down():
+    previous = datetime(2024, 5, 1, 9, tzinfo=timezone.utc)
+    now = previous + timedelta(hours=5, minutes=30)
+    assert next_occurrence('every 7200', previous, 0, now) == previous + timedelta(hours=6)
+
+
+def test_cron_rules_run_on_the_users_time():
+    # Friday 2024-05-03 at 12:00 utc, 09:00 at utc-3
+    now = datetime(2024, 5, 3, 12, tzinfo=timezone.utc)
+    assert next_occurrence('cron 0 10 * * 5-7', now, -10800, now) == datetime(2024, 5, 3, 13, tzinfo=timezone.utc)
+    assert next_occurrence('cron 0 8 * * 5-7', now, -10800, now) == datetime(2024, 5, 4, 11, tzinfo=timezone.utc)
+    assert next_occurrence('cron 0 8 * * 7', now, -10800, now) == datetime(2024, 5, 5, 11, tzinfo=timezone.utc)
+
+
+def test_describe():
+    assert describe('every 7200') == 'every 2h'
+    assert describe('cron 30 8 * * 1-5') == 'every weekday at 8:30'
+    assert describe('cron 0 10 1 * *') == 'cron 0 10 1 * *'
+
+
+def test_reminders_that_cant_advance_are_expired(db):
+    from bot.jobs.db_ops import add_reminders, get_reminder
+    from bot.utils import reminder_columns, schedule_next_occurrence
+
+    when = datetime.utcnow()
+    # Stored before rules were checked as a whole
+    context = job_context(1, 'never', when, recurrence='cron 0 0 31 2 *')
+    reminder_id, = add_reminders([reminder_columns(context)]).values()
+
+    schedule_next_occurrence(None, {**context, 'reminder_id': reminder_id})
+    assert get_reminder(reminder_id, 1).expired is True
+
+
+def test_recurring_reminders_advance(db):
+    from bot.jobs.db_ops import add_reminders, get_reminder
+    from bot.utils import reminder_columns, schedule_next_occurrence
+
+    when = datetime.utcnow() + timedelta(days=5)
+    context = job_context(1, 'stretch', when, recurrence='every 86400')
+    reminder_id, = add_reminders([reminder_columns(context)]).values()
+
+    schedule_next_occurrence(None, {**context, 'reminder_id': reminder_id})
+    reminder = get_reminder(reminder_id, 1)
+    assert reminder.expired is False
+    assert reminder.remind_time.replace(tzinfo=None) == when + timedelta(days=1)
+
+
+def test_follow_ups_of_notifications_sent_on_shutdown_are_run(db):
+    from telegram.ext import Dispatcher, JobQueue
+
+    from benchmarks.fakes import FakeQueuedBot
+    from bot.jobs.db_ops import add_reminders, get_reminder
+    from bot.utils import reminder_columns, run_follow_ups, send_notification
+
+    bot = FakeQueuedBot(latency=0.05)
+    job_queue = JobQueue()
+    dispatcher = Dispatcher(bot, None, workers=0, job_queue=job_queue, use_context=True)
+    job_queue.set_dispatcher(dispatcher)
+
+    when = datetime.utcnow() - timedelta(minutes=1)
+    context = job_context(1, 'stretch', when, recurrence='every 172800')
+    reminder_id, = add_reminders([reminder_columns(context)]).values()
+    job_queue.run_once(send_notification, when, context={**context, 'reminder_id': reminder_id})
+
+    # The job_queue is never started, like once it was stopped on shutdown
+    job_queue.tick()
+    bot.queue.stop()
+    assert len(bot.sent) == 1
+    assert get_reminder(reminder_id, 1).remind_time.replace(tzinfo=None) == when
+
+    run_follow_ups(job_queue, dispatcher)
+    assert get_reminder(reminder_id, 1).remind_time.replace(tzinfo=None) == when + timedelta(days=2)
@@ -0,0 +1,119 @@
+"""
+    Tests of reading reminders from .csv and .ics files
+"""
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from bot.reminder_files import CSV, ICS, Entry, file_kind, parse_date, read_csv, read_ics
+
+
+@pytest.mark.parametrize('file_name, kind', [
+    ('reminders.csv', CSV), ('Calendar.ICS', ICS), ('old.ical', ICS), ('notes.txt', None), (None, None),
+])
+def test_file_kind(file_name, kind):
+    assert file_kind(file_name) == kind
+
+
+@pytest.mark.parametrize('text, date', [
+    ('2024-05-01 18:30', datetime(2024, 5, 1, 18, 30)),
+    ('2024-05-01T18:30:15', datetime(2024, 5, 1, 18, 30, 15)),
+    ('2024-05-01T18:30Z', datetime(2024, 5, 1, 18, 30, tzinfo=timezone.utc)),
+    ('2024-05-01', datetime(2024, 5, 1, 9)),
+    (' 01/05/2024 18:30 ', datetime(2024, 5, 1, 18, 30)),
+    ('01/05/2024', datetime(2024, 5, 1, 9)),
+])
+def test_parse_date(text, date):
+    assert parse_date(text) == date
+
+
+@pytest.mark.parametrize('text', ['', 'tomorrow', '2024-13-01', '05/01/2024 6pm'])
+def test_unknown_dates_are_rejected(text):
+    with pytest.raises(ValueError):
+        parse_date(text)
+
+
+def test_read_csv_with_header():
+    lines = [
+        'Date,Text,Recurrence\n',
+        '2024-05-01 09:30,Water the plants,day 9:30\n',
+        '\n',
+        '01/05/2024,"Call mom, again",\n',
+        '2024-05-01,,\n',
+        'someday,Pay rent,\n',
+        '2024-05-01,Gym,someday 9:00\n',
+    ]
+    assert list(read_csv(lines)) == [
+        Entry(2, 'Water the plants', datetime(2024, 5, 1, 9, 30), 'cron 30 9 * * *', None),
+        Entry(4, 'Call mom, again', datetime(2024, 5, 1, 9), None, None),
+        Entry(5, '', None, None, 'Missing text'),
+        Entry(6, 'Pay rent', None, None, "Unknown date 'someday'"),
+        Entry(7, 'Gym', None, None, "Unknown repetition 'someday 9:00'"),
+    ]
+
+
+def test_read_csv_without_header():
+    assert list(read_csv(['Stretch,2024-05-01 10:00\n', 'Read,2024-05-02 22:00,2h\n'])) == [
+        Entry(1, 'Stretch', datetime(2024, 5, 1, 10), None, None),
+        Entry(2, 'Read', datetime(2024, 5, 2, 22), 'every 7200', None),
+    ]
+
+
+def calendar(*events):
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0']
+    for event in events:
+        lines += ['BEGIN:VEVENT', *event, 'END:VEVENT']
+    return [f'{line}\r\n' for line in lines + ['END:VCALENDAR']]
+
+
+def test_read_ics_dates():
+    lines = calendar(
+        ['SUMMARY:Utc', 'DTSTART:20240501T093000Z'],
+        ['SUMMARY:Floating', 'DTSTART:20240501T093000'],
+        ['SUMMARY:Zoned', 'DTSTART;TZID=America/Argentina/Buenos_Aires:20240501T093000'],
+        ['SUMMARY:Unknown zone', 'DTSTART;TZID="Custom: zone":20240501T093000'],
+        ['SUMMARY:All day', 'DTSTART;VALUE=DATE:20240501'],
+        ['SUMMARY:Bad start', 'DTSTART:May 1st'],
+        ['SUMMARY:No start'],
+        ['DTSTART:20240501T093000Z'],
+    )
+    assert [(entry.text, entry.when, entry.error) for entry in read_ics(lines)] == [
+        ('Utc', datetime(2024, 5, 1, 9, 30, tzinfo=timezone.utc), None),
+        ('Floating', datetime(2024, 5, 1, 9, 30), None),
+        ('Zoned', datetime(2024, 5, 1, 9, 30, tzinfo=ZoneInfo('America/Argentina/Buenos_Aires')), None),
+        ('Unknown zone', datetime(2024, 5, 1, 9, 30), None),
+        ('All day', datetime(2024, 5, 1, 9), None),
+        ('Bad start', None, "Unknown start 'May 1st'"),
+        ('No start', None, 'Event without start'),
+        ('', None, 'Event without summary'),
+    ]
+    assert [entry.line for entry in read_ics(lines)] == [3, 7, 11, 15, 19, 23, 27, 30]
+
+
+def test_read_ics_unfolds_and_unescapes_summaries():
+    lines = calendar([
+        'SUMMARY:Buy milk\\, eggs\\; and',
+        '  bread\\nat the\\\\store',
+        'DTSTART:20240501T093000Z',
+    ])
+    [entry] = read_ics(lines)
+    assert entry.text == 'Buy milk, eggs; and bread\nat the\\store'
+
+
+def test_read_ics_skips_properties_of_nested_components():
+    lines = calendar([
+        'BEGIN:VALARM',
+        'SUMMARY:Alarm',
+        'DTSTART:20240430T093000Z',
+        'END:VALARM',
+        'SUMMARY:Dentist',
+        'DTSTART:20240501T093000Z',
+        'RRULE:FREQ=WEEKLY',
+    ])
+    assert list(read_ics(lines)) == [Entry(3, 'Dentist', datetime(2024, 5, 1, 9, 30, tzinfo=timezone.utc), None, None)]
+
+
+def test_read_ics_ignores_properties_outside_events():
+    lines = ['BEGIN:VCALENDAR\n', 'SUMMARY:Calendar\n', 'DTSTART:20240501T093000Z\n', 'END:VCALENDAR\n']
+    assert list(read_ics(lines)) == []
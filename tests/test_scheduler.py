@@ -0,0 +1,136 @@
+"""
+    Tests of the db scheduler, with several workers sharing the reminder table
+"""
+import threading
+from concurrent.futures import Future
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from benchmarks.fakes import FakeBot, FakeQueuedBot
+from tests.conftest import job_context
+
+
+@pytest.fixture
+def due(db):
+    """Add n reminders due a minute ago to chat. Returns their ids"""
+    from bot.jobs.db_ops import add_reminders
+    from bot.utils import reminder_columns
+
+    def add(n, chat_id=1, **extra):
+        when = datetime.utcnow() - timedelta(minutes=1)
+        contexts = [{**job_context(chat_id, f'reminder {i}', when + timedelta(seconds=i), **extra), 'chat_id': chat_id}
+                    for i in range(n)]
+        return sorted(add_reminders([reminder_columns(context) for context in contexts]).values())
+    return add
+
+
+def reminders():
+    from bot.db import session_scope
+    from bot.jobs.models import Reminder
+
+    with session_scope() as session:
+        return {reminder.id: reminder for reminder in session.query(Reminder)}
+
+
+def scheduler(bot=None, **options):
+    from bot.jobs.scheduler import ReminderScheduler
+
+    return ReminderScheduler(bot or FakeBot(), **options)
+
+
+def test_workers_lease_different_reminders(due):
+    ids = due(6)
+    first, second = scheduler(batch_size=4, worker_id='a'), scheduler(batch_size=4, worker_id='b')
+    now = datetime.now(timezone.utc)
+
+    _, claimed = first.claim_due(now)
+    _, claimed_after = second.claim_due(now)
+    assert sorted(reminder.id for reminder in claimed) == ids[:4]
+    assert sorted(reminder.id for reminder in claimed_after) == ids[4:]
+    assert second.claim_due(now)[1] == []
+
+
+def test_two_workers_send_each_reminder_once(due):
+    ids = due(5) + due(5, chat_id=2)
+    bot = FakeBot()
+    first, second = scheduler(bot, batch_size=3), scheduler(bot, batch_size=3)
+
+    while first.tick() + second.tick():
+        pass
+    texts = [(data['chat_id'], data['text'].split(' ', 1)[1].rsplit(' ', 2)[0]) for _, _, data in bot.sent]
+    assert len(texts) == len(set(texts)) == 10
+    assert all(reminder.expired and reminder.lease_owner is None for reminder in reminders().values())
+    assert set(reminders()) == set(ids)
+
+
+def test_expired_leases_are_delivered_again(due):
+    ids = due(2)
+    crashed, other = scheduler(lease_seconds=60, worker_id='crashed'), scheduler(lease_seconds=60, worker_id='other')
+    now = datetime.now(timezone.utc)
+    crashed_lease, _ = crashed.claim_due(now)
+
+    assert other.claim_due(now + timedelta(seconds=59))[1] == []
+    _, claimed = other.claim_due(now + timedelta(seconds=61))
+    assert sorted(reminder.id for reminder in claimed) == ids
+
+    # The crashed worker can't fire reminders it no longer holds
+    crashed.mark_fired(crashed_lease, ids)
+    assert not any(reminder.expired for reminder in reminders().values())
+
+
+def test_batches_take_a_few_reminders_per_chat(due):
+    due(5, chat_id=-100)
+    due(2, chat_id=2)
+    _, claimed = scheduler(max_per_chat=3).claim_due(datetime.now(timezone.utc))
+    assert sorted(reminder.chat_id for reminder in claimed) == [-100, -100, -100, 2, 2]
+
+
+def test_leases_are_extended_while_sends_are_queued(due):
+    reminder_id, = due(1)
+    worker = scheduler(lease_seconds=1)
+    lease_id, (reminder,) = worker.claim_due(datetime.now(timezone.utc))
+    leased_until = reminders()[reminder_id].leased_until
+    extended = []
+
+    def extend_lease(lease_id, reminder_ids):
+        type(worker).extend_lease(worker, lease_id, reminder_ids)
+        extended.append(reminders()[reminder_id].leased_until)
+
+    worker.extend_lease = extend_lease
+    sent = Future()
+    threading.Timer(0.8, sent.set_result, ['message']).start()
+    assert worker.drain(lease_id, [(reminder, sent)]) == 1
+    # Extended once after half the lease, then released when fired
+    assert len(extended) == 1 and extended[0] > leased_until
+    assert reminders()[reminder_id].expired
+    assert reminders()[reminder_id].leased_until is None
+
+
+def test_failed_sends_keep_their_lease(due):
+    reminder_id, = due(1)
+    worker = scheduler()
+    lease_id, (reminder,) = worker.claim_due(datetime.now(timezone.utc))
+
+    failed = Future()
+    failed.set_exception(RuntimeError('Forbidden: bot was blocked by the user'))
+    assert worker.drain(lease_id, [(reminder, failed)]) == 0
+    assert reminders()[reminder_id].lease_owner == lease_id
+    assert not reminders()[reminder_id].expired
+
+
+def test_recurring_reminders_that_cant_advance_are_released(due):
+    reminder_id, = due(1, recurrence='cron 0 0 31 2 *')
+    assert scheduler().tick() == 1
+    reminder = reminders()[reminder_id]
+    assert reminder.expired and reminder.lease_owner is None
+
+
+def test_queued_bot_batches(due):
+    due(3)
+    bot = FakeQueuedBot()
+    try:
+        assert scheduler(bot).tick() == 3
+    finally:
+        bot.queue.stop()
+    assert len(bot.sent) == 3
@@ -0,0 +1,138 @@
+"""
+    Tests of user sharding and of the router that forwards updates to shards
+"""
+import asyncio
+import json
+
+import pytest
+import tornado.web
+from sqlalchemy import text
+from telegram import Update
+from telegram.ext import DispatcherHandlerStop
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+
+from bot import sharding
+from bot.sharding import conversation_owner, owned_by_shard, owns, routing_key, shard_of
+from bot.webhook import SECRET_HEADER, WEBHOOK_PATH
+
+SECRET = 'secret'
+
+
+@pytest.fixture
+def second_of_three(monkeypatch):
+    monkeypatch.setattr(sharding, 'SHARD_COUNT', 3)
+    monkeypatch.setattr(sharding, 'SHARD_INDEX', 1)
+
+
+def message_update(user_id, chat_id=None, update_id=1):
+    user = {'id': user_id, 'is_bot': False, 'first_name': 'user'}
+    chat = {'id': chat_id or user_id, 'type': 'private' if chat_id is None else 'group'}
+    return {'update_id': update_id, 'message': {'message_id': 1, 'date': 0, 'from': user, 'chat': chat, 'text': 'hi'}}
+
+
+def test_shards_keep_the_sign_of_python_modulo(second_of_three):
+    assert [shard_of(user_id) for user_id in (1, 3, 4, -1, -2, -3)] == [1, 0, 1, 2, 1, 0]
+    assert [owns(user_id) for user_id in (1, 2, -2, -1001234567890)] == [True, False, True, False]
+
+
+def test_sql_condition_matches_python_shards(db, second_of_three):
+    from bot.db import transaction
+
+    user_ids = range(-7, 8)
+    with transaction() as conn:
+        conn.execute(text('INSERT INTO user_state (user_id, data) VALUES (:id, :data)'),
+                     [{'id': user_id, 'data': '{}'} for user_id in user_ids])
+        owned = conn.execute(text(f"SELECT user_id FROM user_state WHERE {owned_by_shard('user_id')}"))
+        assert sorted(user_id for user_id, in owned) == [user_id for user_id in user_ids if owns(user_id)]
+
+
+def test_updates_are_routed_by_user_then_chat():
+    assert routing_key(message_update(7, chat_id=-100)) == 7
+    callback_query = {'update_id': 2, 'callback_query': {'id': '1', 'from': {'id': 8}, 'chat_instance': '1'}}
+    assert routing_key(callback_query) == 8
+    channel_post = {'update_id': 3, 'channel_post': {'message_id': 1, 'date': 0, 'chat': {'id': -100}}}
+    assert routing_key(channel_post) == -100
+    assert routing_key({'update_id': 4, 'poll': {'id': '1', 'question': '?', 'options': []}}) == 4
+
+
+def test_conversations_belong_to_their_user():
+    assert conversation_owner((-100, 7)) == 7
+    assert conversation_owner((-100, 7, 42)) == 7
+    assert conversation_owner((7,)) == 7
+
+
+def test_updates_of_other_shards_are_dropped(second_of_three):
+    sharding.drop_foreign_update(Update.de_json(message_update(4, chat_id=-100), None), None)
+    with pytest.raises(DispatcherHandlerStop):
+        sharding.drop_foreign_update(Update.de_json(message_update(5), None), None)
+
+
+class FakeShard(tornado.web.RequestHandler):
+    def initialize(self, received):
+        self.received = received
+
+    def post(self):
+        self.received.append((self.request.headers.get(SECRET_HEADER), json.loads(self.request.body)))
+
+
+def route(updates, secret=SECRET):
+    """Post updates to a router of two fake shards. Returns the response codes and what each shard got"""
+    from bot.router import make_app
+
+    async def post_all():
+        sock, port = bind_unused_port()
+        url = f'http://127.0.0.1:{port}'
+        received = [[], []]
+        router = make_app([f'{url}/shard0', f'{url}/shard1'], SECRET)
+        router.add_handlers(r'.*', [
+            (rf'/shard{i}{WEBHOOK_PATH}', FakeShard, {'received': shard}) for i, shard in enumerate(received)
+        ])
+        server = HTTPServer(router)
+        server.add_sockets([sock])
+        try:
+            codes = []
+            for update in updates:
+                response = await AsyncHTTPClient().fetch(
+                    f'{url}{WEBHOOK_PATH}', method='POST', body=json.dumps(update),
+                    headers={SECRET_HEADER: secret}, raise_error=False,
+                )
+                codes.append(response.code)
+            return codes, received
+        finally:
+            server.stop()
+
+    return asyncio.run(post_all())
+
+
+def test_updates_are_forwarded_to_the_shard_of_their_user():
+    codes, received = route([message_update(user_id, update_id=i) for i, user_id in enumerate([2, 3, -3, 10])])
+
+    assert codes == [200] * 4
+    assert [[update['update_id'] for _, update in shard] for shard in received] == [[0, 3], [1, 2]]
+    assert {secret for shard in received for secret, _ in shard} == {SECRET}
+
+
+def test_updates_without_the_secret_are_not_forwarded():
+    assert route([message_update(2)], secret='wrong') == ([403], [[], []])
+
+
+def test_shards_load_only_the_conversations_of_their_users(db, second_of_three):
+    from bot.db import transaction
+    from bot.persistence.psqlpersistence import PSQLPersistence
+
+    stored = PSQLPersistence()
+    stored.get_conversations('remind')
+    for user_id in (1, 2, 4):
+        stored.update_conversation('remind', (-100, user_id), 1)
+    assert stored.checkpoint()
+    with transaction() as conn:
+        # Stored by a version that did not record the user
+        conn.execute(text("INSERT INTO conversation_state (name, key, state) VALUES ('remind', :key, '2')"),
+                     [{'key': str((-100, 5))}, {'key': str((-100, 7))}])
+        assert conn.execute(text(
+            f"SELECT COUNT(*) FROM conversation_state WHERE {owned_by_shard('user_id')}"
+        )).scalar() == 2
+
+    assert PSQLPersistence().get_conversations('remind') == {(-100, 1): 1, (-100, 4): 1, (-100, 7): 2}
@@ -0,0 +1,58 @@
+"""
+    Tests of the sentry sampling policy of bot.tracing
+"""
+from bot.tracing import SamplingPolicy, parse_rates, rate_of
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def policy(per_minute, rates='default=1', slow_seconds=0, clock=None):
+    return SamplingPolicy(parse_rates(rates), {}, slow_seconds, per_minute, clock=clock or FakeClock())
+
+
+def test_most_specific_rate_wins():
+    rates = parse_rates('handler=0.05, job=0.01,job:send_notification=0')
+    assert rate_of(rates, 'job', 'send_notification') == 0
+    assert rate_of(rates, 'job', 'flush') == 0.01
+    assert rate_of(rates, 'handler', 'quicky') == 0.05
+    assert rate_of(rates, 'other', 'name') == 0
+
+
+def test_zero_budget_samples_nothing():
+    zero = policy(per_minute=0, slow_seconds=1)
+    assert not any(zero.sample('handler', 'quicky') for _ in range(3))
+    zero.observe('handler', 'quicky', 5)
+    assert zero.stats['sampled'] == zero.stats['slow'] == 0
+    assert zero.stats['over_budget'] == 4
+
+
+def test_exhausted_budget_drops_until_refilled():
+    clock = FakeClock()
+    budget = policy(per_minute=2, clock=clock)
+    assert budget.sample('handler', 'quicky') and budget.sample('handler', 'quicky')
+    assert not budget.sample('handler', 'quicky')
+    assert budget.stats['over_budget'] == 1
+
+    clock.now += 30
+    assert budget.sample('handler', 'quicky')
+    assert not budget.sample('handler', 'quicky')
+
+
+def test_unsampled_rate_does_not_take_from_budget():
+    never = policy(per_minute=1, rates='default=0')
+    assert not never.sample('job', 'flush')
+    assert never.stats == {'sampled': 0, 'slow': 0, 'dropped': 1, 'over_budget': 0}
+
+
+def test_only_slow_callbacks_are_reported():
+    slow = policy(per_minute=10, rates='default=0', slow_seconds=2)
+    slow.observe('handler', 'quicky', 1.5)
+    assert slow.stats['slow'] == 0
+    slow.observe('handler', 'quicky', 2.5)
+    assert slow.stats['slow'] == 1
@@ -0,0 +1,104 @@
+"""
+    Tests of the webhook server, which only takes updates that carry the secret token
+"""
+import asyncio
+import json
+import queue
+
+import pytest
+import tornado.web
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+
+from bot.webhook import HEALTH_PATH, SECRET_HEADER, WEBHOOK_PATH, HealthHandler, SecretWebhookHandler, start_webhook
+
+SECRET = 'secret'
+UPDATE = {'update_id': 1, 'message': {
+    'message_id': 1, 'date': 0, 'text': 'hi',
+    'chat': {'id': 7, 'type': 'private'}, 'from': {'id': 7, 'is_bot': False, 'first_name': 'user'},
+}}
+
+
+def serve(requests):
+    """Make requests, as (method, path, headers), to a webhook server. Returns the response codes and queued updates"""
+    async def fetch_all():
+        sock, port = bind_unused_port()
+        updates = queue.Queue()
+        server = HTTPServer(tornado.web.Application([
+            (rf'{WEBHOOK_PATH}/?', SecretWebhookHandler,
+             {'bot': None, 'update_queue': updates, 'secret_token': SECRET}),
+            (HEALTH_PATH, HealthHandler),
+        ]))
+        server.add_sockets([sock])
+        try:
+            codes = []
+            for method, path, headers in requests:
+                response = await AsyncHTTPClient().fetch(
+                    f'http://127.0.0.1:{port}{path}', method=method, headers=headers, raise_error=False,
+                    body=json.dumps(UPDATE) if method == 'POST' else None,
+                )
+                codes.append(response.code)
+            return codes, [updates.get_nowait().update_id for _ in range(updates.qsize())]
+        finally:
+            server.stop()
+
+    return asyncio.run(fetch_all())
+
+
+def post(**headers):
+    return 'POST', WEBHOOK_PATH, {'Content-Type': 'application/json', **headers}
+
+
+def test_updates_with_the_secret_are_queued():
+    assert serve([post(**{SECRET_HEADER: SECRET})]) == ([200], [1])
+
+
+@pytest.mark.parametrize('headers', [{}, {SECRET_HEADER: ''}, {SECRET_HEADER: 'wrong'}, {SECRET_HEADER: SECRET[:-1]}])
+def test_updates_without_the_secret_are_rejected(headers):
+    assert serve([post(**headers)]) == ([403], [])
+
+
+def test_telegram_checks_still_apply():
+    assert serve([('POST', WEBHOOK_PATH, {SECRET_HEADER: SECRET, 'Content-Type': 'text/plain'})]) == ([403], [])
+
+
+def test_health_checks_need_no_secret():
+    assert serve([('GET', HEALTH_PATH, {})]) == ([200], [])
+
+
+class FakeUpdater(object):
+    def __init__(self):
+        self.bot = self
+        self.webhooks = []
+        self.started = None
+        self.secret_token = None
+
+    def set_webhook(self, **kwargs):
+        self.webhooks.append(kwargs)
+
+    def start_webhook(self, **kwargs):
+        self.started = kwargs
+
+
+def test_registered_webhooks_get_a_secret(monkeypatch):
+    monkeypatch.delenv('WEBHOOK_SECRET', raising=False)
+    updater = FakeUpdater()
+    start_webhook(updater, 8443, 'https://bot.example.com/')
+
+    [webhook] = updater.webhooks
+    assert webhook['url'] == f'https://bot.example.com{WEBHOOK_PATH}'
+    assert len(webhook['secret_token']) == 64
+    assert updater.secret_token == webhook['secret_token']
+    assert updater.started['url_path'] == WEBHOOK_PATH
+
+
+def test_shards_need_the_secret_of_the_router(monkeypatch):
+    monkeypatch.delenv('WEBHOOK_SECRET', raising=False)
+    with pytest.raises(ValueError):
+        start_webhook(FakeUpdater(), 8443)
+
+    monkeypatch.setenv('WEBHOOK_SECRET', SECRET)
+    updater = FakeUpdater()
+    start_webhook(updater, 8443)
+    assert (updater.webhooks, updater.secret_token) == ([], SECRET)